@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+
+# the synthetic services of bench/config.py, not the ones of config.py
+ROOT = os.path.dirname(os.path.abspath(__file__))
+os.chdir(ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+import google.protobuf
+import google.protobuf.text_format as tf
+
+from config import services, replace, delete, proto_out
+from lib import __version__
+from lib import grammar
+from lib import helper
+from lib import tree_helper
+from lib.builder import BuildError
+from lib.inject import Template
+from fuzzer import ProtoFuzzer, AsyncRunner
+
+SINK_RESPONSE = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+RE_CONTENT_LENGTH = re.compile(rb'^content-length:\s*(\d+)', re.IGNORECASE | re.MULTILINE)
+
+def sink(sock):
+    """
+    Answer every request on the listening socket `sock` with a short 200,
+    over keep-alive connections
+    """
+    async def handle(reader, writer):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = RE_CONTENT_LENGTH.search(head)
+                await reader.readexactly(int(length[1]) if length else 0)
+                writer.write(SINK_RESPONSE)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve():
+        server = await asyncio.start_server(handle, sock=sock)
+        await server.serve_forever()
+
+    asyncio.run(serve())
+
+def start_sink():
+    """
+    Run the sink in a process of its own, return the process and its port
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(1024)
+    port = sock.getsockname()[1]
+    process = multiprocessing.Process(target=sink, args=(sock,), daemon=True)
+    process.start()
+    sock.close()
+    return process, port
+
+def timed(func, items, errors=()):
+    """
+    Call `func` on every item, return the stage statistics and the results,
+    None for the items raising one of `errors`
+    """
+    results = []
+    failed = 0
+    start = time.perf_counter()
+    for item in items:
+        try:
+            results.append(func(item))
+        except errors:
+            results.append(None)
+            failed += 1
+    elapsed = time.perf_counter() - start
+    return stage(len(results), elapsed, failed), results
+
+def stage(calls, elapsed, failed=0):
+    return {
+        'calls': calls,
+        'failed': failed,
+        'seconds': round(elapsed, 6),
+        'us_per_call': round(elapsed / calls * 1e6, 2) if calls else None,
+        'per_second': round(calls / elapsed, 1) if elapsed else None,
+    }
+
+def bench_grammar(v, repeat):
+    """
+    Time the creation of the grammar of `v`, `repeat` times
+    """
+    stages = dict()
+    start_symbol = f'<{v["request"]}>'
+
+    # gpb_to_ebnf ends with convert_ebnf_grammar
+    stages['gpb_to_ebnf'], bnf = timed(lambda _: grammar.gpb_to_ebnf(v['msg']), range(repeat))
+    stages['compile_grammar'], compiled = timed(
+        lambda g: grammar.compile_grammar(g, start_symbol), bnf)
+    stages['check_grammar'], _ = timed(lambda g: grammar.check_grammar(g, start_symbol), compiled)
+    return stages, compiled[0]
+
+def bench_stages(fuzzer, v, n):
+    """
+    Time every stage from the derivation tree to the serialized message, on `n` inputs
+    """
+    stages = dict()
+    fuzzer.v = v
+    parse_errors = (tf.ParseError, ValueError)
+
+    stages['expand_tree'], trees = timed(lambda _: fuzzer.fuzz_tree(), range(n))
+    stages['tree_to_gpb'], _ = timed(tree_helper.tree_to_gpb, trees)
+
+    stages['template'], templates = timed(
+        lambda tree: Template(*tree_helper.tree_to_chunks(tree)), trees)
+    stages['template_delete'], _ = timed(
+        lambda template: [template.delete(key) for key in delete], templates)
+    stages['template_set'], _ = timed(
+        lambda template: [template.set(key, value) for key, value in replace.items()], templates)
+
+    # filling the payloads, then joining the chunks into the text
+    def fill(template):
+        template.inject(fuzzer.value_sources(), fuzzer.field_sources())
+        return template.text
+    stages['template_fill'], texts = timed(fill, templates)
+
+    stages['text_parse'], msgs = timed(lambda text: tf.Parse(text, v['msg']()), texts, parse_errors)
+    stages['serialize'], serialized = timed(lambda msg: msg.SerializePartialToString(),
+                                            [msg for msg in msgs if msg is not None])
+
+    # the other two encoders, from the trees
+    stages['build_message'], _ = timed(fuzzer.build_message, trees, (BuildError, ValueError))
+    stages['encode_wire'], _ = timed(fuzzer.encode_wire, trees)
+
+    sizes = [len(s) for s in serialized]
+    summary = {
+        'nodes': sum(len(tree.codes) for tree in trees) / n,
+        'bytes': sum(sizes) / len(sizes) if sizes else 0,
+    }
+    return stages, summary
+
+def bench_end_to_end(fuzzer, url, n, concurrency):
+    """
+    Generate `n` inputs, then generate and send them to the sink
+    """
+    start = time.perf_counter()
+    generated = sum(1 for _ in fuzzer.fuzz_iter(n))
+    generate = stage(generated, time.perf_counter() - start)
+
+    runner = AsyncRunner(concurrency, log=False)
+    stats = runner.run_iter((url, serialized) for (_, serialized) in fuzzer.fuzz_iter(n))
+    send = stage(stats['sent'], stats['elapsed'], stats['failed'])
+    return {'fuzz_iter': generate, 'end_to_end': send}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, previous):
+    """
+    Print the ratio of the time per call of every stage to the one of `previous`
+    """
+    print(f"\nagainst {previous['commit']} ({previous['time']}), time per call:")
+    for request, r in results['schemas'].items():
+        before = previous['schemas'].get(request, {}).get('stages', {})
+        for name, s in r['stages'].items():
+            b = before.get(name)
+            if b and b['us_per_call'] and s['us_per_call']:
+                ratio = s['us_per_call'] / b['us_per_call']
+                print(f"{request:<16} {name:<16} {b['us_per_call']:>12.1f} -> "
+                      f"{s['us_per_call']:>12.1f} us  x{ratio:.2f}")
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Time every stage of ppfuzz on synthetic schemas")
+    parser.add_argument("-n", type=int, default=200,
+                        help="inputs per schema for the stages (default: %(default)s)")
+    parser.add_argument("-g", type=int, default=5, metavar="REPEAT",
+                        help="grammars created per schema (default: %(default)s)")
+    parser.add_argument("-e", type=int, default=2000, metavar="INPUTS",
+                        help="inputs per schema sent to the local sink, 0 to skip "
+                             "(default: %(default)s)")
+    parser.add_argument("-c", type=int, default=32, metavar="CONCURRENCY",
+                        help="requests in flight to the sink (default: %(default)s)")
+    parser.add_argument("-E", default="message", choices=["message", "text", "wire"],
+                        metavar="ENCODER",
+                        help="encoder of the end-to-end inputs: %(choices)s (default: %(default)s)")
+    parser.add_argument("-r", action="append", metavar="REQUEST",
+                        help="only run the schema of REQUEST, can be repeated")
+    parser.add_argument("-s", "--seed", type=int, default=1,
+                        help="random seed (default: %(default)s)")
+    parser.add_argument("-o", metavar="RESULTS",
+                        help="write the results to the JSON file RESULTS")
+    parser.add_argument("-p", metavar="PREVIOUS",
+                        help="compare with the results of a previous run")
+    args = parser.parse_args()
+    unknown = helper.unknown_requests(args.r)
+    if unknown:
+        parser.error(f"no service for request(s) {', '.join(unknown)} in the config")
+
+    failures = helper.pb_compile(helper.get_proto_files(args.r), proto_out)
+    if failures:
+        exit(1)
+
+    results = {
+        'commit': git_commit(),
+        'version': __version__,
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'protobuf': google.protobuf.__version__,
+        'args': vars(args),
+        'schemas': dict(),
+    }
+
+    sink_process, port = start_sink() if args.e else (None, None)
+    try:
+        for url, request, proto in services:
+            if args.r and request not in args.r:
+                continue
+
+            random.seed(args.seed)
+            fuzzer = ProtoFuzzer(min_nonterminals=0, max_nonterminals=40, encoder=args.E,
+                                 cache=False, requests=[request])
+            v = fuzzer.vectors[0]
+
+            stages, compiled = bench_grammar(v, args.g)
+            more, summary = bench_stages(fuzzer, v, args.n)
+            stages.update(more)
+            if args.e:
+                url = re.sub(r'^(http://[^/:]+)', rf'\1:{port}', url)
+                stages.update(bench_end_to_end(fuzzer, url, args.e, args.c))
+
+            summary.update(symbols=len(compiled.symbols), stages=stages)
+            results['schemas'][request] = summary
+
+            print(f"{request}: {summary['symbols']} symbols, {summary['nodes']:.0f} nodes "
+                  f"and {summary['bytes']:.0f} bytes per input")
+            for name, s in stages.items():
+                failed = f"  ({s['failed']} failed)" if s['failed'] else ""
+                print(f"  {name:<16} {s['us_per_call']:>12.1f} us  {s['per_second']:>10.1f}/s{failed}")
+    finally:
+        if sink_process:
+            sink_process.terminate()
+
+    if args.o:
+        with open(args.o, "w") as f:
+            json.dump(results, f, indent=1)
+        print(f"results in {args.o}")
+
+    if args.p:
+        with open(args.p, "r") as f:
+            compare(results, json.load(f))
@@ -0,0 +1,26 @@
+# config of bench.py, which puts this directory first on the module path
+
+proto_dir = 'bench/proto'
+proto_out = 'bench_out'
+
+# (url + endpoint, request, .proto file), the port being the one of the sink
+# server started by bench.py
+services = [
+  ('http://127.0.0.1/wide', 'WideRequest', f'{proto_dir}/Wide.proto'),
+  ('http://127.0.0.1/deep', 'DeepRequest', f'{proto_dir}/Deep.proto'),
+  ('http://127.0.0.1/repeated', 'RepeatedRequest', f'{proto_dir}/Repeated.proto'),
+  ('http://127.0.0.1/scalars', 'ScalarsRequest', f'{proto_dir}/Scalars.proto'),
+]
+
+replace = {
+    'token'         : 'To7noisie0ae',
+}
+
+delete = ['note']
+
+dictionaries = {}
+
+field_dictionaries = {}
+
+__all__ = ["services", "proto_dir", "proto_out", "replace", "delete",
+           "dictionaries", "field_dictionaries"]
@@ -1,18 +1,35 @@
 import random
+import time
+import asyncio
+import hashlib
 import requests
-import re
+import multiprocessing
 import google.protobuf.text_format as tf
 
-from functools import lru_cache
+from google.protobuf.message import DecodeError
+
+from collections import deque
+from itertools import count
 from pprint import pprint
 
 from lib import helper
 from lib import tree_helper
 from lib import grammar
-
-from lib.inject import Template
+from lib import cache as grammar_cache
+from lib import dictionary
+
+from lib.builder import Builder, BuildError
+from lib.coverage import GrammarCoverage
+from lib.inject import Template, FORMATS
+from lib.mutate import Entry, TreePool, choose_node, top_level_field
+from lib.tree import DerivationTree, Selection, UNEXPANDED
+from lib.transport import Client
+from lib.values import BatchValues
+from lib.weights import ExpansionWeights
+from lib.wire import WireEncoder, field_spans, splice_field
 from lib.inject_const import *
-from config import replace, delete
+import config
+from config import replace, delete, proto_out
 
 INT32_FILE = "fuzzlist/int32.txt"
 INT64_FILE = "fuzzlist/int64.txt"
@@ -20,29 +37,173 @@ INT64_FILE = "fuzzlist/int64.txt"
 # from https://github.com/fuzzdb-project/fuzzdb/blob/master/attack/all-attacks/all-attacks-unix.txt
 STRING_FILE = "fuzzlist/string.txt"
 
-class Runner():
-    
-    def __init__(self):
-        pass
+# inputs failing to serialize in a row after which fuzz_iter() gives up
+MAX_FAILURES = 1000
+
+# compiled grammars, keyed by the descriptors they were created from
+grammar_cache_dir = f"{proto_out}_cache"
+
+def record_input(store, triage, serialized, bucket, meta):
+    """
+    Append a sent input to `store`, `meta` being its vector id and optional
+    reference; the bucket is stored as the fingerprint id of its `triage`
+    bucket, which stays the same from one run to the next
+    """
+    if store is not None and meta:
+        bucket = triage.bucket_id(bucket) if triage else None
+        store.append(meta[0], serialized, meta[1] if len(meta) > 1 else None, bucket)
+
+def record_stats(stats, meta, latency, failed=False):
+    """
+    Count a sent (or failed) input in `stats`, a stats.Stats, if given
+    """
+    if stats is not None:
+        vector_id = meta[0] if meta else None
+        stats.count('failed' if failed else 'sent', vector_id)
+        stats.observe_latency(vector_id, latency)
+
+class GenerationError(Exception):
+    pass
 
-    def run(self, url, serialized):
+class Runner():
+    """
+    Send the inputs one by one, printing the responses, or counting them in
+    `triage` (a triage.Triage) if given. With a `store` (a corpus.CorpusStore),
+    the inputs given with their vector id (and reference) are recorded.
+    on_result(bucket, meta) is called after each triaged input. The inputs
+    and their latencies are counted in `stats` (a stats.Stats) if given.
+    """
+
+    def __init__(self, triage=None, store=None, on_result=None, stats=None):
+        self.triage = triage
+        self.store = store
+        self.on_result = on_result
+        self.stats = stats
+
+    def run(self, url, serialized, *meta):
 
         if len(serialized):
-            r = requests.post(url=url, data=serialized)
-            print(f"Status code: {r.status_code}")
-            print(f"Headers: {r.headers}")
-            print(f"Response: {r.text}")
+            if self.triage:
+                start = time.monotonic()
+                try:
+                    r = requests.post(url=url, data=serialized)
+                except requests.RequestException as e:
+                    latency = time.monotonic() - start
+                    record_stats(self.stats, meta, latency, failed=True)
+                    bucket = self.triage.add_error(url, serialized, e, latency)
+                else:
+                    record_stats(self.stats, meta, r.elapsed.total_seconds())
+                    bucket = self.triage.add_response(url, serialized, r)
+                record_input(self.store, self.triage, serialized, bucket, meta)
+                if self.on_result:
+                    self.on_result(bucket, meta)
+                return
+
+            start = time.monotonic()
+            try:
+                r = requests.post(url=url, data=serialized)
+            except requests.RequestException as e:
+                record_stats(self.stats, meta, time.monotonic() - start, failed=True)
+                print(f"Request to {url} failed: {e!r}")
+            else:
+                record_stats(self.stats, meta, r.elapsed.total_seconds())
+                print(f"Status code: {r.status_code}")
+                print(f"Headers: {r.headers}")
+                print(f"Response: {r.text}")
+            record_input(self.store, None, serialized, None, meta)
+
+class AsyncRunner():
+    """
+    Send a stream of inputs with at most `concurrency` requests in flight,
+    over keep-alive connections pooled per service. The responses are
+    printed if `log`, or counted in `triage` (a triage.Triage) if given.
+    Inputs given with their vector id (and reference) are recorded in
+    `store` (a corpus.CorpusStore) if given. on_result(bucket, meta) is
+    called after each input. The inputs and their latencies are counted in
+    `stats` (a stats.Stats) if given.
+    """
+
+    def __init__(self, concurrency=32, timeout=10, log=True, triage=None, store=None,
+                 on_result=None, stats=None):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.log = log
+        self.triage = triage
+        self.store = store
+        self.on_result = on_result
+        self.stats = stats
+
+    def run_iter(self, inputs):
+        """
+        Send every (url, serialized[, vector id[, reference]]) tuple from
+        `inputs`, return the statistics
+        """
+        return asyncio.run(self.run_async(inputs))
+
+    async def run_async(self, inputs):
+        client = Client(pool_size=self.concurrency, timeout=self.timeout)
+        inputs = iter(inputs)
+        stats = {'sent': 0, 'failed': 0}
+
+        async def worker():
+            # the workers share the input iterator
+            for url, serialized, *meta in inputs:
+                if not len(serialized):
+                    continue
+                start = time.monotonic()
+                try:
+                    response = await client.post(url, serialized)
+                except Exception as e:
+                    stats['failed'] += 1
+                    latency = time.monotonic() - start
+                    record_stats(self.stats, meta, latency, failed=True)
+                    bucket = self.handle_error(url, serialized, e, latency, *meta)
+                else:
+                    stats['sent'] += 1
+                    record_stats(self.stats, meta, response.latency)
+                    bucket = self.handle(url, serialized, response, *meta)
+                record_input(self.store, self.triage, serialized, bucket, meta)
+                if self.on_result:
+                    self.on_result(bucket, meta)
+
+        start = time.monotonic()
+        try:
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        finally:
+            client.close()
+
+        stats['elapsed'] = time.monotonic() - start
+        stats['rps'] = stats['sent'] / stats['elapsed'] if stats['elapsed'] else 0.0
+        return stats
+
+    def handle(self, url, serialized, response, *meta):
+        """
+        Process a response, return its triage bucket if any. `meta` are the
+        items of the input following the serialized message.
+        """
+        if self.triage:
+            return self.triage.add_response(url, serialized, response)
+        elif self.log:
+            print(f"Status code: {response.status_code}")
+            print(f"Headers: {response.headers}")
+            print(f"Response: {response.text}")
+
+    def handle_error(self, url, serialized, error, latency=0.0, *meta):
+        if self.triage:
+            return self.triage.add_error(url, serialized, error, latency)
+        elif self.log:
+            print(f"Request to {url} failed: {error!r}")
 
 class Fuzzer():
 
     def __init__(self):
         pass
 
-    @lru_cache(maxsize=32)
     def read_txtfile(self, fname):
-        with open(fname, "r") as f:
-            data = f.read().splitlines()
-        return data
+        """
+        Return the lines of `fname`, memory-mapped and shared by every fuzzer
+        """
+        return dictionary.open_wordlist(fname)
 
     def rand_string(self):
         n = random.randint(0, 20)
@@ -52,70 +213,139 @@ class Fuzzer():
         return ''.join( [random.choice(alphabet) for x in range(n)] )
         # return ''.join( [chr(random.randint(0, 0xff)) for x in range(n)] )
 
+    def value_int32(self):
+        return int(random.choice(self.read_txtfile(INT32_FILE)))
+
+    def value_int64(self):
+        return int(random.choice(self.read_txtfile(INT64_FILE)))
+
+    def value_bool(self):
+        return random.randint(0, 1)
+
+    def value_string(self):
+        # return random.choice(self.read_txtfile(STRING_FILE))
+        return self.rand_string()
+
+    def value_bytes(self):
+        # return random.choice(self.read_txtfile(STRING_FILE)).encode()
+        return self.rand_string().encode()
+
+    def value_sources(self):
+        """
+        Return the function creating the values of each payload type (the
+        'value_' methods, or the batch values if enabled), mixing in the
+        wordlists of the config 'dictionaries'
+        """
+        if getattr(self, '_value_sources', None) is None:
+            if getattr(self, 'batch_values', None):
+                sources = self.batch_values.sources()
+            else:
+                sources = {
+                    INJECT_INT32: self.value_int32,
+                    INJECT_INT64: self.value_int64,
+                    INJECT_BOOL: self.value_bool,
+                    INJECT_STRING: self.value_string,
+                    INJECT_BYTES: self.value_bytes,
+                }
+            for name, entries in getattr(config, 'dictionaries', {}).items():
+                inj_type = dictionary.TYPE_NAMES[name]
+                sources[inj_type] = dictionary.type_source(entries, inj_type, sources[inj_type])
+            self._value_sources = sources
+        return self._value_sources
+
+    def field_sources(self):
+        """
+        Return the value sources of the fields listed in the config 'field_dictionaries'
+        """
+        if getattr(self, '_field_sources', None) is None:
+            self._field_sources = {
+                key: dictionary.field_source(entries, self.value_sources())
+                for key, entries in getattr(config, 'field_dictionaries', {}).items()
+            }
+        return self._field_sources
+
+    def inject(self, txt, inj_type):
+        """
+        Replace every `inj_type` placeholder in `txt`, in one pass
+        """
+        chunks = txt.split(inj_type)
+        func = self.value_sources()[inj_type]
+        fmt = FORMATS[inj_type]
+        for i in range(1, len(chunks)):
+            chunks[i] = fmt(func()) + chunks[i]
+        return ''.join(chunks)
+
     def inject_int32(self, txt):
-        FUZZ = self.read_txtfile(INT32_FILE)
-        while INJECT_INT32 in txt:
-            txt = txt.replace(INJECT_INT32, str(random.choice(FUZZ)), 1)
-        return txt
-        
+        return self.inject(txt, INJECT_INT32)
+
     def inject_int64(self, txt):
-        FUZZ = self.read_txtfile(INT64_FILE)
-        while INJECT_INT64 in txt:
-            txt = txt.replace(INJECT_INT64, str(random.choice(FUZZ)), 1)
-        return txt
+        return self.inject(txt, INJECT_INT64)
 
     def inject_bool(self, txt):
-        while INJECT_BOOL in txt:
-            txt = txt.replace(INJECT_BOOL, str(random.randint(0, 1)), 1)
-        return txt
+        return self.inject(txt, INJECT_BOOL)
 
     def inject_string(self, txt):
-        FUZZ = self.read_txtfile(STRING_FILE)
-        while INJECT_STRING in txt:
-            # txt = txt.replace(INJECT_STRING, f'"{str(random.choice(FUZZ))}"', 1)
-            txt = txt.replace(INJECT_STRING, f'"{self.rand_string()}"', 1)
-        return txt
-            
+        return self.inject(txt, INJECT_STRING)
+
     def inject_bytes(self, txt):
-        FUZZ = self.read_txtfile(STRING_FILE)
-        while INJECT_BYTES in txt:
-            # txt = txt.replace(INJECT_BYTES, f'"{str(random.choice(FUZZ))}"', 1)
-            txt = txt.replace(INJECT_BYTES, f'"{self.rand_string()}"', 1)
-        return txt
+        return self.inject(txt, INJECT_BYTES)
 
 
 class ProtoFuzzer(Fuzzer):
 
-    def __init__(self, min_nonterminals=0, max_nonterminals=10, disp=False, log=False):
+    def __init__(self, min_nonterminals=0, max_nonterminals=10, disp=False, log=False,
+                 encoder="message", mutator=None, cache=True, requests=None, batch=None,
+                 compact=True, stats=None):
 
         self.disp = disp
         self.log = log
 
+        # phase timers and input counters (a stats.Stats), None when off
+        self.stats = stats
+
+        # values generated in blocks, `batch` being the options of the
+        # values.BatchValues (eg. {'alphabet': 'bytes'}), instead of the 'value_' methods
+        self.batch_values = None
+        if batch is not None:
+            self.batch_values = BatchValues(self.read_txtfile(INT32_FILE),
+                                            self.read_txtfile(INT64_FILE), **batch)
+
+        # "message" builds the messages from the tree directly, "text" goes
+        # through the text format and "wire" encodes the tree to wire format,
+        # with malformed encodings chosen by the (optional) wire.Mutator
+        self.encoder = encoder
+        self.wire_encoder = WireEncoder(mutator=mutator)
+
         self.min_nonterminals = min_nonterminals
         self.max_nonterminals = max_nonterminals
 
-        proto_files = helper.get_proto_files()
+        # grow the trees in a tree.DerivationTree rather than in nested tuples
+        self.compact = compact
+
+        self.frontier_root = None
+        self.frontier_open = dict()
+        self.frontier_skip = dict()
+        self.frontier_size = 0
+
+        proto_files = helper.get_proto_files(requests)
         libs = helper.get_proto_libs(proto_files)
 
         if self.log:
             print("Creating grammars, please wait..")
-        self.vectors = helper.create_vectors(libs)
+        self.vectors = helper.create_vectors(libs, requests)
         for v in self.vectors:
-            v['grammar'] = grammar.gpb_to_ebnf(v['msg'])
             v['start_symbol'] = f'<{v["request"]}>'
+            if cache:
+                v['grammar'] = grammar_cache.load_grammar(grammar_cache_dir, v['msg'], v['start_symbol'])
+                if v['grammar'] is not None:
+                    continue
+
+            v['grammar'] = grammar.compile_grammar(
+                grammar.gpb_to_ebnf(v['msg']), v['start_symbol'])
             # Check if the created grammar is valid and if not, exit
             grammar.check_grammar(v['grammar'], v['start_symbol'])
-
-    def expansion_to_children(self, expansion):
-        expansion = grammar.exp_string(expansion)
-        assert isinstance(expansion, str)
-
-        if expansion == "":  # Special case: epsilon expansion
-            return [("", [])]
-
-        strings = re.split(grammar.RE_NONTERMINAL, expansion)
-        return [(s, None) if grammar.is_nonterminal(s) else (s, [])
-                for s in strings if len(s) > 0]
+            if cache:
+                grammar_cache.save_grammar(grammar_cache_dir, v['msg'], v['grammar'])
 
     def choose_node_expansion(self, node, possible_children):
         """
@@ -133,11 +363,13 @@ class ProtoFuzzer(Fuzzer):
         """
         Returns True if the tree has any unexpanded nodes
         """
-        (symbol, children) = node
-        if children is None:
-            return True
-
-        return any(self.any_possible_expansions(c) for c in children)
+        stack = [node]
+        while stack:
+            (symbol, children) = stack.pop()
+            if children is None:
+                return True
+            stack.extend(children)
+        return False
 
     def choose_tree_expansion(self, tree, children):
         """
@@ -145,31 +377,210 @@ class ProtoFuzzer(Fuzzer):
         """
         return random.randrange(0, len(children))
 
+    def init_frontier(self, tree):
+        """
+        Index the unexpanded nodes of `tree`. For every expanded node we keep the
+        (ordered) indices of its children that still contain unexpanded symbols,
+        so the expansion loop never has to rescan the whole tree.
+
+        A node with a single open child leaves no choice: frontier_skip maps
+        such a node to the last one of the chain it starts, so the walk jumps
+        over the chains of repeated fields instead of going down every level.
+        """
+        self.frontier_root = tree
+        self.frontier_open = dict()
+        self.frontier_skip = dict()
+        if isinstance(tree, DerivationTree):
+            self.frontier_size = self.index_compact_frontier(tree, 0)
+        else:
+            self.frontier_size = self.index_frontier(tree)
+
+    def index_frontier(self, node):
+        """
+        Register `node` and its subtree in the frontier, return the number of unexpanded symbols
+        """
+        if node[1] is None:
+            return 1
+
+        # the expanded nodes, parents first, then counted children first
+        expanded = []
+        stack = [node]
+        while stack:
+            (symbol, children) = stack.pop()
+            if children:
+                expanded.append(children)
+                stack.extend(children)
+
+        counts = dict()
+        for children in reversed(expanded):
+            count = 0
+            open_children = []
+            for (i, (_, c)) in enumerate(children):
+                n = 1 if c is None else counts.get(id(c), 0)
+                if n:
+                    open_children.append(i)
+                    count += n
+
+            counts[id(children)] = count
+            if open_children:
+                self.frontier_open[id(children)] = open_children
+        return counts.get(id(node[1]), 0)
+
+    def index_compact_frontier(self, tree, n):
+        """
+        index_frontier() for node `n` of a DerivationTree, keyed by node index
+        """
+        counts, firsts = tree.counts, tree.first
+        if counts[n] == UNEXPANDED:
+            return 1
+
+        expanded = []
+        stack = [n]
+        while stack:
+            m = stack.pop()
+            if counts[m] > 0:
+                expanded.append(m)
+                stack.extend(range(firsts[m], firsts[m] + counts[m]))
+
+        totals = dict()
+        for m in reversed(expanded):
+            total = 0
+            open_children = []
+            first = firsts[m]
+            for i in range(counts[m]):
+                c = first + i
+                k = 1 if counts[c] == UNEXPANDED else totals.get(c, 0)
+                if k:
+                    open_children.append(i)
+                    total += k
+
+            totals[m] = total
+            if open_children:
+                self.frontier_open[m] = open_children
+        return totals.get(n, 0)
+
+    def expand_compact_once(self, tree):
+        """
+        expand_tree_once() for a DerivationTree: the expand_node methods get
+        the node as a tuple, and the children they return go to the node arrays
+        """
+        counts, firsts = tree.counts, tree.first
+        frontier_open, frontier_skip = self.frontier_open, self.frontier_skip
+        # the default choice only needs the number of children, no node tuples
+        choose = type(self).choose_tree_expansion is not ProtoFuzzer.choose_tree_expansion
+
+        path = []
+        chain = []
+        n = 0
+        while counts[n] != UNEXPANDED:
+            open_children = frontier_open[n]
+
+            if len(open_children) == 1:
+                chain.append((n, n))
+                path.append((n, open_children, 0))
+                end = frontier_skip.get(n)
+                if end is not None:
+                    n = end
+                    continue
+                child_to_be_expanded = 0
+            else:
+                self.skip_chain(chain)
+                if choose:
+                    child_to_be_expanded = self.choose_tree_expansion(
+                        tree.node(n), Selection(tree, firsts[n], open_children))
+                else:
+                    child_to_be_expanded = random.randrange(0, len(open_children))
+                path.append((n, open_children, child_to_be_expanded))
+
+            n = firsts[n] + open_children[child_to_be_expanded]
+        self.skip_chain(chain)
+
+        (_, children) = self.expand_node(tree.node(n))
+        tree.expand(n, children)
+
+        count = self.index_compact_frontier(tree, n)
+        self.frontier_size += count - 1
+
+        if count == 0:
+            for parent, open_children, index in reversed(path):
+                del open_children[index]
+                if open_children:
+                    break
+                del self.frontier_open[parent]
+
+        return tree
+
+    def skip_chain(self, chain):
+        """
+        Point the nodes of a chain of single open children, gone through by
+        the last walk as (frontier key, node) pairs, to its last node; then
+        empty `chain`. Until the chain
+        is complete its nodes keep their single open child, and once complete
+        it is never walked again, so the pointers never go stale.
+        """
+        if len(chain) > 1:
+            (_, end) = chain[-1]
+            for (key, _) in chain[:-1]:
+                self.frontier_skip[key] = end
+        chain.clear()
+
     def expand_tree_once(self, tree):
         """
         Choose an unexpanded symbol in tree; expand it.  Can be overloaded in subclasses.
         """
+        if isinstance(tree, DerivationTree):
+            return self.expand_compact_once(tree)
+
         (symbol, children) = tree
         if children is None:
             # Expand this node
-            return self.expand_node(tree)
+            tree = self.expand_node(tree)
+            self.frontier_size += self.index_frontier(tree) - 1
+            return tree
+
+        # Walk down from the root, at each level selecting one of the children
+        # with possible expansions; the levels with a single one need no choice
+        path = []
+        chain = []
+        node = tree
+        while node[1] is not None:
+            children = node[1]
+            open_children = self.frontier_open[id(children)]
+
+            if len(open_children) == 1:
+                # no choice, jump to the end of the chain if known
+                chain.append((id(children), node))
+                path.append((children, open_children, 0))
+                end = self.frontier_skip.get(id(children))
+                if end is not None:
+                    node = end
+                    continue
+                child_to_be_expanded = 0
+            else:
+                self.skip_chain(chain)
+                expandable_children = [children[i] for i in open_children]
+                child_to_be_expanded = \
+                    self.choose_tree_expansion(node, expandable_children)
+                path.append((children, open_children, child_to_be_expanded))
+
+            node = children[open_children[child_to_be_expanded]]
+        self.skip_chain(chain)
 
-        # Find all children with possible expansions
-        expandable_children = [
-            c for c in children if self.any_possible_expansions(c)]
-
-        # `index_map` translates an index in `expandable_children`
-        # back into the original index in `children`
-        index_map = [i for (i, c) in enumerate(children)
-                     if c in expandable_children]
+        # Expand in place
+        node = self.expand_node(node)
+        children, open_children, index = path[-1]
+        children[open_children[index]] = node
 
-        # Select a random child
-        child_to_be_expanded = \
-            self.choose_tree_expansion(tree, expandable_children)
+        count = self.index_frontier(node)
+        self.frontier_size += count - 1
 
-        # Expand in place
-        children[index_map[child_to_be_expanded]] = \
-            self.expand_tree_once(expandable_children[child_to_be_expanded])
+        if count == 0:
+            # The subtree is complete, close it on the way up
+            for children, open_children, index in reversed(path):
+                del open_children[index]
+                if open_children:
+                    break
+                del self.frontier_open[id(children)]
 
         return tree
 
@@ -181,9 +592,11 @@ class ProtoFuzzer(Fuzzer):
             print("Expanding", tree_helper.all_terminals(node), "randomly")
 
         # Fetch the possible expansions from grammar...
-        expansions = self.v['grammar'][symbol]
-        possible_children = [self.expansion_to_children(
-            expansion) for expansion in expansions]
+        g = self.v['grammar']
+        symbol_id = g.ids[symbol]
+        expansions = g.expansions[symbol_id]
+        possible_children = [g.expansion_to_children(symbol_id, i)
+                             for i in range(len(expansions))]
 
         # ... and select a random expansion
         index = self.choose_node_expansion(node, possible_children)
@@ -196,29 +609,6 @@ class ProtoFuzzer(Fuzzer):
         # Return with new children
         return (symbol, chosen_children)
 
-    def symbol_cost(self, symbol, seen=set()):
-        """
-        Returns the minimum cost of all expansions of a symbol
-        """
-        expansions = self.v['grammar'][symbol]
-        return min(self.expansion_cost(e, seen | {symbol}) for e in expansions)
-
-    def expansion_cost(self, expansion, seen=set()):
-        """
-        Returns the sum of all expansions in expansions
-        """
-        symbols = grammar.nonterminals(expansion)
-        if len(symbols) == 0:
-            return 1  # no symbol
-
-        # indicating (potentially infinite) recursion
-        if any(s in seen for s in symbols):
-            return float('inf')
-
-        # the value of a expansion is the sum of all expandable variables
-        # inside + 1
-        return sum(self.symbol_cost(s, seen) for s in symbols) + 1
-
     def expand_node_by_cost(self, node, choose=min):
         """
         Determines the minimum cost cost across all children and then 
@@ -229,22 +619,17 @@ class ProtoFuzzer(Fuzzer):
         (symbol, children) = node
         assert children is None
 
-        # Fetch the possible expansions from grammar...
-        expansions = self.v['grammar'][symbol]
-
-        possible_children_with_cost = [(self.expansion_to_children(expansion),
-                                        self.expansion_cost(
-                                            expansion, {symbol}),
-                                        expansion)
-                                       for expansion in expansions]
+        # Fetch the possible expansions and their precomputed costs from grammar...
+        g = self.v['grammar']
+        symbol_id = g.ids[symbol]
+        expansions = g.expansions[symbol_id]
+        costs = g.costs[symbol_id]
 
-        costs = [cost for (child, cost, expansion)
-                 in possible_children_with_cost]
         chosen_cost = choose(costs)
-        children_with_chosen_cost = [child for (child, child_cost, _) in possible_children_with_cost
-                                     if child_cost == chosen_cost]
-        expansion_with_chosen_cost = [expansion for (_, child_cost, expansion) in possible_children_with_cost
-                                      if child_cost == chosen_cost]
+        chosen = [i for (i, cost) in enumerate(costs) if cost == chosen_cost]
+        expansion_with_chosen_cost = [expansions[i] for i in chosen]
+        children_with_chosen_cost = [g.expansion_to_children(symbol_id, i)
+                                     for i in chosen]
 
         index = self.choose_node_expansion(node, children_with_chosen_cost)
 
@@ -278,10 +663,14 @@ class ProtoFuzzer(Fuzzer):
         until the number of possible expansions reaches `limit`.
         """
         self.expand_node = expand_node_method
+        if tree is not self.frontier_root:
+            self.init_frontier(tree)
+
         while ((limit is None
-                or self.possible_expansions(tree) < limit)
-               and self.any_possible_expansions(tree)):
+                or self.frontier_size < limit)
+               and self.frontier_size > 0):
             tree = self.expand_tree_once(tree)
+            self.frontier_root = tree
             self.log_tree(tree)
         return tree
 
@@ -289,10 +678,18 @@ class ProtoFuzzer(Fuzzer):
         """
         Counts how many unexpanded symbols there are in a tree
         """
-        (symbol, children) = node
-        if children is None:
-            return 1
-        return sum(self.possible_expansions(c) for c in children)
+        if isinstance(node, DerivationTree):
+            return node.unexpanded()
+
+        count = 0
+        stack = [node]
+        while stack:
+            (symbol, children) = stack.pop()
+            if children is None:
+                count += 1
+            else:
+                stack.extend(children)
+        return count
 
     def log_tree(self, tree):
         """
@@ -302,12 +699,15 @@ class ProtoFuzzer(Fuzzer):
             print("Tree:")
             pprint(tree)
             print("-" * 80)
-            print(self.possible_expansions(tree), "possible expansion(s) left")
+            print(self.frontier_size, "possible expansion(s) left")
 
     def expand_tree(self, tree):
         """
         Expand `tree` in a three-phase strategy until all expansions are complete.
         """
+        if self.stats:
+            start = time.monotonic()
+        self.init_frontier(tree)
         self.log_tree(tree)
         tree = self.expand_tree_with_strategy(
             tree, self.expand_node_max_cost, self.min_nonterminals)
@@ -318,9 +718,13 @@ class ProtoFuzzer(Fuzzer):
 
         assert self.possible_expansions(tree) == 0
 
+        if self.stats:
+            self.stats.phase('expand_tree', start)
         return tree
 
     def init_tree(self):
+        if self.compact:
+            return DerivationTree(self.v['grammar'], self.v['start_symbol'])
         return (self.v['start_symbol'], None)
 
     def fuzz_tree(self):
@@ -346,36 +750,413 @@ class ProtoFuzzer(Fuzzer):
         print(f"{self.v['request']} => {self.v['url']} :: {self.v['msg']}")
 
         derivation_tree = self.fuzz_tree()
-        tmp = tree_helper.tree_to_gpb(derivation_tree)
 
-        template = Template(tmp)
         print("----------------- TEMPLATE ------------------")
-        print(template)
+        print(tree_helper.tree_to_gpb(derivation_tree))
+        print("---------------------------------------------")
+
+        try:
+            serialized, msg = self.serialize(derivation_tree)
+        except (tf.ParseError, BuildError, ValueError):
+            print("Unable to deserialize the message")
+            if self.stats:
+                self.stats.count('discarded', self.v['id'])
+            return '', ''
+        if self.stats:
+            self.stats.count('generated', self.v['id'])
+
+        print("----------------- SENDING -------------------")
+        print(tf.MessageToString(msg) if msg is not None else repr(serialized))
         print("---------------------------------------------")
 
+        return self.v['url'], serialized
+
+    def fuzz_iter(self, n=None):
+        """
+        Yield `n` (vector, serialized) tuples, or an endless stream if `n` is None.
+        Nothing is printed; inputs which fail to serialize are skipped, but
+        after MAX_FAILURES of them in a row a GenerationError is raised.
+        """
+        count = 0
+        failures = 0
+        while n is None or count < n:
+            self.v = random.choice(self.vectors)
+            derivation_tree = self.fuzz_tree()
+            try:
+                serialized, _ = self.serialize(derivation_tree)
+            except (tf.ParseError, BuildError, ValueError) as e:
+                if self.stats:
+                    self.stats.count('discarded', self.v['id'])
+                failures += 1
+                if failures >= MAX_FAILURES:
+                    raise GenerationError(f"{failures} inputs in a row failed to serialize, "
+                                          f"the last one of {self.v['request']}: {e!r}") from e
+                continue
+            if self.stats:
+                self.stats.count('generated', self.v['id'])
+            failures = 0
+            count += 1
+            yield self.v, serialized
+
+    def serialize(self, derivation_tree):
+        """
+        Return the serialized input and the message it was created from
+        (None for the wire encoder)
+        """
+        if self.encoder == "wire":
+            return self.encode_wire(derivation_tree), None
+
+        if self.encoder == "text":
+            msg = self.build_message_text(derivation_tree)
+        else:
+            msg = self.build_message(derivation_tree)
+        if self.stats:
+            start = time.monotonic()
+        # partial: deleted fields may be required ones
+        serialized = msg.SerializePartialToString()
+        if self.stats:
+            self.stats.phase('serialize', start)
+        return serialized, msg
+
+    def build_message(self, derivation_tree):
+        """
+        Create the message from the derivation tree directly
+        """
+        if self.stats:
+            start = time.monotonic()
+        builder = Builder(derivation_tree, self.v['msg'], delete, replace, self.field_sources())
+
+        for inj_type, func in self.value_sources().items():
+            builder.fill(inj_type, func)
+
+        if self.stats:
+            self.stats.phase('build_message', start)
+        return builder.message
+
+    def encode_wire(self, derivation_tree):
+        """
+        Encode the derivation tree to wire format, without creating the message
+        """
+        if self.stats:
+            start = time.monotonic()
+        serialized = self.wire_encoder.encode(derivation_tree, self.v['msg'].DESCRIPTOR,
+                                              self.value_sources(), replace, delete,
+                                              self.field_sources())
+        if self.stats:
+            self.stats.phase('encode_wire', start)
+        return serialized
+
+    def build_message_text(self, derivation_tree):
+        """
+        Create the message by rendering the tree to text format and parsing it back
+        """
+        stats = self.stats
+        if stats:
+            start = time.monotonic()
+        template = Template(*tree_helper.tree_to_chunks(derivation_tree))
+        if stats:
+            start = stats.phase('template', start)
+
         [template.delete(key) for key in delete]
+        if stats:
+            start = stats.phase('template_delete', start)
         [template.set(key, value) for key, value in replace.items()]
+        if stats:
+            start = stats.phase('template_set', start)
 
-        template.fill(self.inject_int32)
-        template.fill(self.inject_int64)
-        template.fill(self.inject_bool)
-        template.fill(self.inject_string)
-        template.fill(self.inject_bytes)
+        template.inject(self.value_sources(), self.field_sources())
+        text = template.text
+        if stats:
+            start = stats.phase('template_fill', start)
 
-        print("----------------- SENDING -------------------")
-        print(template)
-        print("---------------------------------------------")
-        
-        try:
-            msg = tf.Parse(template.text, self.v['msg']())
-            serialized = msg.SerializeToString()
-            return self.v['url'], serialized
-        except tf.ParseError:
-            print("Unable to deserialize the message")
-            return '', ''
+        msg = tf.Parse(text, self.v['msg']())
+        if stats:
+            stats.phase('text_parse', start)
+        return msg
 
     def run(self, runner=Runner()):
         """
         Run `runner` with fuzz input
         """
-        return runner.run(*self.fuzz())
+        url, serialized = self.fuzz()
+        return runner.run(url, serialized, self.v['id'])
+
+class AdaptiveFuzzer(ProtoFuzzer):
+    """
+    ProtoFuzzer choosing the random expansions in proportion to weights
+    learned from the responses (see weights.ExpansionWeights). `trace` holds
+    the vector and the expansions chosen for the last input; pass it back to
+    feedback() with the novelty of the response to that input.
+    """
+
+    def __init__(self, weights=None, **kwargs):
+        super().__init__(**kwargs)
+        self.weights = ExpansionWeights() if weights is None else weights
+        self.trace = None
+
+    def fuzz_tree(self):
+        self.trace = (self.v, [])
+        return super().fuzz_tree()
+
+    def choose_node_expansion(self, node, possible_children):
+        # the cost-based phases choose among a subset of the expansions
+        if self.expand_node != self.expand_node_randomly:
+            return super().choose_node_expansion(node, possible_children)
+
+        symbol_id = self.v['grammar'].ids[node[0]]
+        index = self.weights.choose(self.v, symbol_id)
+        self.trace[1].append((symbol_id, index))
+        return index
+
+    def feedback(self, trace, novel):
+        vector, expansions = trace
+        self.weights.update(vector, expansions, novel)
+
+class CoverageFuzzer(ProtoFuzzer):
+    """
+    ProtoFuzzer preferring, in the random phase, the expansions which no input
+    of the vector has covered yet, then those leading to most uncovered ones,
+    so the whole schema is reached with few inputs. The coverage of every
+    vector (expansions and k-paths, see coverage.GrammarCoverage) is given
+    by coverage_report().
+    """
+
+    def __init__(self, k=2, **kwargs):
+        super().__init__(**kwargs)
+        self.coverage = {v['request']: GrammarCoverage(v['grammar'], k) for v in self.vectors}
+
+    def fuzz_tree(self):
+        tree = super().fuzz_tree()
+        self.coverage[self.v['request']].add_tree(tree)
+        return tree
+
+    def choose_node_expansion(self, node, possible_children):
+        # the cost-based phases choose among a subset of the expansions
+        if self.expand_node != self.expand_node_randomly:
+            return super().choose_node_expansion(node, possible_children)
+
+        coverage = self.coverage[self.v['request']]
+        symbol_id = self.v['grammar'].ids[node[0]]
+        scores = [coverage.score(symbol_id, i) for i in range(len(possible_children))]
+        best = max(scores)
+        index = random.choice([i for (i, score) in enumerate(scores) if score == best])
+
+        # covered right away, so the next choices of the same tree go elsewhere
+        coverage.add(symbol_id, index)
+        return index
+
+    def coverage_report(self):
+        """
+        Return the coverage of each vector, by request name
+        """
+        return {request: coverage.report() for (request, coverage) in self.coverage.items()}
+
+class MutationFuzzer(ProtoFuzzer):
+    """
+    ProtoFuzzer deriving most inputs from the trees of earlier inputs which
+    got new kinds of responses, rather than from scratch. A mutation picks a
+    subtree of a pool tree by nonterminal, and either expands it again, or
+    (with probability `crossover`) replaces it by a subtree of the same symbol
+    from another tree of the pool. Pass `trace` to feedback() with the novelty
+    of the response, as for the AdaptiveFuzzer.
+
+    With the wire encoder (and no wire mutator), only the top level field
+    holding the mutated subtree is encoded again, and spliced into the input
+    of the original tree; the rest keeps its values.
+    """
+
+    def __init__(self, mutation_rate=0.9, crossover=0.5, pool_size=1000, **kwargs):
+        # the pool trees are copied and grafted, which takes tree.DerivationTrees
+        kwargs['compact'] = True
+        super().__init__(**kwargs)
+        self.mutation_rate = mutation_rate
+        self.crossover = crossover
+        self.pools = {v['request']: TreePool(pool_size) for v in self.vectors}
+        # (pool entry of the mutated tree, top level field number) of the last tree
+        self.mutation = None
+        self.trace = None
+
+    def fuzz_tree(self):
+        pool = self.pools[self.v['request']]
+        self.mutation = None
+        tree = None
+        if len(pool) and random.random() < self.mutation_rate:
+            tree = self.mutate(pool)
+        if tree is None:
+            tree = super().fuzz_tree()
+
+        self.trace = (self.v, Entry(tree))
+        return tree
+
+    def mutate(self, pool):
+        """
+        Return a mutated copy of a tree of `pool`, or None if it has nothing to mutate
+        """
+        entry = pool.choose()
+        n = choose_node(entry)
+        if n is None:
+            return None
+
+        tree = entry.tree.copy()
+        code = tree.codes[n]
+        donor = pool.donor(code, entry) if random.random() < self.crossover else None
+        if donor is not None:
+            tree.graft(n, donor[0].tree, donor[1])
+        else:
+            subtree = self.expand_tree(DerivationTree(self.v['grammar'], tree.symbol(n)))
+            tree.graft(n, subtree, 0)
+
+        field = top_level_field(tree, n)
+        if field is not None and entry.spans is not None:
+            self.mutation = (entry, self.v['msg'].DESCRIPTOR.fields_by_name[field].number)
+        return tree
+
+    def serialize(self, derivation_tree):
+        entry = self.trace[1]
+        spliceable = self.encoder == "wire" and self.wire_encoder.mutator is None
+
+        if spliceable and self.mutation is not None:
+            if self.stats:
+                start = time.monotonic()
+            parent, number = self.mutation
+            encoded = self.wire_encoder.encode(derivation_tree, self.v['msg'].DESCRIPTOR,
+                                               self.value_sources(), replace, delete,
+                                               self.field_sources(), only={number})
+            serialized, msg = splice_field(parent.serialized, parent.spans, number, encoded), None
+            if self.stats:
+                self.stats.phase('encode_wire', start)
+        else:
+            serialized, msg = super().serialize(derivation_tree)
+
+        entry.serialized = serialized
+        if spliceable:
+            entry.spans = field_spans(serialized)
+        return serialized, msg
+
+    def feedback(self, trace, novel):
+        vector, entry = trace
+        if novel:
+            self.pools[vector['request']].add(entry)
+
+    def load_pool(self, store, examples=3):
+        """
+        Add the first `examples` inputs of each result bucket (fingerprint id)
+        of the corpus store `store` to the pools of their vectors, return their
+        count. The inputs the grammar cannot derive again are skipped.
+        """
+        vectors = {v['id']: v for v in self.vectors}
+        spliceable = self.encoder == "wire" and self.wire_encoder.mutator is None
+        count = 0
+        for bucket in store.buckets():
+            taken = dict()
+            for number in store.by_bucket(bucket):
+                record = store[number]
+                v = vectors.get(record.vector_id)
+                if v is None or taken.get(v['id'], 0) >= examples:
+                    continue
+
+                serialized = bytes(record.serialized)
+                msg = v['msg']()
+                try:
+                    msg.ParseFromString(serialized)
+                    tree = tree_helper.message_to_tree(v['grammar'], msg, v['start_symbol'])
+                except (DecodeError, ValueError):
+                    continue
+                tree = DerivationTree.from_tuples(v['grammar'], tree)
+                self.pools[v['request']].add(
+                    Entry(tree, serialized, field_spans(serialized) if spliceable else None))
+                taken[v['id']] = taken.get(v['id'], 0) + 1
+                count += 1
+        return count
+
+
+# ProtoFuzzer of a worker process of the ParallelFuzzer
+_worker_fuzzer = None
+
+def _init_worker(kwargs):
+    """
+    Create the worker's ProtoFuzzer, unless it was inherited already built from the parent (fork)
+    """
+    global _worker_fuzzer
+    if _worker_fuzzer is None:
+        _worker_fuzzer = ProtoFuzzer(**kwargs)
+
+def _generate_batch(seed, size):
+    """
+    Generate a batch from its own seed; the state of the random module is
+    restored after it, as the batches of a single process run in the caller
+    """
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        if _worker_fuzzer.batch_values:
+            _worker_fuzzer.batch_values.clear()
+        return [(v['id'], serialized) for v, serialized in _worker_fuzzer.fuzz_iter(size)]
+    finally:
+        random.setstate(state)
+
+def derive_seed(seed, batch):
+    """
+    Return the seed of a batch, derived from the master seed
+    """
+    digest = hashlib.sha256(f"{seed}:{batch}".encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+class ParallelFuzzer():
+    """
+    Generate inputs in a pool of worker processes. The inputs are created in
+    batches; every batch is seeded from the master `seed` and its index, so the
+    stream is reproducible whatever the number of processes.
+    """
+
+    def __init__(self, processes=None, seed=None, batch_size=256, **kwargs):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.seed = random.randrange(1 << 63) if seed is None else seed
+        self.batch_size = batch_size
+        self.kwargs = kwargs
+
+        # built once here, forked workers inherit it
+        self.fuzzer = ProtoFuzzer(**kwargs)
+        self.vectors = {v['id']: v for v in self.fuzzer.vectors}
+
+    def batches(self, n):
+        """
+        Yield the (seed, size) of the batches making `n` inputs
+        """
+        batches = count() if n is None else range(-(-n // self.batch_size))
+        for batch in batches:
+            size = self.batch_size
+            if n is not None:
+                size = min(size, n - batch * self.batch_size)
+            yield derive_seed(self.seed, batch), size
+
+    def fuzz_iter(self, n=None):
+        """
+        Yield `n` (vector, serialized) tuples, or an endless stream if `n` is None
+        """
+        global _worker_fuzzer
+
+        _worker_fuzzer = self.fuzzer
+        try:
+            if self.processes == 1:
+                for seed, size in self.batches(n):
+                    yield from self.batch_results(_generate_batch(seed, size))
+                return
+
+            with multiprocessing.Pool(self.processes, _init_worker, (self.kwargs,)) as pool:
+                pending = deque()
+                for seed, size in self.batches(n):
+                    pending.append(pool.apply_async(_generate_batch, (seed, size)))
+
+                    # keep a bounded number of batches in flight
+                    if len(pending) >= 2 * self.processes:
+                        yield from self.batch_results(pending.popleft().get())
+
+                while pending:
+                    yield from self.batch_results(pending.popleft().get())
+        finally:
+            _worker_fuzzer = None
+
+    def batch_results(self, batch):
+        for vector_id, serialized in batch:
+            yield self.vectors[vector_id], serialized
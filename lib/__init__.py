@@ -1 +1,3 @@
-__all__ = ["grammar", "helper", "inject", "inject_const", "inject", "tree_helper"]
+__version__ = "0.2"
+
+__all__ = ["builder", "cache", "corpus", "coverage", "dictionary", "grammar", "helper", "inject", "inject_const", "minimize", "mutate", "replay", "stats", "transport", "tree", "tree_helper", "triage", "values", "weights", "wire"]
@@ -0,0 +1,184 @@
+from google.protobuf.descriptor import FieldDescriptor as fd
+
+from lib.grammar import symbol_name
+from lib.inject import FieldKeys
+from lib.inject_const import *
+
+class BuildError(Exception):
+    pass
+
+def convert(field, value):
+    """
+    Convert `value` to the python type expected by the protobuf `field`
+    """
+    if field.type == fd.TYPE_ENUM:
+        if isinstance(value, str):
+            if value.lstrip('-').isdigit():
+                return int(value)
+            if value not in field.enum_type.values_by_name:
+                raise BuildError(f"{field.name}: unknown enum value {value}")
+            return field.enum_type.values_by_name[value].number
+        return int(value)
+
+    elif field.type == fd.TYPE_BOOL:
+        if isinstance(value, str):
+            return value.lower() in ('1', 't', 'true')
+        return bool(value)
+
+    elif field.type == fd.TYPE_STRING:
+        if isinstance(value, bytes):
+            return value.decode('utf-8', 'replace')
+        return str(value)
+
+    elif field.type == fd.TYPE_BYTES:
+        if isinstance(value, str):
+            return value.encode('utf-8')
+        return bytes(value)
+
+    elif isinstance(value, str):
+        return int(value, 0)
+    return int(value)
+
+class Builder():
+    """
+    Fill a protobuf message straight from a derivation tree, skipping the text
+    format. Fields matching `delete` are skipped and those matching `replace`
+    set while walking the tree (see inject.FieldKeys). Each remaining payload
+    placeholder becomes a slot, which is assigned a typed value later with
+    fill(), in the same order as the text Template does. Slots of the fields
+    matching `field_sources` take their value from there instead.
+    """
+
+    def __init__(self, tree, msg_class, delete=[], replace={}, field_sources={}):
+        self._msg = msg_class()
+        self._slots = {t: [] for t in INJECT_TYPES}
+        self._values = []
+        self._delete = FieldKeys(delete)
+        self._replace = replace
+        self._replace_keys = FieldKeys(replace)
+        self._field_sources = field_sources
+        self._field_keys = FieldKeys(field_sources)
+        self.traverse(tree, self._msg, ())
+
+    @property
+    def message(self):
+        return self._msg
+
+    def traverse(self, tree, msg, path):
+        """
+        Walk the tree the same way as tree_helper.tree_to_gpb and fill `msg`.
+        The stack holds the iterators over the children left to visit, with
+        the message and path they belong to.
+        """
+        symbol, children, *_ = tree
+        stack = [(iter(children or ()), msg, path)]
+
+        while stack:
+            children, msg, path = stack.pop()
+            for c in children:
+                if not c[0].startswith("<"):
+                    continue
+
+                if c[0].startswith(symbol_name[:-1]):
+                    # do not update anything, just traverse
+                    stack.append((children, msg, path))
+                    stack.append((iter(c[1] or ()), msg, path))
+                    break
+
+                name = c[0][1:-1]
+                field = msg.DESCRIPTOR.fields_by_name.get(name)
+                if field is None:
+                    raise BuildError(f"{msg.DESCRIPTOR.name} has no field {name}")
+
+                field_path = path + (name,)
+                if self._delete.match(field_path) is not None:
+                    continue
+
+                if len(c[1][0][1]) == 0:
+                    # leaf, eg: ('<field>', [(':::STRING:::', [])])
+                    self.add_scalar(msg, field, c[1][0][0], field_path)
+
+                elif field.type == fd.TYPE_MESSAGE:
+                    if field.label == fd.LABEL_REPEATED:
+                        sub = getattr(msg, name).add()
+                    else:
+                        sub = getattr(msg, name)
+                        sub.SetInParent()
+                    stack.append((children, msg, path))
+                    stack.append((iter(c[1]), sub, field_path))
+                    break
+
+                else:
+                    raise BuildError(f"{msg.DESCRIPTOR.name}.{name} is not a message")
+
+    def add_scalar(self, msg, field, content, path):
+        if field.type == fd.TYPE_MESSAGE:
+            if content:
+                raise BuildError(f"{msg.DESCRIPTOR.name}.{field.name} is a message")
+            # message without any fields
+            if field.label == fd.LABEL_REPEATED:
+                getattr(msg, field.name).add()
+            else:
+                getattr(msg, field.name).SetInParent()
+            return
+
+        key = self._replace_keys.match(path)
+        if key is not None:
+            value = convert(field, self._replace[key])
+            self._values.append(self.assign(msg, field, None, value) + (path,))
+        elif content in self._slots:
+            self._slots[content].append(self.assign(msg, field, None, convert(field, 0)) + (path,))
+        else:
+            # enum
+            self._values.append(self.assign(msg, field, None, convert(field, content)) + (path,))
+
+    def assign(self, msg, field, index, value):
+        """
+        Assign `value` to the field (or to the element `index` of a repeated field),
+        return the slot
+        """
+        try:
+            if field.label == fd.LABEL_REPEATED:
+                container = getattr(msg, field.name)
+                if index is None:
+                    index = len(container)
+                    container.append(value)
+                else:
+                    container[index] = value
+            else:
+                setattr(msg, field.name, value)
+        except (TypeError, ValueError) as e:
+            raise BuildError(f"{msg.DESCRIPTOR.name}.{field.name}: {e}")
+
+        return (msg, field, index)
+
+    def set(self, key, value):
+        """
+        Assign `value` to every payload placeholder and enum of the fields matching `key`
+        """
+        keys = FieldKeys([key])
+
+        for (msg, field, index, path) in self._values:
+            if keys.match(path) is not None:
+                self.assign(msg, field, index, convert(field, value))
+
+        for inject_type, slots in self._slots.items():
+            remaining = []
+            for slot in slots:
+                (msg, field, index, path) = slot
+                if keys.match(path) is not None:
+                    self.assign(msg, field, index, convert(field, value))
+                    self._values.append(slot)
+                else:
+                    remaining.append(slot)
+            self._slots[inject_type] = remaining
+
+    def fill(self, inject_type, func):
+        """
+        Assign func() to every remaining `inject_type` placeholder
+        """
+        for (msg, field, index, path) in self._slots[inject_type]:
+            key = self._field_keys.match(path)
+            value = func() if key is None else self._field_sources[key](inject_type)
+            self.assign(msg, field, index, convert(field, value))
+        self._slots[inject_type] = []
@@ -0,0 +1,52 @@
+import hashlib
+import json
+import os
+
+from lib import __version__
+from lib.grammar import CompiledGrammar
+
+def fingerprint(msg, start_symbol):
+    """
+    Hash the serialized FileDescriptorProto of the message's file and of all its
+    imports, together with the start symbol and the ppfuzz version
+    """
+    files = dict()
+    stack = [msg.DESCRIPTOR.file]
+    while stack:
+        f = stack.pop()
+        if f.name not in files:
+            files[f.name] = f
+            stack.extend(f.dependencies)
+
+    h = hashlib.sha256()
+    h.update(f"{__version__}\0{start_symbol}\0".encode())
+    for name in sorted(files):
+        h.update(name.encode() + b"\0")
+        h.update(files[name].serialized_pb)
+    return h.hexdigest()
+
+def cache_file(cache_dir, msg, start_symbol):
+    key = fingerprint(msg, start_symbol)
+    return os.path.join(cache_dir, f"{msg.DESCRIPTOR.name}-{key}.json")
+
+def load_grammar(cache_dir, msg, start_symbol):
+    """
+    Return the cached compiled grammar of `msg`, or None
+    """
+    try:
+        with open(cache_file(cache_dir, msg, start_symbol), "r") as f:
+            return CompiledGrammar.from_tables(json.load(f))
+    except (OSError, ValueError, KeyError):
+        return None
+
+def save_grammar(cache_dir, msg, compiled):
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    fname = cache_file(cache_dir, msg, compiled.start_symbol)
+    tmp = f"{fname}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(compiled.to_tables(), f, separators=(',', ':'))
+    os.replace(tmp, fname)
+
+__all__ = ["fingerprint", "load_grammar", "save_grammar"]
@@ -0,0 +1,383 @@
+import json
+import mmap
+import os
+import struct
+
+from array import array
+from bisect import bisect_right
+from collections import namedtuple
+
+from lib.wire import encode_varint, decode_varint
+
+def write_record(f, vector_id, serialized):
+    """
+    Append a record to a length-delimited corpus file: the varint id of the
+    vector (its index in config.services), the varint length of the
+    serialized input and the input itself
+    """
+    f.write(encode_varint(vector_id) + encode_varint(len(serialized)))
+    f.write(serialized)
+
+def write_corpus(fname, inputs):
+    """
+    Stream the (vector, serialized) tuples from `inputs` to `fname`, return their count
+    """
+    count = 0
+    with open(fname, "wb", buffering=1 << 20) as f:
+        for vector, serialized in inputs:
+            write_record(f, vector['id'], serialized)
+            count += 1
+    return count
+
+def read_corpus(fname):
+    """
+    Yield the (vector id, serialized) records of a corpus file
+    """
+    with open(fname, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError: # empty file
+            return
+
+        with data:
+            pos = 0
+            while pos < len(data):
+                vector_id, pos = decode_varint(data, pos)
+                n, pos = decode_varint(data, pos)
+                if pos + n > len(data):
+                    raise ValueError(f"{fname}: truncated record")
+                yield vector_id, data[pos:pos + n]
+                pos += n
+
+# entry of a CorpusStore index: segment, offset of the record, vector id, bucket
+INDEX_ENTRY = struct.Struct('<IQIq')
+
+# index entries held back until the records they point to are written
+INDEX_BUFFER = 1 << 16
+
+Record = namedtuple('Record', ['vector_id', 'serialized', 'ref', 'bucket'])
+
+def encode_optional(value):
+    return encode_varint(0 if value is None else value + 1)
+
+def decode_optional(data, pos):
+    value, pos = decode_varint(data, pos)
+    return (None if value == 0 else value - 1), pos
+
+class CorpusStore():
+    """
+    Append-only store of inputs in the directory `path`. The records go to
+    segment files of about `segment_size` bytes: varint vector id, reference
+    (eg. the index of the input in the stream of a seed), result bucket
+    (the triage.fingerprint_id() of the response, the same in every run),
+    length and the serialized input; the reference and bucket are optional. A fixed-size entry per record in the index file
+    gives access to any record by number, and the records of a bucket or a
+    vector are listed from the index. Both are read through mmap. The index
+    entries are only written once their records are, so after a crash the
+    index never points past the segments.
+
+    The runs appending to the store are noted in the JSON lines file `runs`
+    (see add_run()), with the seed the references of their records refer to.
+    """
+
+    def __init__(self, path, segment_size=1 << 28):
+        self.path = path
+        self.segment_size = segment_size
+        os.makedirs(path, exist_ok=True)
+
+        self.maps = dict()
+        self.index_map = None
+        self.by_key = None
+
+        self.index = open(os.path.join(path, "index"), "ab+")
+        self.count = self.recover()
+        self.segment = self.segment_offset = self.out = None
+        self.pending = bytearray()
+        self.dirty = False
+
+    def segment_path(self, segment):
+        return os.path.join(self.path, f"{segment:06d}.seg")
+
+    def segments(self):
+        return sorted(int(f[:-4]) for f in os.listdir(self.path) if f.endswith(".seg"))
+
+    def recover(self):
+        """
+        Drop the partly written index entry and the entries of incomplete
+        records, index the records written after the last valid entry; return
+        the number of records
+        """
+        self.index.seek(0, os.SEEK_END)
+        count = self.index.tell() // INDEX_ENTRY.size
+
+        # the entries of the records lost with the end of their segment
+        maps = dict()
+        try:
+            while count:
+                self.index.seek((count - 1) * INDEX_ENTRY.size)
+                segment, offset, _, _ = INDEX_ENTRY.unpack(self.index.read(INDEX_ENTRY.size))
+                if self.record_end(maps, segment, offset) is not None:
+                    break
+                count -= 1
+        finally:
+            for data in maps.values():
+                if data is not None:
+                    data.close()
+        self.index.truncate(count * INDEX_ENTRY.size)
+
+        segment, end = 0, 0
+        if count:
+            self.index.seek((count - 1) * INDEX_ENTRY.size)
+            segment, end, _, _ = INDEX_ENTRY.unpack(self.index.read(INDEX_ENTRY.size))
+            # indexed again from the segment, with the records following it
+            count -= 1
+            self.index.truncate(count * INDEX_ENTRY.size)
+
+        self.index.seek(0, os.SEEK_END)
+        for s in self.segments():
+            if s < segment:
+                continue
+            if s > segment:
+                end = 0
+
+            with open(self.segment_path(s), "r+b") as f:
+                size = os.fstat(f.fileno()).st_size
+                pos = end
+                if pos < size:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        while pos < size:
+                            entry = []
+                            next_pos = self.scan(data, pos, entry)
+                            if next_pos is None:
+                                break
+                            self.index.write(INDEX_ENTRY.pack(s, pos, *entry))
+                            count += 1
+                            pos = next_pos
+                if pos < size:
+                    f.truncate(pos)
+
+        self.index.flush()
+        return count
+
+    def record_end(self, maps, segment, offset):
+        """
+        Return the end of the record at `offset` of a segment, None if it is
+        incomplete or the segment is missing; `maps` holds the segments mapped so far
+        """
+        if segment not in maps:
+            try:
+                with open(self.segment_path(segment), "rb") as f:
+                    maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError): # missing or empty
+                maps[segment] = None
+
+        data = maps[segment]
+        if data is None or offset >= len(data):
+            return None
+        return self.scan(data, offset, None)
+
+    def scan(self, data, pos, entry):
+        """
+        Return the end of the record at `pos`, None if it is incomplete;
+        append its vector id and bucket to `entry`
+        """
+        try:
+            vector_id, pos = decode_varint(data, pos)
+            _, pos = decode_optional(data, pos)
+            bucket, pos = decode_optional(data, pos)
+            n, pos = decode_varint(data, pos)
+        except ValueError:
+            return None
+        if pos + n > len(data):
+            return None
+        if entry is not None:
+            entry += [vector_id, -1 if bucket is None else bucket]
+        return pos + n
+
+    def open_segment(self):
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 0
+        self.out = open(self.segment_path(self.segment), "ab", buffering=1 << 20)
+        self.segment_offset = self.out.tell()
+
+    def append(self, vector_id, serialized, ref=None, bucket=None):
+        """
+        Store an input, return its record number
+        """
+        if self.out is None:
+            self.open_segment()
+        if self.segment_offset >= self.segment_size:
+            self.out.close()
+            self.segment += 1
+            self.out = open(self.segment_path(self.segment), "ab", buffering=1 << 20)
+            self.segment_offset = 0
+
+        record = (encode_varint(vector_id) + encode_optional(ref) + encode_optional(bucket)
+                  + encode_varint(len(serialized)))
+        self.out.write(record)
+        self.out.write(serialized)
+        self.pending += INDEX_ENTRY.pack(self.segment, self.segment_offset, vector_id,
+                                         -1 if bucket is None else bucket)
+        self.segment_offset += len(record) + len(serialized)
+        self.dirty = True
+        if len(self.pending) >= INDEX_BUFFER:
+            self.write_pending()
+
+        number = self.count
+        self.count += 1
+        if self.by_key is not None:
+            self.by_key.setdefault(('bucket', bucket), array('Q')).append(number)
+            self.by_key.setdefault(('vector', vector_id), array('Q')).append(number)
+        return number
+
+    def add_run(self, **info):
+        """
+        Note that the next records come from a new run, described by `info`
+        (eg. its seed and arguments, to generate their inputs again)
+        """
+        with open(os.path.join(self.path, "runs"), "a") as f:
+            f.write(json.dumps({'first': self.count, **info}) + '\n')
+
+    def runs(self):
+        """
+        Return the runs noted by add_run(), in order
+        """
+        try:
+            with open(os.path.join(self.path, "runs"), "r") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def run_of(self, number):
+        """
+        Return the run which appended the record `number`, None if not noted
+        """
+        runs = self.runs()
+        i = bisect_right([run['first'] for run in runs], number)
+        return runs[i - 1] if i else None
+
+    def extend(self, inputs):
+        """
+        Store the (vector id, serialized) tuples from `inputs`, eg. read_corpus(), return their count
+        """
+        count = 0
+        for vector_id, serialized in inputs:
+            self.append(vector_id, serialized)
+            count += 1
+        return count
+
+    def write_pending(self):
+        """
+        Write the pending index entries, after the records they point to
+        """
+        self.out.flush()
+        self.index.write(self.pending)
+        self.pending.clear()
+
+    def flush(self):
+        if self.dirty:
+            self.write_pending()
+            self.index.flush()
+            self.dirty = False
+
+    def map(self, segment, end):
+        """
+        Return the mmap of a segment, covering at least `end` bytes
+        """
+        data = self.maps.get(segment)
+        if data is None or len(data) < end:
+            self.flush()
+            if data is not None:
+                data.close()
+            with open(self.segment_path(segment), "rb") as f:
+                data = self.maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return data
+
+    def entry(self, number):
+        end = (number + 1) * INDEX_ENTRY.size
+        if self.index_map is None or len(self.index_map) < end:
+            self.flush()
+            if self.index_map is not None:
+                self.index_map.close()
+            self.index_map = mmap.mmap(self.index.fileno(), 0, access=mmap.ACCESS_READ)
+        return INDEX_ENTRY.unpack_from(self.index_map, number * INDEX_ENTRY.size)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, number):
+        if number < 0:
+            number += self.count
+        if not 0 <= number < self.count:
+            raise IndexError(number)
+
+        segment, offset, _, _ = self.entry(number)
+        data = self.map(segment, offset + 1)
+        vector_id, pos = decode_varint(data, offset)
+        ref, pos = decode_optional(data, pos)
+        bucket, pos = decode_optional(data, pos)
+        n, pos = decode_varint(data, pos)
+        if pos + n > len(data):
+            data = self.map(segment, pos + n)
+        return Record(vector_id, data[pos:pos + n], ref, bucket)
+
+    def __iter__(self):
+        for number in range(self.count):
+            yield self[number]
+
+    def inputs(self):
+        """
+        Yield the (vector id, serialized) tuples, as read_corpus()
+        """
+        for record in self:
+            yield record.vector_id, record.serialized
+
+    def load_keys(self):
+        if self.by_key is None:
+            self.by_key = dict()
+            if self.count:
+                self.entry(self.count - 1)
+                view = memoryview(self.index_map)[:self.count * INDEX_ENTRY.size]
+                for number, (_, _, vector_id, bucket) in enumerate(INDEX_ENTRY.iter_unpack(view)):
+                    bucket = None if bucket < 0 else bucket
+                    self.by_key.setdefault(('bucket', bucket), array('Q')).append(number)
+                    self.by_key.setdefault(('vector', vector_id), array('Q')).append(number)
+                view.release()
+        return self.by_key
+
+    def by_bucket(self, bucket):
+        """
+        Return the record numbers of a result bucket
+        """
+        return list(self.load_keys().get(('bucket', bucket), ()))
+
+    def by_vector(self, vector_id):
+        """
+        Return the record numbers of a vector
+        """
+        return list(self.load_keys().get(('vector', vector_id), ()))
+
+    def buckets(self):
+        """
+        Return the number of records per bucket
+        """
+        return {key[1]: len(numbers) for key, numbers in self.load_keys().items()
+                if key[0] == 'bucket'}
+
+    def close(self):
+        self.flush()
+        if self.out:
+            self.out.close()
+        self.index.close()
+        for data in self.maps.values():
+            data.close()
+        if self.index_map is not None:
+            self.index_map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+__all__ = ["write_record", "write_corpus", "read_corpus", "CorpusStore", "Record"]
@@ -0,0 +1,129 @@
+from lib.grammar import exp_string, is_nonterminal
+
+class GrammarCoverage():
+    """
+    Expansions and k-paths of a CompiledGrammar covered by derivation trees.
+    An expansion is a (symbol id, expansion index) pair, a k-path a tuple of
+    k symbol ids, each one expanded from the previous in a tree.
+    """
+
+    def __init__(self, g, k=2, lookahead=2):
+        self.g = g
+        self.k = k
+        self.lookahead = lookahead
+        self.covered = set()
+        self.paths = set()
+
+        # expansion index by child symbols, per symbol
+        self.indexes = [{tuple(s for (s, _) in template): i for (i, template) in enumerate(templates)}
+                        for templates in g.templates]
+        self.successors = [sorted({s for nts in nonterminals for s in nts})
+                           for nonterminals in g.nonterminals]
+
+        self.reach = dict()
+        self.below = dict()
+        self.reachable = self.reachable_from(g.start)
+
+    def reachable_from(self, symbol_id):
+        """
+        Return the ids of the symbols reachable from `symbol_id`, itself included
+        """
+        reach = self.reach.get(symbol_id)
+        if reach is None:
+            reach = {symbol_id}
+            stack = [symbol_id]
+            while stack:
+                for s in self.successors[stack.pop()]:
+                    if s not in reach:
+                        reach.add(s)
+                        stack.append(s)
+            self.reach[symbol_id] = reach
+        return reach
+
+    def add(self, symbol_id, index):
+        """
+        Record an expansion chosen while a tree is being expanded
+        """
+        if (symbol_id, index) not in self.covered:
+            self.covered.add((symbol_id, index))
+            self.below.clear()
+
+    def add_tree(self, tree):
+        """
+        Record the coverage of a derivation tree, return the number of newly
+        covered expansions
+        """
+        g = self.g
+        before = len(self.covered)
+
+        # (node, k-path of its ancestors, itself included)
+        stack = [(tree, ())]
+        while stack:
+            (symbol, children), path = stack.pop()
+            if not children or not is_nonterminal(symbol):
+                continue
+
+            symbol_id = g.ids[symbol]
+            index = self.indexes[symbol_id].get(tuple(s for (s, _) in children))
+            if index is not None:
+                self.covered.add((symbol_id, index))
+
+            path = (path + (symbol_id,))[-self.k:]
+            if len(path) == self.k:
+                self.paths.add(path)
+            stack.extend((c, path) for c in children)
+
+        if len(self.covered) > before:
+            self.below.clear()
+        return len(self.covered) - before
+
+    def uncovered_below(self, symbol_id):
+        """
+        Return the number of uncovered expansions of the symbols at most
+        `lookahead` expansions below `symbol_id`, itself included
+        """
+        count = self.below.get(symbol_id)
+        if count is None:
+            near = {symbol_id}
+            level = [symbol_id]
+            for _ in range(self.lookahead - 1):
+                level = [t for s in level for t in self.successors[s] if t not in near]
+                near.update(level)
+            count = sum(1 for s in near for i in range(len(self.g.expansions[s]))
+                        if (s, i) not in self.covered)
+            self.below[symbol_id] = count
+        return count
+
+    def score(self, symbol_id, index):
+        """
+        Rank an expansion: first if it is uncovered itself, then by the number
+        of uncovered expansions close below it. Looking further could always
+        favour recursive expansions, and never end a repeated field.
+        """
+        return (int((symbol_id, index) not in self.covered),
+                sum(self.uncovered_below(s) for s in self.g.nonterminals[symbol_id][index]))
+
+    def total_paths(self):
+        """
+        Number of k-paths from the symbols reachable from the start symbol
+        """
+        walks = {s: 1 for s in self.reachable}
+        for _ in range(self.k - 1):
+            walks = {s: sum(walks[t] for t in self.successors[s]) for s in self.reachable}
+        return sum(walks.values())
+
+    def report(self):
+        expansions = [(s, i) for s in sorted(self.reachable)
+                      for i in range(len(self.g.expansions[s]))]
+        uncovered = [f"{self.g.symbols[s]} ::= {exp_string(self.g.expansions[s][i])}"
+                     for (s, i) in expansions if (s, i) not in self.covered]
+        return {
+            'expansions': len(expansions) - len(uncovered),
+            'total_expansions': len(expansions),
+            'k': self.k,
+            'k_paths': len(self.paths),
+            'total_k_paths': self.total_paths(),
+            'uncovered': uncovered,
+        }
+
+__all__ = ["GrammarCoverage"]
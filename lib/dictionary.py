@@ -0,0 +1,173 @@
+import mmap
+import os
+import random
+import struct
+
+from array import array
+from bisect import bisect
+from functools import lru_cache
+from itertools import accumulate
+
+from lib.inject_const import *
+
+# sidecar index: magic, size and mtime of the wordlist, then the line offsets
+INDEX_MAGIC = b'PPFZIDX1'
+INDEX_HEADER = struct.Struct('=8sQQ')
+
+# placeholder types by their name in the config
+TYPE_NAMES = {
+    'int32': INJECT_INT32,
+    'int64': INJECT_INT64,
+    'bool': INJECT_BOOL,
+    'string': INJECT_STRING,
+    'bytes': INJECT_BYTES,
+}
+
+def parse(inj_type, entry):
+    """
+    Convert a wordlist entry to a value of the placeholder type
+    """
+    if inj_type in (INJECT_INT32, INJECT_INT64):
+        return int(entry, 0)
+    elif inj_type == INJECT_BOOL:
+        return int(int(entry, 0) != 0)
+    elif inj_type == INJECT_STRING:
+        return entry.decode('utf-8', 'replace')
+    return entry
+
+class Wordlist():
+    """
+    Memory-mapped wordlist, one entry per line. The offsets of the lines are
+    stored in a sidecar file (<wordlist>.idx), created on first use and
+    memory-mapped as well, so the entries are never loaded into the Python
+    heap and processes using the same wordlist share the pages.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        with open(fname, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b''
+
+        self.header = INDEX_HEADER.pack(INDEX_MAGIC, st.st_size, st.st_mtime_ns)
+        self.offsets = self.load_index()
+        if self.offsets is None:
+            self.offsets = self.build_index()
+
+    def load_index(self):
+        try:
+            with open(f"{self.fname}.idx", 'rb') as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+
+        if index[:INDEX_HEADER.size] != self.header or (len(index) - INDEX_HEADER.size) % 8:
+            index.close()
+            return None
+        return memoryview(index)[INDEX_HEADER.size:].cast('Q')
+
+    def build_index(self):
+        """
+        Find the start of every line; the last offset is the end of the data,
+        plus one if the last line is not terminated
+        """
+        data = self.data
+        offsets = array('Q')
+        pos = 0
+        while pos < len(data):
+            offsets.append(pos)
+            pos = data.find(b'\n', pos)
+            pos = len(data) if pos < 0 else pos
+            pos += 1
+        offsets.append(pos)
+
+        tmp = f"{self.fname}.idx.{os.getpid()}"
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(self.header)
+                offsets.tofile(f)
+            os.replace(tmp, f"{self.fname}.idx")
+        except OSError:
+            # read-only location, keep the index in memory
+            return offsets
+
+        return self.load_index() or offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.data[self.offsets[i]:self.offsets[i + 1] - 1].rstrip(b'\r')
+
+    def choice(self, rng=random):
+        if not len(self):
+            raise IndexError(f"{self.fname}: empty wordlist")
+        return self[rng.randrange(len(self))]
+
+@lru_cache(maxsize=None)
+def open_wordlist(fname):
+    return Wordlist(fname)
+
+def open_entries(entries):
+    """
+    Return the (weight, Wordlist or None) of the (weight, file) `entries`,
+    without the empty wordlists
+    """
+    result = []
+    for w, fname in entries:
+        wordlist = None if fname is None else open_wordlist(fname)
+        if wordlist is not None and not len(wordlist):
+            print(f"Skipping the empty wordlist {fname}")
+            continue
+        result.append((w, wordlist))
+    return result
+
+class Mix():
+    """
+    Call one of several sources, picked by weight
+    """
+
+    def __init__(self, weighted, rng=random):
+        weighted = [(w, source) for (w, source) in weighted if w > 0]
+        if not weighted:
+            raise ValueError("no source with a positive weight")
+        self.sources = [source for (_, source) in weighted]
+        self.cumulative = list(accumulate(w for (w, _) in weighted))
+        self.rng = rng
+
+    def __call__(self, *args):
+        if len(self.sources) == 1:
+            return self.sources[0](*args)
+        i = bisect(self.cumulative, self.rng.random() * self.cumulative[-1])
+        return self.sources[min(i, len(self.sources) - 1)](*args)
+
+def type_source(entries, inj_type, default):
+    """
+    Return the value source of a placeholder type, mixing the (weight, wordlist)
+    `entries`; a None wordlist stands for the `default` source
+    """
+    def wordlist_source(wordlist):
+        return lambda: parse(inj_type, wordlist.choice())
+
+    return Mix([(w, default if wordlist is None else wordlist_source(wordlist))
+                for (w, wordlist) in open_entries(entries)])
+
+def field_source(entries, type_sources):
+    """
+    Return the value source of a field, a function of the placeholder type;
+    a None wordlist stands for the source of that type in `type_sources`
+    """
+    def default_source(inj_type):
+        return type_sources[inj_type]()
+
+    def wordlist_source(wordlist):
+        return lambda inj_type: parse(inj_type, wordlist.choice())
+
+    return Mix([(w, default_source if wordlist is None else wordlist_source(wordlist))
+                for (w, wordlist) in open_entries(entries)])
+
+__all__ = ["Wordlist", "Mix", "open_wordlist", "type_source", "field_source", "TYPE_NAMES"]
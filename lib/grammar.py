@@ -3,6 +3,8 @@ import re
 import random
 import sys
 
+from collections.abc import Mapping
+
 from lib.inject_const import *
 from google.protobuf.descriptor import FieldDescriptor as fd
 
@@ -238,11 +240,255 @@ def is_valid_grammar(grammar, start_symbol):
 
     return used_nonterminals == defined_nonterminals and len(unreachable) == 0
 
+def strongly_connected_components(graph):
+    """
+    Return the strongly connected components of `graph` ({node: [successors]})
+    as a {node: component} mapping, component being a frozenset of nodes
+    """
+    index = dict()
+    lowlink = dict()
+    stack = list()
+    on_stack = set()
+    components = dict()
+
+    for root in graph:
+        if root in index:
+            continue
+
+        work = [(root, iter(graph[root]))]
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+
+        while work:
+            node, successors = work[-1]
+            for succ in successors:
+                if succ not in index:
+                    index[succ] = lowlink[succ] = len(index)
+                    stack.append(succ)
+                    on_stack.add(succ)
+                    work.append((succ, iter(graph.get(succ, []))))
+                    break
+                elif succ in on_stack:
+                    lowlink[node] = min(lowlink[node], index[succ])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+                if lowlink[node] == index[node]:
+                    component = set()
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.add(member)
+                        if member == node:
+                            break
+                    component = frozenset(component)
+                    for member in component:
+                        components[member] = component
+
+    return components
+
+def min_costs(symbols, costs, region):
+    """
+    Compute the minimum expansion cost of every symbol in `region` as a fixpoint.
+    `symbols` maps a symbol to the nonterminals of each of its expansions, `costs`
+    holds the known costs and is updated in place.
+    """
+    changed = True
+    while changed:
+        changed = False
+        for symbol in region:
+            cost = min(sum(costs[s] for s in expansion) + 1
+                       for expansion in symbols[symbol])
+            if cost < costs[symbol]:
+                costs[symbol] = cost
+                changed = True
+    return costs
+
+def cost_table(grammar):
+    """
+    Return {symbol: [cost of each expansion]}. The cost of an expansion is the
+    minimum number of expansions needed to derive terminals from it without
+    expanding its own symbol again, float('inf') marking expansions which can
+    only be derived through (potentially infinite) recursion.
+    """
+    symbols = {symbol: [nonterminals(e) for e in expansions]
+               for symbol, expansions in grammar.items()}
+    graph = {symbol: {s for expansion in expansions for s in expansion}
+             for symbol, expansions in symbols.items()}
+    components = strongly_connected_components(graph)
+
+    used = {s for successors in graph.values() for s in successors}
+    costs = min_costs(symbols, dict.fromkeys(used | symbols.keys(), float('inf')), symbols)
+
+    table = dict()
+    for symbol, expansions in symbols.items():
+        local_costs = costs
+        component = components[symbol]
+        if symbol in graph[symbol] or len(component) > 1:
+            # The symbol is recursive; only the symbols of its own component
+            # may depend on it, recompute them with the symbol excluded
+            local_costs = dict(costs)
+            for s in component:
+                local_costs[s] = float('inf')
+            min_costs(symbols, local_costs, component - {symbol})
+
+        table[symbol] = [sum(local_costs[s] for s in expansion) + 1
+                         for expansion in expansions]
+    return table
+
+class CompiledGrammar(Mapping):
+    """
+    Read-only view of a BNF grammar with every expansion pre-tokenized, so the
+    derivation tree can be expanded without any regex or string parsing.
+    Symbols are numbered; for each symbol id and expansion index it keeps the
+    child template, the ids of the nonterminals and the expansion cost.
+    """
+
+    def __init__(self, grammar, start_symbol):
+        self.grammar = grammar
+        self.start_symbol = start_symbol
+
+        # Number the defined symbols first, then the used but undefined ones,
+        # which check_grammar() reports
+        self.symbols = list(grammar)
+        for expansions in grammar.values():
+            for expansion in expansions:
+                for nonterminal in nonterminals(expansion):
+                    if nonterminal not in grammar and nonterminal not in self.symbols:
+                        self.symbols.append(nonterminal)
+        self.ids = {symbol: i for (i, symbol) in enumerate(self.symbols)}
+        self.start = self.ids.get(start_symbol)
+
+        self.expansions = [grammar.get(symbol, []) for symbol in self.symbols]
+        self.templates = [[expansion_template(e) for e in expansions]
+                          for expansions in self.expansions]
+        self.nonterminals = [[[self.ids[s] for s in nonterminals(e)] for e in expansions]
+                             for expansions in self.expansions]
+
+        costs = cost_table(grammar)
+        self.costs = [costs.get(symbol, []) for symbol in self.symbols]
+        self.index_terminals()
+
+    @classmethod
+    def from_tables(cls, tables):
+        """
+        Recreate a compiled grammar from to_tables(), without parsing the expansions again
+        """
+        self = cls.__new__(cls)
+        self.start_symbol = tables['start_symbol']
+        self.symbols = tables['symbols']
+        self.ids = {symbol: i for (i, symbol) in enumerate(self.symbols)}
+        self.start = self.ids.get(self.start_symbol)
+        self.expansions = tables['expansions']
+        self.templates = [[tuple((s, bool(nonterminal)) for (s, nonterminal) in template)
+                           for template in templates]
+                          for templates in tables['templates']]
+        self.nonterminals = tables['nonterminals']
+        self.costs = tables['costs']
+        self.grammar = {symbol: expansions for (symbol, expansions)
+                        in zip(self.symbols, self.expansions) if expansions}
+        self.index_terminals()
+        return self
+
+    def to_tables(self):
+        """
+        Return the compiled grammar as plain lists and strings
+        """
+        return {
+            'start_symbol': self.start_symbol,
+            'symbols': self.symbols,
+            'expansions': self.expansions,
+            'templates': [[[[s, int(nonterminal)] for (s, nonterminal) in template]
+                           for template in templates]
+                          for templates in self.templates],
+            'nonterminals': self.nonterminals,
+            'costs': self.costs,
+        }
+
+    def __getitem__(self, symbol):
+        return self.grammar[symbol]
+
+    def __iter__(self):
+        return iter(self.grammar)
+
+    def __len__(self):
+        return len(self.grammar)
+
+    def index_terminals(self):
+        """
+        Number the terminals of the expansions after the symbols, for the
+        codes of tree.DerivationTree: `names` holds the symbols then the terminals
+        """
+        self.names = list(self.symbols)
+        self.terminal_ids = dict()
+        for templates in self.templates:
+            for template in templates:
+                for (s, nonterminal) in template:
+                    if not nonterminal:
+                        self.code(s, False)
+
+    def code(self, s, nonterminal):
+        """
+        Return the code of a symbol: its id for a nonterminal, or the number
+        of symbols plus its index for a terminal
+        """
+        if nonterminal:
+            return self.ids[s]
+        code = self.terminal_ids.get(s)
+        if code is None:
+            code = self.terminal_ids[s] = len(self.names)
+            self.names.append(s)
+        return code
+
+    def expansion_to_children(self, symbol_id, index):
+        """
+        Return new (unexpanded) children for expansion `index` of the symbol
+        """
+        return [(s, None) if nonterminal else (s, [])
+                for (s, nonterminal) in self.templates[symbol_id][index]]
+
+    def is_consistent(self):
+        """
+        True if the compiled tables match the source grammar
+        """
+        for (i, symbol) in enumerate(self.symbols):
+            expansions = self.grammar.get(symbol, [])
+            if len(self.templates[i]) != len(expansions):
+                return False
+            if len(self.costs[i]) != len(expansions):
+                return False
+            for (template, ids, expansion) in zip(self.templates[i], self.nonterminals[i], expansions):
+                if ''.join(s for (s, _) in template) != exp_string(expansion):
+                    return False
+                if [s for (s, nonterminal) in template if nonterminal] != [self.symbols[n] for n in ids]:
+                    return False
+        return True
+
+def expansion_template(expansion):
+    """
+    Split `expansion` into a tuple of (string, is_nonterminal) pairs
+    """
+    expansion = exp_string(expansion)
+    if expansion == "":  # Special case: epsilon expansion
+        return (("", False),)
+
+    strings = re.split(RE_NONTERMINAL, expansion)
+    return tuple((s, bool(is_nonterminal(s))) for s in strings if len(s) > 0)
+
+def compile_grammar(grammar, start_symbol):
+    return CompiledGrammar(grammar, start_symbol)
+
 def check_grammar(grammar, start_symbol):
         assert start_symbol in grammar
         assert is_valid_grammar(
             grammar,
             start_symbol=start_symbol)
+        if isinstance(grammar, CompiledGrammar):
+            assert grammar.is_consistent()
 
 def exp_string(expansion):
     """
@@ -252,4 +498,4 @@ def exp_string(expansion):
         return expansion
     return expansion[0]
 
-__all__ = ["create_grammar", "grammar_to_gpb", "check_grammar"]
+__all__ = ["create_grammar", "grammar_to_gpb", "check_grammar", "cost_table", "compile_grammar", "CompiledGrammar"]
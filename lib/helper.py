@@ -1,61 +1,203 @@
 import subprocess
+import hashlib
+import json
 import re
 import os.path
 import sys
 
 from os import mkdir
 from importlib import import_module
+from concurrent.futures import ThreadPoolExecutor
+
+import google.protobuf
 
 sys.path.append("..")
 from config import *
 
+# protoc outputs of the previous runs, see pb_compile()
+MANIFEST = ".manifest.json"
+
+RE_IMPORT = re.compile(r'^\s*import\s+(?:public\s+|weak\s+)?"([^"]+)"\s*;', re.MULTILINE)
+
+
+def unknown_requests(requests=None):
+    """
+    Return the request names of `requests` which match no service
+    """
+    names = {request for (_, request, _) in services}
+    return [r for r in requests or () if r not in names]
+
+def selected_services(requests=None):
+    """
+    Return the services, restricted to the given request names; raise a
+    ValueError for the names matching no service
+    """
+    unknown = unknown_requests(requests)
+    if unknown:
+        raise ValueError(f"no service for request(s) {', '.join(unknown)}")
+    return [(i, s) for (i, s) in enumerate(services) if requests is None or s[1] in requests]
 
-def get_proto_files():
+def get_proto_files(requests=None):
     """
     Extract .proto files from the services
     """
     proto_files = set()
-    [proto_files.add(p) for _, _, p in services]
+    [proto_files.add(p) for _, (_, _, p) in selected_services(requests)]
     return proto_files
 
+class ProtoLibs(dict):
+    """
+    Compiled protobuf modules of the .proto files, imported on first access
+    """
+
+    def __init__(self, proto_files):
+        super().__init__()
+        self.proto_files = set(proto_files)
+
+    def __missing__(self, pf):
+        if pf not in self.proto_files:
+            raise KeyError(pf)
+        proto_lib = re.sub(r'.proto$', '_pb2', os.path.basename(pf))
+        self[pf] = import_module(f"{proto_out}.{proto_lib}")
+        return self[pf]
+
 def get_proto_libs(proto_files):
     """
     Dynamically import the compiled protobuf files
     """
-    libs = dict()
-    for pf in proto_files:
-        proto_lib = re.sub(r'.proto$', '_pb2', os.path.basename(pf))
-        libs[pf] = import_module(f"{proto_out}.{proto_lib}")
-    return libs
+    return ProtoLibs(proto_files)
 
-def create_vectors(libs):
+def create_vectors(libs, requests=None):
     """
     Create attack vectors - list of dictionaries containing url, request 
     and protobuf message. Later each entry will be expanded with grammar.
+    The id of a vector is the index of its service in the config.
     """
     vectors = list()
-    for url, request, proto in services:
+    for i, (url, request, proto) in selected_services(requests):
         msg = getattr(libs[proto], request)
         entry = dict()
+        entry['id'] = i
         entry['url'] = url
         entry['request'] = request
         entry['msg'] = msg 
         vectors.append(entry)
     return vectors
-    
-def pb_compile(files, dest):
+
+def proto_fingerprint(file):
     """
-    Compile the protobuf files running the external 'protoc' compiler
+    Hash the content of a .proto file and of all the files it imports
+    """
+    include = os.path.dirname(file)
+    closure = dict()
+    stack = [file]
+    while stack:
+        f = stack.pop()
+        if f in closure:
+            continue
+        try:
+            with open(f, "rb") as fp:
+                content = fp.read()
+        except OSError:
+            closure[f] = b"missing"
+            continue
+        closure[f] = hashlib.sha256(content).digest()
+        for i in RE_IMPORT.findall(content.decode('utf-8', 'replace')):
+            stack.append(os.path.join(include, i))
+
+    h = hashlib.sha256()
+    for f in sorted(closure):
+        h.update(f.encode() + b"\0" + closure[f])
+    return h.hexdigest()
+
+def generator_version():
+    """
+    Return the versions of 'protoc' and of the protobuf runtime, which the
+    generated files depend on besides the .proto files
+    """
+    try:
+        ret = subprocess.run(['protoc', '--version'], stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL, universal_newlines=True)
+        protoc = ret.stdout.strip()
+    except OSError:
+        protoc = None
+    return f"{protoc}, protobuf {google.protobuf.__version__}"
+
+def pb2_file(file, dest):
+    return os.path.join(dest, re.sub(r'.proto$', '_pb2.py', os.path.basename(file)))
+
+def run_protoc(files, dest):
+    """
+    Compile `files` (sharing one include directory) with a single 'protoc' run,
+    return {file: error} for the files which failed
+    """
+    args = ['protoc', f'-I={os.path.dirname(files[0])}', f'--python_out={dest}'] + files
+    print(f"Running '{' '.join(args)}'")
+
+    ret = subprocess.run(args, stderr=subprocess.PIPE, universal_newlines=True)
+    if not ret.returncode:
+        return dict()
+    if len(files) == 1:
+        return {files[0]: ret.stderr.strip()}
+
+    # find out which files of the batch failed
+    failures = dict()
+    for file in files:
+        failures.update(run_protoc([file], dest))
+    return failures
+
+def pb_compile(files, dest, jobs=None, batch_size=32):
+    """
+    Compile the protobuf files running the external 'protoc' compiler, in
+    parallel batches. Files which did not change since the last run (including
+    their imports) are skipped, unless 'protoc' or the protobuf runtime
+    changed. Return {file: error} for the failed files.
     """
     if not os.path.exists(dest):
         mkdir(dest)
 
-    for file in files:
-        args = f'protoc -I={os.path.dirname(file)} --python_out={dest} {file}'
-        print(f"Running '{args}'")
+    version = generator_version()
+    manifest_file = os.path.join(dest, MANIFEST)
+    try:
+        with open(manifest_file, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = dict()
+    # compiled by another generator, or a manifest of the old format
+    if manifest.get('generator') != version:
+        manifest = {'generator': version, 'files': dict()}
+    files_manifest = manifest['files']
+
+    fingerprints = {file: proto_fingerprint(file) for file in files}
+    outdated = sorted(file for file in files
+                      if files_manifest.get(file) != fingerprints[file]
+                      or not os.path.exists(pb2_file(file, dest)))
+    print(f"{len(files) - len(outdated)} file(s) up to date, {len(outdated)} to compile")
+
+    # protoc gets one include directory per run
+    batches = list()
+    for include in sorted({os.path.dirname(file) for file in outdated}):
+        same_dir = [file for file in outdated if os.path.dirname(file) == include]
+        for i in range(0, len(same_dir), batch_size):
+            batches.append(same_dir[i:i + batch_size])
+
+    failures = dict()
+    with ThreadPoolExecutor(jobs) as pool:
+        for result in pool.map(lambda batch: run_protoc(batch, dest), batches):
+            failures.update(result)
+
+    for file in outdated:
+        if file in failures:
+            files_manifest.pop(file, None)
+        else:
+            files_manifest[file] = fingerprints[file]
+
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
 
-        ret = subprocess.call(args, shell=True)
-        if ret:
-            exit()
+    for file, error in sorted(failures.items()):
+        print(f"Failed to compile {file}:\n{error}")
+    return failures
 
-__all__ = ["create_vectors", "get_proto_files", "get_proto_libs", "pb_compile"]
+__all__ = ["create_vectors", "get_proto_files", "get_proto_libs", "pb_compile", "selected_services",
+           "unknown_requests"]
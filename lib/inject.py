@@ -1,49 +1,192 @@
 import random
 import re
 from string import ascii_letters
+from google.protobuf.text_encoding import CEscape
 from lib.inject_const import *
 
+RE_SCALAR_LINE = re.compile(r'(\w+): (.*)')
+RE_MESSAGE_LINE = re.compile(r'(\w+) \{')
+
+def quote(value):
+    if isinstance(value, bytes):
+        return '"{}"'.format(CEscape(value, as_utf8=False))
+    return '"{}"'.format(CEscape(value, as_utf8=True))
+
+# how the value of each payload type is written in the text format
+FORMATS = {
+    INJECT_INT32: str,
+    INJECT_INT64: str,
+    INJECT_BOOL: lambda value: str(int(value)),
+    INJECT_STRING: quote,
+    INJECT_BYTES: quote,
+}
+
+class FieldKeys():
+    """
+    Field keys of the config 'replace' and 'delete': a bare field name (eg.
+    'token') matches the field at any depth, a dotted path (eg. 'auth.token')
+    only the field at this path from the request message.
+    """
+
+    def __init__(self, keys):
+        self.order = {key: i for (i, key) in enumerate(keys)}
+        self.names = {key for key in self.order if '.' not in key}
+        self.paths = {key for key in self.order if '.' in key}
+
+    def match(self, path):
+        """
+        Return the key matching the field at `path` (a tuple of field names), or
+        None. If both its name and its path are listed, the later one wins.
+        """
+        name = path[-1] if path[-1] in self.names else None
+        full = None
+        if self.paths:
+            full = '.'.join(path)
+            if full not in self.paths:
+                full = None
+
+        if name is None or full is None:
+            return name or full
+        return max(name, full, key=self.order.get)
+
 class Template():
+    """
+    Protobuf text message with payload placeholders. The text is kept as a
+    list of chunks, each placeholder being a chunk of its own, so all of them
+    can be filled in one pass. The fields are indexed by name and by path,
+    so set() and delete() only touch their occurrences.
+    """
 
-    def __init__(self, text):
-        self._text = text
+    def __init__(self, text, slots=None, fields=None):
+        if slots is None:
+            self.text = text
+        else:
+            # chunks, slots and fields from tree_helper.tree_to_chunks()
+            self._chunks = text
+            self._slots = slots
+            self._text = None
+            self.index(fields)
 
     @property
     def text(self):
+        if self._text is None:
+            self._text = ''.join(self._chunks)
         return self._text
 
     @text.setter
     def text(self, text):
+        """
+        Split a text message, written one field per line as by tree_to_gpb()
+        """
+        chunks = list()
+        slots = {t: [] for t in INJECT_TYPES}
+        fields = list()
+        opened = list()
+
+        for line in text.splitlines(keepends=True):
+            stripped = line.rstrip('\n')
+            newline = line[len(stripped):]
+
+            m = RE_SCALAR_LINE.fullmatch(stripped)
+            if m:
+                path = tuple(name for (name, _) in opened) + (m[1],)
+                inj_type = m[2] if m[2] in slots else None
+                start = len(chunks)
+                if inj_type:
+                    slots[inj_type].append(start + 1)
+                chunks += [m[1] + ": ", m[2], newline]
+                fields.append((path, start, len(chunks), start + 1, inj_type))
+                continue
+
+            m = RE_MESSAGE_LINE.fullmatch(stripped)
+            if m:
+                opened.append((m[1], len(chunks)))
+            elif stripped == '}' and opened:
+                path = tuple(name for (name, _) in opened)
+                _, start = opened.pop()
+                fields.append((path, start, len(chunks) + 1, None, None))
+            chunks.append(line)
+
+        self._chunks = chunks
+        self._slots = slots
         self._text = text
+        self.index(fields)
+
+    def index(self, fields):
+        self._by_name = dict()
+        self._by_path = dict()
+        self._slot_paths = dict()
+        for field in fields:
+            path = field[0]
+            if field[4] is not None:
+                self._slot_paths[field[3]] = path
+            self._by_name.setdefault(path[-1], []).append(field)
+            self._by_path.setdefault('.'.join(path), []).append(field)
+
+    def lookup(self, key):
+        """
+        Return the occurrences of the field name or dotted path `key`
+        """
+        if '.' in key:
+            return self._by_path.get(key, [])
+        return self._by_name.get(key, [])
 
     def __str__(self):
         return self.text
 
     def set(self, key, value):
+        """
+        Set the value of every occurrence of the scalar field `key`
+        """
+        for (path, start, end, value_chunk, inj_type) in self.lookup(key):
+            if value_chunk is None or not self._chunks[start]:
+                continue # message or deleted
 
-        r = re.search(r'^{}: (.+)\n'.format(key), self.text, re.MULTILINE)
-        if not r:
-            return
+            if inj_type in (INJECT_STRING, INJECT_BYTES):
+                # eg. an int from the config for a string field
+                if not isinstance(value, (str, bytes)):
+                    value = str(value)
+                self._chunks[value_chunk] = quote(value)
+            else:
+                self._chunks[value_chunk] = str(value)
+            self._text = None
 
-        inj_type = r[1]
-
-        if inj_type in [INJECT_STRING]: # \b means boundry
-            pattern = r'(\b{}:) {}'.format(key, INJECT_STRING)
-            repl = f"\\1 '{value}'"
-            
-        else: 
-            pattern = r'(\b{}:) \w+'.format(key)
-            repl = f"\\1 {value}"
-        
-        self.text = re.sub(pattern, repl, self.text, re.MULTILINE)
-    
     def delete(self, key):
+        """
+        Remove every occurrence of the field (or the message) `key`
+        """
         if not len(key):
             return
-        pattern = r'(\b{}:) \w+'.format(key)
-        repl = ''
-        self.text = re.sub(r'\b{}:.*'.format(key), '', self.text, re.MULTILINE)
 
+        for (path, start, end, value_chunk, inj_type) in self.lookup(key):
+            for i in range(start, end):
+                self._chunks[i] = ''
+            self._text = None
+
+    def inject(self, sources, field_sources={}):
+        """
+        Fill the placeholders with values from `sources` ({placeholder type: function}),
+        type by type in the INJECT_TYPES order. The placeholders of the fields
+        matching `field_sources` ({field key: function of the placeholder type})
+        are filled from there instead.
+        """
+        keys = FieldKeys(field_sources) if field_sources else None
+        for inj_type in INJECT_TYPES:
+            if inj_type not in sources:
+                continue
+            func = sources[inj_type]
+            fmt = FORMATS[inj_type]
+            for i in self._slots[inj_type]:
+                # skip the placeholders which were set or deleted
+                if self._chunks[i] != inj_type:
+                    continue
+                key = keys.match(self._slot_paths[i]) if keys else None
+                if key is None:
+                    self._chunks[i] = fmt(func())
+                else:
+                    self._chunks[i] = fmt(field_sources[key](inj_type))
+            self._slots[inj_type] = []
+        self._text = None
 
     def fill(self, func):
         self.text = func(self.text)
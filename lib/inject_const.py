@@ -2,4 +2,7 @@ INJECT_INT64  = ":::INT64:::"
 INJECT_INT32  = ":::INT32:::"
 INJECT_BOOL   = ":::BOOL:::"
 INJECT_STRING = ":::STRING:::"
-INJECT_BYTES  = ":::BYTES:::"
\ No newline at end of file
+INJECT_BYTES  = ":::BYTES:::"
+
+# in the order the payloads are filled
+INJECT_TYPES  = [INJECT_INT32, INJECT_INT64, INJECT_BOOL, INJECT_STRING, INJECT_BYTES]
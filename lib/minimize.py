@@ -0,0 +1,296 @@
+import asyncio
+import time
+
+from google.protobuf.descriptor import FieldDescriptor as fd
+
+from lib.transport import Client
+from lib.triage import fingerprint
+
+def removable(msg, path=()):
+    """
+    Return the parts of `msg` which can be removed, as (path, name, index)
+    tuples: the elements of the repeated fields (by index) and the optional
+    set fields (index None), at every depth. `path` holds the (name, index) of
+    the submessages from the top message. The required fields stay, so the
+    result can be serialized and replayed with probe.py.
+    """
+    units = []
+    stack = [(msg, path)]
+    while stack:
+        msg, path = stack.pop()
+        for field, value in msg.ListFields():
+            if field.label == fd.LABEL_REPEATED:
+                for i in range(len(value)):
+                    units.append((path, field.name, i))
+                    if field.type == fd.TYPE_MESSAGE:
+                        stack.append((value[i], path + ((field.name, i),)))
+            else:
+                if field.label != fd.LABEL_REQUIRED:
+                    units.append((path, field.name, None))
+                if field.type == fd.TYPE_MESSAGE:
+                    stack.append((value, path + ((field.name, None),)))
+    return units
+
+def strings(msg):
+    """
+    Return the (path, name, index) of the non empty string and bytes values of `msg`
+    """
+    leaves = []
+    stack = [(msg, ())]
+    while stack:
+        msg, path = stack.pop()
+        for field, value in msg.ListFields():
+            values = value if field.label == fd.LABEL_REPEATED else [value]
+            for i, v in enumerate(values):
+                i = i if field.label == fd.LABEL_REPEATED else None
+                if field.type == fd.TYPE_MESSAGE:
+                    stack.append((v, path + ((field.name, i),)))
+                elif field.type in (fd.TYPE_STRING, fd.TYPE_BYTES) and len(v):
+                    leaves.append((path, field.name, i))
+    return leaves
+
+def resolve(msg, path):
+    for name, i in path:
+        msg = getattr(msg, name)
+        if i is not None:
+            msg = msg[i]
+    return msg
+
+def resolve_value(msg, leaf):
+    path, name, i = leaf
+    value = getattr(resolve(msg, path), name)
+    return value if i is None else value[i]
+
+def unit_key(unit):
+    # deepest first, then from the last element: the removals do not shift
+    # the indexes of those still to do
+    path, name, i = unit
+    return (len(path), [(n, -1 if j is None else j) for (n, j) in path], name,
+            -1 if i is None else i)
+
+def copy(msg):
+    # CopyFrom refuses a message without its required fields
+    result = type(msg)()
+    result.MergeFromString(msg.SerializePartialToString())
+    return result
+
+def remove(msg, units):
+    """
+    Return a copy of `msg` without `units` (see removable)
+    """
+    result = copy(msg)
+    for path, name, i in sorted(units, key=unit_key, reverse=True):
+        try:
+            parent = resolve(result, path)
+        except (IndexError, AttributeError):
+            # inside a part removed already
+            continue
+        if i is None:
+            parent.ClearField(name)
+        elif i < len(getattr(parent, name)):
+            del getattr(parent, name)[i]
+    return result
+
+def shorten(msg, slices):
+    """
+    Return a copy of `msg` with the string and bytes values cut to `slices`,
+    a dict of (start, end) by their (path, name, index)
+    """
+    result = copy(msg)
+    for (path, name, i), (start, end) in slices.items():
+        parent = resolve(result, path)
+        if i is None:
+            setattr(parent, name, getattr(parent, name)[start:end])
+        else:
+            values = getattr(parent, name)
+            values[i] = values[i][start:end]
+    return result
+
+def halves(start, end):
+    """
+    Return the halves of a slice shorter than it: none for an empty slice,
+    only the empty one for a single item
+    """
+    middle = (start + end) // 2
+    return [half for half in [(start, middle), (middle, end)] if half != (start, end)]
+
+def split(items, n):
+    """
+    Split `items` into `n` chunks of (almost) equal sizes
+    """
+    size, extra = divmod(len(items), n)
+    chunks = []
+    start = 0
+    for i in range(n):
+        end = start + size + (i < extra)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+class Minimizer():
+    """
+    Reduce an input of `msg_class` sent to `url` to a smaller one getting the
+    same response, by delta debugging (ddmin) on the parts of the message:
+    the elements of the repeated fields and the set fields, at every depth.
+    The string and bytes values are then halved while the response stays
+    the same. The candidates of each step are sent at once, at most
+    `concurrency` in flight over pooled keep-alive connections.
+
+    The oracle compares the fingerprints of the responses (see
+    triage.fingerprint) without the latency class, or only the status code
+    (or error name) with `status_only`.
+    """
+
+    def __init__(self, url, msg_class, concurrency=8, timeout=10, status_only=False, log=True):
+        self.url = url
+        self.msg_class = msg_class
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.status_only = status_only
+        self.log = log
+
+        self.target = None
+        self.tests = 0
+        self.results = dict()
+
+    def minimize(self, serialized):
+        """
+        Return the smallest message found, or None if `serialized` does not
+        get the same response twice
+        """
+        return asyncio.run(self.minimize_async(serialized))
+
+    async def minimize_async(self, serialized):
+        msg = self.msg_class()
+        msg.ParseFromString(serialized)
+
+        self.client = Client(pool_size=self.concurrency, timeout=self.timeout)
+        self.slots = asyncio.Semaphore(self.concurrency)
+        try:
+            # sent twice: a flaky response is no oracle
+            self.target = await self.send(serialized)
+            self.results.clear()
+            if await self.send(serialized) != self.target:
+                return None
+
+            # until a round changes nothing
+            size, smaller = None, len(serialized)
+            while smaller != size:
+                size = smaller
+                msg = await self.ddmin(msg)
+                msg = await self.shorten(msg)
+                smaller = len(msg.SerializePartialToString())
+                self.report(f"{size} -> {smaller} bytes")
+            return msg
+        finally:
+            self.client.close()
+
+    def key(self, status, content, latency):
+        if self.status_only:
+            return (status,)
+        return fingerprint(status, content, latency)[:3]
+
+    async def send(self, serialized):
+        """
+        Return the oracle key of the response to `serialized`
+        """
+        result = self.results.get(serialized)
+        if result is not None:
+            return result
+
+        async with self.slots:
+            self.tests += 1
+            start = time.monotonic()
+            try:
+                r = await self.client.post(self.url, serialized)
+            except Exception as e:
+                result = self.key(type(e).__name__, str(e).encode(), time.monotonic() - start)
+            else:
+                result = self.key(r.status_code, r.content, r.latency)
+
+        self.results[serialized] = result
+        return result
+
+    async def first_passing(self, candidates):
+        """
+        Test the candidate messages at once, return the index of the first one
+        getting the target response, or None
+        """
+        keys = await asyncio.gather(*(self.send(c.SerializePartialToString()) for c in candidates))
+        for i, key in enumerate(keys):
+            if key == self.target:
+                return i
+        return None
+
+    async def ddmin(self, msg):
+        """
+        Return `msg` with the parts of a 1-minimal set of them left
+        """
+        units = removable(msg)
+        if await self.first_passing([remove(msg, units)]) == 0:
+            return remove(msg, units)
+
+        keep = units
+        n = 2
+        while len(keep) >= 2:
+            chunks = split(keep, n)
+            complements = [[u for c in chunks[:i] + chunks[i + 1:] for u in c]
+                           for i in range(n)]
+            # the complements of two chunks are the chunks themselves
+            options = complements if n == 2 else chunks + complements
+
+            kept = [set(o) for o in options]
+            i = await self.first_passing([remove(msg, [u for u in units if u not in k])
+                                          for k in kept])
+            if i is not None:
+                keep = options[i]
+                n = 2 if n == 2 or i < n else max(n - 1, 2)
+                self.report(f"{len(keep)} of {len(units)} parts left")
+            elif n >= len(keep):
+                break
+            else:
+                n = min(2 * n, len(keep))
+
+        keep = set(keep)
+        return remove(msg, [u for u in units if u not in keep])
+
+    async def shorten(self, msg):
+        """
+        Halve the string and bytes values, keeping their first or last half,
+        as long as the response stays the same
+        """
+        slices = {leaf: (0, len(resolve_value(msg, leaf))) for leaf in strings(msg)}
+        active = list(slices)
+        while active:
+            options = [(leaf, half) for leaf in active for half in halves(*slices[leaf])]
+            keys = await asyncio.gather(*(self.send(shorten(msg, {**slices, leaf: half})
+                                                    .SerializePartialToString())
+                                          for (leaf, half) in options))
+            halved = dict()
+            for (leaf, half), key in zip(options, keys):
+                if key == self.target:
+                    halved.setdefault(leaf, half)
+            if not halved:
+                break
+
+            # all the halvings at once, or else the first one, the others
+            # being tried again from there
+            combined = {**slices, **halved}
+            if len(halved) > 1 and await self.first_passing([shorten(msg, combined)]) == 0:
+                shorter = combined
+            else:
+                leaf = next(iter(halved))
+                shorter = {**slices, leaf: halved[leaf]}
+            if shorter == slices:
+                break
+            slices = shorter
+
+            active = [leaf for leaf in halved if slices[leaf][0] < slices[leaf][1]]
+
+        return shorten(msg, slices)
+
+    def report(self, text):
+        if self.log:
+            print(f"[{self.tests} tests] {text}")
+
+__all__ = ["Minimizer", "removable", "remove", "split"]
@@ -0,0 +1,97 @@
+import random
+
+from lib.grammar import symbol_name
+
+class Entry():
+    """
+    A tree of the pool, with its serialized input and, for the wire encoder,
+    the spans of its top level fields (see wire.field_spans)
+    """
+    __slots__ = ('tree', 'serialized', 'spans', 'nodes')
+
+    def __init__(self, tree, serialized=None, spans=None):
+        self.tree = tree
+        self.serialized = serialized
+        self.spans = spans
+        # symbol code -> expanded nonterminal nodes, built when first needed
+        self.nodes = None
+
+    def nodes_by_symbol(self):
+        if self.nodes is None:
+            tree = self.tree
+            start = tree.codes[0]
+            nonterminals = len(tree.g.symbols)
+            self.nodes = dict()
+            for n in tree.subtree(0):
+                code = tree.codes[n]
+                if code < nonterminals and code != start and tree.counts[n] > 0:
+                    self.nodes.setdefault(code, []).append(n)
+        return self.nodes
+
+class TreePool():
+    """
+    Derivation trees (tree.DerivationTree) of the inputs of a vector which got
+    new kinds of responses, the seeds of the mutations. At most `size` trees
+    are kept, a new one replacing a random one past that.
+    """
+
+    def __init__(self, size=1000, rng=random):
+        self.size = size
+        self.rng = rng
+        self.entries = list()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, entry):
+        tree = entry.tree
+        if tree.garbage * 2 > len(tree.codes):
+            # the subtrees replaced by the mutations take most of the tree
+            entry.tree = tree.compacted()
+            entry.nodes = None
+
+        if len(self.entries) < self.size:
+            self.entries.append(entry)
+        else:
+            self.entries[self.rng.randrange(len(self.entries))] = entry
+
+    def choose(self):
+        return self.rng.choice(self.entries)
+
+    def donor(self, code, exclude, tries=8):
+        """
+        Return a (entry, node) of another tree with a subtree of symbol `code`, or None
+        """
+        for _ in range(min(tries, len(self.entries))):
+            entry = self.rng.choice(self.entries)
+            if entry is exclude:
+                continue
+            nodes = entry.nodes_by_symbol().get(code)
+            if nodes:
+                return entry, self.rng.choice(nodes)
+        return None
+
+def choose_node(entry, rng=random):
+    """
+    Return a node of the tree of `entry`, its symbol chosen first among the
+    expanded nonterminals (the start symbol aside), or None if there is none
+    """
+    nodes = entry.nodes_by_symbol()
+    if not nodes:
+        return None
+    return rng.choice(nodes[rng.choice(list(nodes))])
+
+def top_level_field(tree, n):
+    """
+    Return the name of the top level field whose subtree holds node `n`, or
+    None if `n` is the root or one of the helper nodes the fields hang from
+    """
+    field = None
+    while n > 0:
+        symbol = tree.symbol(n)
+        if not symbol.startswith(symbol_name[:-1]):
+            field = symbol[1:-1]
+        n = tree.parents[n]
+    return field
+
+__all__ = ["Entry", "TreePool", "choose_node", "top_level_field"]
@@ -0,0 +1,105 @@
+import json
+import os
+
+import google.protobuf.text_format as tf
+
+from lib import corpus
+from lib import helper
+from lib.triage import fingerprint
+
+def corpus_inputs(source, requests=None):
+    """
+    Yield the (key, vector id, serialized) inputs of `source`: a corpus file
+    (see corpus.write_corpus), a corpus store directory, or a directory of
+    text format messages with a sub-directory per request name. The key
+    identifies the input from one replay to the next.
+    """
+    if os.path.isfile(os.path.join(source, "index")):
+        store = corpus.CorpusStore(source)
+        try:
+            for number, (vector_id, serialized) in enumerate(store.inputs()):
+                yield number, vector_id, serialized
+        finally:
+            store.close()
+
+    elif os.path.isdir(source):
+        yield from text_inputs(source, requests)
+
+    else:
+        for number, (vector_id, serialized) in enumerate(corpus.read_corpus(source)):
+            yield number, vector_id, bytes(serialized)
+
+def text_inputs(source, requests=None):
+    """
+    Yield the messages of a directory of text format messages, the message
+    class of each request being resolved once
+    """
+    services = dict()
+    for i, (url, request, proto) in helper.selected_services(requests):
+        services.setdefault(request, (i, proto))
+    libs = helper.get_proto_libs({proto for (_, proto) in services.values()})
+
+    for request in sorted(os.listdir(source)):
+        directory = os.path.join(source, request)
+        if not os.path.isdir(directory) or request not in services:
+            continue
+        vector_id, proto = services[request]
+        msg_class = getattr(libs[proto], request)
+
+        for name in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, name), "r") as f:
+                msg = tf.Parse(f.read(), msg_class())
+            yield f"{request}/{name}", vector_id, msg.SerializePartialToString()
+
+def result(key, url, status, content, latency):
+    """
+    Return the record of a replayed input
+    """
+    return {
+        'key': key,
+        'url': url,
+        'fingerprint': list(fingerprint(status, content, latency)),
+        'latency': latency,
+    }
+
+def read_results(fname):
+    """
+    Return the records of a previous replay by key
+    """
+    results = dict()
+    with open(fname, "r") as f:
+        for line in f:
+            r = json.loads(line)
+            results[r['key']] = r
+    return results
+
+def diff(previous, current):
+    """
+    Yield the differences between two replays ({key: record}), the latency
+    class aside: inputs which changed fingerprint, are new or are missing
+    """
+    for key, r in current.items():
+        old = previous.get(key)
+        if old is None:
+            yield {'key': key, 'change': 'new', 'fingerprint': r['fingerprint']}
+        elif old['fingerprint'][:3] != r['fingerprint'][:3]:
+            yield {'key': key, 'change': 'changed', 'previous': old['fingerprint'],
+                   'fingerprint': r['fingerprint']}
+
+    for key, old in previous.items():
+        if key not in current:
+            yield {'key': key, 'change': 'missing', 'previous': old['fingerprint']}
+
+def latency_stats(latencies):
+    """
+    Return the mean and percentiles of the latencies
+    """
+    if not latencies:
+        return dict()
+    latencies = sorted(latencies)
+    stats = {'mean': sum(latencies) / len(latencies), 'max': latencies[-1]}
+    for p in (50, 90, 99):
+        stats[f'p{p}'] = latencies[min(len(latencies) - 1, len(latencies) * p // 100)]
+    return stats
+
+__all__ = ["corpus_inputs", "read_results", "diff", "latency_stats"]
@@ -0,0 +1,169 @@
+import json
+import os
+import time
+
+from bisect import bisect_left
+
+# upper bounds (seconds) of the latency histogram buckets, as in Prometheus
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+class Histogram():
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # one count per bound, and one for the larger values
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """
+        Return the (bound, number of values up to it) pairs, the last bound being inf
+        """
+        total = 0
+        result = []
+        for bound, count in zip(self.bounds + [float('inf')], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+class Stats():
+    """
+    Instrumentation of a campaign: time spent and calls per phase (see
+    phase()), per vector counters of the inputs (see count(), eg. generated,
+    discarded, sent, failed) and response latency histograms. Every
+    `interval` seconds a JSON line of the totals is appended to `fname`, and
+    the Prometheus text format file `prometheus` is written again.
+
+    The fuzzers and runners only call it when given one, so the
+    instrumentation costs nothing when off. `requests` maps the vector ids to
+    their request names, for the labels.
+    """
+
+    def __init__(self, fname=None, prometheus=None, interval=10, requests=None):
+        self.fname = fname
+        self.prometheus = prometheus
+        self.interval = interval
+        self.requests = requests or {}
+
+        # phase -> [calls, seconds]
+        self.phases = dict()
+        # (counter, vector id) -> count
+        self.counters = dict()
+        # vector id -> Histogram
+        self.latency = dict()
+
+        self.start = time.monotonic()
+        self.next_write = self.start + interval
+        self.out = open(fname, 'a') if fname else None
+
+    def phase(self, name, start):
+        """
+        Add the time since `start` (from time.monotonic()) to phase `name`,
+        return the current time, the start of the next phase
+        """
+        now = time.monotonic()
+        phase = self.phases.get(name)
+        if phase is None:
+            phase = self.phases[name] = [0, 0.0]
+        phase[0] += 1
+        phase[1] += now - start
+        return now
+
+    def count(self, name, vector_id, n=1):
+        key = (name, vector_id)
+        self.counters[key] = self.counters.get(key, 0) + n
+        self.tick()
+
+    def observe_latency(self, vector_id, latency):
+        histogram = self.latency.get(vector_id)
+        if histogram is None:
+            histogram = self.latency[vector_id] = Histogram()
+        histogram.observe(latency)
+
+    def tick(self):
+        if time.monotonic() >= self.next_write:
+            self.write()
+
+    def snapshot(self):
+        return {
+            'time': time.time(),
+            'elapsed': time.monotonic() - self.start,
+            'phases': {name: {'calls': calls, 'seconds': seconds}
+                       for name, (calls, seconds) in self.phases.items()},
+            'counters': [{'counter': name, 'vector': vector_id,
+                          'request': self.requests.get(vector_id), 'count': count}
+                         for (name, vector_id), count in self.counters.items()],
+            'latency': [{'vector': vector_id, 'request': self.requests.get(vector_id),
+                         'count': h.count, 'sum': h.sum,
+                         'buckets': [[bound if bound != float('inf') else None, count]
+                                     for bound, count in h.cumulative()]}
+                        for vector_id, h in self.latency.items()],
+        }
+
+    def labels(self, vector_id, **extra):
+        labels = {'vector': '' if vector_id is None else vector_id}
+        if vector_id in self.requests:
+            labels['request'] = self.requests[vector_id]
+        labels.update(extra)
+        return '{' + ','.join(f'{k}="{v}"' for k, v in labels.items()) + '}'
+
+    def to_prometheus(self):
+        lines = [
+            "# HELP ppfuzz_phase_seconds_total Time spent in each phase",
+            "# TYPE ppfuzz_phase_seconds_total counter",
+        ]
+        lines += [f'ppfuzz_phase_seconds_total{{phase="{name}"}} {seconds}'
+                  for name, (_, seconds) in self.phases.items()]
+        lines += [
+            "# HELP ppfuzz_phase_calls_total Calls of each phase",
+            "# TYPE ppfuzz_phase_calls_total counter",
+        ]
+        lines += [f'ppfuzz_phase_calls_total{{phase="{name}"}} {calls}'
+                  for name, (calls, _) in self.phases.items()]
+
+        for name in sorted({name for (name, _) in self.counters}):
+            lines += [f"# HELP ppfuzz_{name}_total Inputs {name}, per vector",
+                      f"# TYPE ppfuzz_{name}_total counter"]
+            lines += [f"ppfuzz_{name}_total{self.labels(vector_id)} {count}"
+                      for (n, vector_id), count in self.counters.items() if n == name]
+
+        lines += [
+            "# HELP ppfuzz_latency_seconds Response latency, per vector",
+            "# TYPE ppfuzz_latency_seconds histogram",
+        ]
+        for vector_id, h in self.latency.items():
+            for bound, count in h.cumulative():
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f"ppfuzz_latency_seconds_bucket{self.labels(vector_id, le=le)} {count}")
+            lines.append(f"ppfuzz_latency_seconds_sum{self.labels(vector_id)} {h.sum}")
+            lines.append(f"ppfuzz_latency_seconds_count{self.labels(vector_id)} {h.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """
+        Append the JSON line and write the Prometheus file, now
+        """
+        self.next_write = time.monotonic() + self.interval
+        if self.out:
+            self.out.write(json.dumps(self.snapshot()) + '\n')
+            self.out.flush()
+        if self.prometheus:
+            # replaced at once, for the scrapers reading it meanwhile
+            tmp = f"{self.prometheus}.{os.getpid()}.tmp"
+            with open(tmp, "w") as f:
+                f.write(self.to_prometheus())
+            os.replace(tmp, self.prometheus)
+
+    def close(self):
+        self.write()
+        if self.out:
+            self.out.close()
+            self.out = None
+
+__all__ = ["Stats", "Histogram", "LATENCY_BUCKETS"]
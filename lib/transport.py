@@ -0,0 +1,192 @@
+import asyncio
+import ssl
+import time
+
+from urllib.parse import urlsplit
+
+class TransportError(Exception):
+    pass
+
+class Response():
+
+    def __init__(self, status_code, headers, content, latency):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.latency = latency
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', 'replace')
+
+class Connection():
+    """
+    Persistent HTTP/1.1 connection
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.reusable = True
+
+    @classmethod
+    async def open(cls, scheme, host, port):
+        context = ssl.create_default_context() if scheme == 'https' else None
+        reader, writer = await asyncio.open_connection(host, port, ssl=context)
+        return cls(reader, writer)
+
+    def close(self):
+        self.reusable = False
+        self.writer.close()
+
+    async def post(self, host, path, body):
+        start = time.monotonic()
+
+        head = (f"POST {path} HTTP/1.1\r\n"
+                f"Host: {host}\r\n"
+                "Accept: */*\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                "\r\n")
+        self.writer.write(head.encode('latin-1') + body)
+        await self.writer.drain()
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise TransportError("connection closed by the server")
+        try:
+            version, status, *_ = status_line.decode('latin-1').split(None, 2)
+            status = int(status)
+        except ValueError:
+            raise TransportError(f"invalid status line {status_line!r}")
+
+        headers = dict()
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            content = await self.read_chunked()
+        elif 'content-length' in headers:
+            content = await self.reader.readexactly(int(headers['content-length']))
+        elif status in (204, 304) or 100 <= status < 200:
+            content = b''
+        else:
+            content = await self.reader.read()
+            self.reusable = False
+
+        if headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0':
+            self.reusable = False
+
+        return Response(status, headers, content, time.monotonic() - start)
+
+    async def read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # trailers
+                while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readline()
+
+def remaining(deadline):
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+class ConnectionPool():
+    """
+    Keep-alive connections to one scheme://host:port, at most `size` of them open
+    """
+
+    def __init__(self, url, size):
+        parts = urlsplit(url)
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == 'https' else 80)
+        self.netloc = parts.netloc
+        self.idle = []
+        self.slots = asyncio.Semaphore(size)
+
+    async def post(self, url, body, timeout=None):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        async with self.slots:
+            # one budget for the retry, the connection and the request
+            deadline = None if timeout is None else time.monotonic() + timeout
+
+            if self.idle:
+                # a kept-alive connection may have been closed by the server
+                # meanwhile, in that case retry on a new one
+                try:
+                    return await self.send(self.idle.pop(), path, body, remaining(deadline))
+                except asyncio.TimeoutError:
+                    raise
+                except (OSError, EOFError, TransportError, asyncio.IncompleteReadError):
+                    pass
+
+            conn = await self.connect(remaining(deadline))
+            return await self.send(conn, path, body, remaining(deadline))
+
+    async def connect(self, timeout):
+        """
+        Open a new connection within `timeout`, closing it if the wait ends
+        (timeout or cancellation) just as it was opened
+        """
+        task = asyncio.ensure_future(Connection.open(self.scheme, self.host, self.port))
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except BaseException:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None:
+                task.result().close()
+            raise
+
+    async def send(self, conn, path, body, timeout):
+        try:
+            response = await asyncio.wait_for(conn.post(self.netloc, path, body), timeout)
+        except BaseException:
+            conn.close()
+            raise
+
+        if conn.reusable:
+            self.idle.append(conn)
+        else:
+            conn.close()
+        return response
+
+    def close(self):
+        while self.idle:
+            self.idle.pop().close()
+
+class Client():
+    """
+    HTTP client with a ConnectionPool per scheme://host:port
+    """
+
+    def __init__(self, pool_size=10, timeout=10):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.pools = dict()
+
+    async def post(self, url, body):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        if key not in self.pools:
+            self.pools[key] = ConnectionPool(url, self.pool_size)
+        return await self.pools[key].post(url, body, self.timeout)
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+
+__all__ = ["Client", "ConnectionPool", "Response", "TransportError"]
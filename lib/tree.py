@@ -0,0 +1,239 @@
+from array import array
+
+# children count of a node not expanded yet
+UNEXPANDED = -1
+
+class DerivationTree():
+    """
+    Derivation tree held in parallel arrays instead of nested (symbol, children)
+    tuples. Node n has a symbol code (see CompiledGrammar.code), the index of
+    its first child, its number of children (UNEXPANDED if it still has to
+    be expanded) and its parent; the children of a node are contiguous. Node 0
+    is the root. Nodes replaced by graft() stay in the arrays, unreachable,
+    until the tree is copied.
+
+    node() returns a node as a (symbol, children) tuple, the children being a
+    Children sequence creating the tuples of the child nodes on access, and
+    the tree itself unpacks as its root. So the functions walking tuple trees
+    (tree_helper, Builder, WireEncoder, ...) take it as it is, while the tree
+    only holds four integers per node.
+    """
+
+    def __init__(self, g, symbol=None):
+        self.g = g
+        self.names = g.names
+        self.codes = array('i')
+        self.first = array('i')
+        self.counts = array('i')
+        self.parents = array('i')
+        # unreachable nodes
+        self.garbage = 0
+        self.append(g.start_symbol if symbol is None else symbol, None, -1)
+
+    def append(self, symbol, children, parent):
+        """
+        Add an unexpanded node, or a terminal one if `children` is empty, return its index
+        """
+        nonterminal = children is None or len(children) > 0 or symbol in self.g.ids
+        self.codes.append(self.g.code(symbol, nonterminal))
+        self.first.append(0)
+        self.counts.append(UNEXPANDED if children is None else 0)
+        self.parents.append(parent)
+        return len(self.codes) - 1
+
+    def expand(self, n, children):
+        """
+        Set the children of node `n`, a list of (symbol, children) tuples
+        or views, which may be expanded further
+        """
+        stack = [(n, children)]
+        while stack:
+            n, children = stack.pop()
+            first = len(self.codes)
+            self.first[n] = first
+            self.counts[n] = len(children)
+            for (symbol, c) in children:
+                self.append(symbol, c, n)
+            for (i, (_, c)) in enumerate(children):
+                if c:
+                    stack.append((first + i, c))
+
+    def graft(self, n, donor, m):
+        """
+        Replace the subtree of node `n` by a copy of the subtree of node `m`
+        of `donor`, another tree of the same grammar
+        """
+        if self.counts[n] != UNEXPANDED:
+            self.garbage += self.size(n) - 1
+        self.codes[n] = donor.codes[m]
+
+        stack = [(n, m)]
+        while stack:
+            n, m = stack.pop()
+            count = donor.counts[m]
+            self.counts[n] = count
+            if count <= 0:
+                continue
+
+            first = len(self.codes)
+            self.first[n] = first
+            start = donor.first[m]
+            self.codes.extend(donor.codes[start:start + count])
+            self.counts.extend(donor.counts[start:start + count])
+            self.first.extend(array('i', bytes(4 * count)))
+            self.parents.extend(array('i', [n]) * count)
+            stack.extend((first + i, start + i) for i in range(count))
+
+    def compacted(self):
+        """
+        Return a copy of the tree without its unreachable nodes, renumbered
+        """
+        tree = DerivationTree(self.g, self.symbol(0))
+        tree.graft(0, self, 0)
+        return tree
+
+    def copy(self):
+        """
+        Return a copy of the tree, with the same node numbers
+        """
+        tree = DerivationTree.__new__(DerivationTree)
+        tree.g = self.g
+        tree.names = self.names
+        tree.codes = array('i', self.codes)
+        tree.first = array('i', self.first)
+        tree.counts = array('i', self.counts)
+        tree.parents = array('i', self.parents)
+        tree.garbage = self.garbage
+        return tree
+
+    def subtree(self, n):
+        """
+        Yield the nodes of the subtree of node `n`, parents first
+        """
+        counts, firsts = self.counts, self.first
+        stack = [n]
+        while stack:
+            n = stack.pop()
+            yield n
+            if counts[n] > 0:
+                stack.extend(range(firsts[n], firsts[n] + counts[n]))
+
+    def size(self, n=0):
+        return sum(1 for _ in self.subtree(n))
+
+    def symbol(self, n):
+        return self.names[self.codes[n]]
+
+    def node(self, n):
+        return (self.names[self.codes[n]], self.children(n))
+
+    def children(self, n):
+        count = self.counts[n]
+        if count == UNEXPANDED:
+            return None
+        return Children(self, self.first[n], count)
+
+    def unexpanded(self):
+        """
+        Number of nodes still to be expanded
+        """
+        return self.counts.count(UNEXPANDED)
+
+    def __len__(self):
+        return 2
+
+    def __getitem__(self, i):
+        return self.node(0)[i]
+
+    def __iter__(self):
+        yield self.symbol(0)
+        yield self.children(0)
+
+    def __repr__(self):
+        return repr(self.to_tuples())
+
+    def to_tuples(self, n=0):
+        """
+        Return the subtree of node `n` as nested (symbol, children) tuples
+        """
+        root = (self.symbol(n), None if self.counts[n] == UNEXPANDED else [])
+        stack = [(n, root[1])]
+        while stack:
+            n, children = stack.pop()
+            first = self.first[n]
+            for m in range(first, first + self.counts[n]):
+                child = (self.symbol(m), None if self.counts[m] == UNEXPANDED else [])
+                children.append(child)
+                if child[1] is not None:
+                    stack.append((m, child[1]))
+        return root
+
+    @classmethod
+    def from_tuples(cls, g, tree):
+        """
+        Create a DerivationTree from nested (symbol, children) tuples
+        """
+        symbol, children, *_ = tree
+        self = cls(g, symbol)
+        if children:
+            self.expand(0, children)
+        elif children is not None:
+            self.counts[0] = 0
+        return self
+
+class Children():
+    """
+    Sequence of the children of a node of a DerivationTree
+    """
+    __slots__ = ('tree', 'first', 'count')
+
+    def __init__(self, tree, first, count):
+        self.tree = tree
+        self.first = first
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        tree = self.tree
+        n = self.first + i
+        count = tree.counts[n]
+        return (tree.names[tree.codes[n]],
+                None if count == UNEXPANDED else Children(tree, tree.first[n], count))
+
+    def __iter__(self):
+        tree = self.tree
+        names, codes, firsts, counts = tree.names, tree.codes, tree.first, tree.counts
+        for n in range(self.first, self.first + self.count):
+            count = counts[n]
+            yield (names[codes[n]],
+                   None if count == UNEXPANDED else Children(tree, firsts[n], count))
+
+class Selection():
+    """
+    Sequence of some children of a node, by position
+    """
+    __slots__ = ('tree', 'first', 'positions')
+
+    def __init__(self, tree, first, positions):
+        self.tree = tree
+        self.first = first
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        return self.tree.node(self.first + self.positions[i])
+
+    def __iter__(self):
+        node = self.tree.node
+        for i in self.positions:
+            yield node(self.first + i)
+
+__all__ = ["DerivationTree", "Children", "Selection", "UNEXPANDED"]
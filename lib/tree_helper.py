@@ -2,6 +2,7 @@ import re
 import os
 
 from lib.grammar import is_nonterminal, symbol_name
+from lib.inject_const import *
 
 def unicode_escape(s, error="backslashreplace"):
     """
@@ -52,19 +53,21 @@ def display_tree(derivation_tree,
     # If we import display_tree, we also have to import its functions
     from graphviz import Digraph
 
-    counter = 0
-
-    def traverse_tree(dot, tree, id=0):
-        (symbol, children, annotation) = extract_node(tree, id)
-        node_attr(dot, id, symbol, annotation)
-
-        if children:
-            for child in children:
-                nonlocal counter
-                counter += 1
-                child_id = counter
-                edge_attr(dot, id, child_id)
-                traverse_tree(dot, child, child_id)
+    def traverse_tree(dot, tree):
+        # nodes are numbered in depth-first order, each one with the edge from its parent
+        counter = 0
+        stack = [(tree, None)]
+        while stack:
+            tree, parent = stack.pop()
+            id = counter
+            counter += 1
+            if parent is not None:
+                edge_attr(dot, parent, id)
+
+            (symbol, children, annotation) = extract_node(tree, id)
+            node_attr(dot, id, symbol, annotation)
+            if children:
+                stack.extend((child, id) for child in reversed(children))
 
     dot = Digraph(comment="Derivation Tree")
     graph_attr(dot)
@@ -104,23 +107,37 @@ def display_annotated_tree(tree, a_nodes, a_edges, log=False):
 
 
 def all_terminals(tree):
-    (symbol, children) = tree
-    if children is None:
-        # This is a nonterminal symbol not expanded yet
-        return symbol
-
-    if len(children) == 0:
-        # This is a terminal symbol
-        return symbol
-
-    # This is an expanded symbol:
-    # Concatenate all terminal symbols from all children
-    return ''.join([all_terminals(c) for c in children])
+    """
+    Concatenate the terminal symbols of the tree, and the nonterminals not expanded yet
+    """
+    result = []
+    stack = [tree]
+    while stack:
+        (symbol, children) = stack.pop()
+        if children:
+            # an expanded symbol
+            stack.extend(reversed(children))
+        else:
+            # a terminal symbol, or a nonterminal symbol not expanded yet
+            result.append(symbol)
+    return ''.join(result)
 
 
 def tree_to_gpb(tree):
-    
-    result = str()
+    chunks, *_ = tree_to_chunks(tree)
+    return ''.join(chunks)
+
+def tree_to_chunks(tree):
+    """
+    Render the tree as a protobuf text message, split into a list of chunks.
+    Every payload placeholder is a chunk of its own. Also return the indexes
+    of these chunks by placeholder type, and an index of the fields:
+    (path, first chunk, end chunk, value chunk, placeholder type) tuples,
+    the value chunk being None for messages and the type None for enums.
+    """
+    result = list()
+    slots = {t: [] for t in INJECT_TYPES}
+    fields = list()
 
     def next_leaf(node):
         """
@@ -136,34 +153,127 @@ def tree_to_gpb(tree):
         """
         return node[1][0][0]
 
-    def traverse(tree):
+    def traverse(tree, path):
         """
-        Traverse the tree and return a protobuf message
+        Traverse the tree and return a protobuf message. The stack holds the
+        iterators over the children left to visit with their path, and the
+        messages to close, as (None, path, first chunk), once their fields are done.
         """
-        nonlocal result
-
         symbol, children, *_ = tree
+        stack = [(iter(children or ()), path, None)]
+
+        while stack:
+            children, path, start = stack.pop()
+            if children is None:
+                result.append("}" + "\n")
+                fields.append((path, start, len(result), None, None))
+                continue
 
-        if children:
             for c in children:
-                if c[0].startswith("<"):
-                    if not c[0].startswith(symbol_name[:-1]):
-                        if next_leaf(c):
-                            result += c[0].replace("<", "").replace(">", ": ") + next_leaf_content(c) + "\n"
-                        else:
-                            result += c[0].replace("<", "").replace(">", "") + " {" + "\n"
-                            traverse(c)
-                            result += "}" + "\n"
-                    else:
-                        traverse(c) # do not update anything, just traverse
-
-    traverse(tree)
-    return result
+                if not c[0].startswith("<"):
+                    continue
+                if c[0].startswith(symbol_name[:-1]):
+                    # do not update anything, just traverse
+                    stack.append((children, path, None))
+                    stack.append((iter(c[1] or ()), path, None))
+                    break
+
+                name = c[0][1:-1]
+                start = len(result)
+                if next_leaf(c):
+                    content = next_leaf_content(c)
+                    inj_type = content if content in slots else None
+                    result.append(name + ": ")
+                    if inj_type:
+                        slots[inj_type].append(len(result))
+                    result.append(content)
+                    result.append("\n")
+                    fields.append((path + (name,), start, len(result), start + 1, inj_type))
+                else:
+                    result.append(name + " {" + "\n")
+                    stack.append((children, path, None))
+                    stack.append((None, path + (name,), start))
+                    stack.append((iter(c[1]), path + (name,), None))
+                    break
+
+    traverse(tree, ())
+    return result, slots, fields
 
 def tree_to_string(tree):
-    symbol, children, *_ = tree
-    if children:
-        return ''.join(tree_to_string(c) for c in children)
-    else:
-        return '' if is_nonterminal(symbol) else symbol
+    result = []
+    stack = [tree]
+    while stack:
+        symbol, children, *_ = stack.pop()
+        if children:
+            stack.extend(reversed(children))
+        elif not is_nonterminal(symbol):
+            result.append(symbol)
+    return ''.join(result)
 
+def message_to_tree(g, msg, symbol):
+    """
+    Return the derivation tree of the protobuf message `msg` from `symbol` of
+    the compiled grammar `g` of gpb_to_ebnf(), the payloads being placeholders
+    again. Raise ValueError if the grammar cannot derive the message, eg. with
+    no element in a repeated field (the grammar repeats them at least once)
+    """
+    root = (symbol, [])
+    # (children to fill, message symbol, message)
+    stack = [(root[1], symbol, msg)]
+    while stack:
+        children, symbol, msg = stack.pop()
+        fields = msg.DESCRIPTOR.fields_by_name
+        values = {f'<{field.name}>': value if field.label == field.LABEL_REPEATED else [value]
+                  for field, value in msg.ListFields()}
+
+        def field_node(field_symbol, value):
+            field = fields[field_symbol[1:-1]]
+            if field.type == field.TYPE_MESSAGE:
+                node = (field_symbol, [])
+                stack.append((node[1], field_symbol, value))
+                return node
+            expansions = g.templates[g.ids[field_symbol]]
+            if field.type == field.TYPE_ENUM:
+                value = field.enum_type.values_by_number.get(value)
+                if value is None or ((value.name, False),) not in expansions:
+                    raise ValueError(f"{field_symbol}: unknown enum value")
+                return (field_symbol, [(value.name, [])])
+            # the placeholder of the payload
+            return (field_symbol, [(expansions[0][0][0], [])])
+
+        for item, _ in g.templates[g.ids[symbol]][0]:
+            if not item.startswith(symbol_name[:-1]):
+                # a required field
+                occurrences = values.get(item, [])
+                if len(occurrences) != 1:
+                    raise ValueError(f"{item}: {len(occurrences)} values of a required field")
+                children.append(field_node(item, occurrences[0]))
+                continue
+
+            # (<field>)? is "" | <group>, (<field>)+ is <group> | <group><item>
+            expansions = g.templates[g.ids[item]]
+            group = next(s for template in expansions for (s, nonterminal) in template
+                         if nonterminal and s != item)
+            field_symbol = group
+            if group.startswith(symbol_name[:-1]):
+                field_symbol = g.templates[g.ids[group]][0][0][0]
+            occurrences = values.get(field_symbol, [])
+
+            def group_node(value):
+                node = field_node(field_symbol, value)
+                return (group, [node]) if group != field_symbol else node
+
+            if (("", False),) in expansions:
+                if len(occurrences) > 1:
+                    raise ValueError(f"{field_symbol}: {len(occurrences)} values of an optional field")
+                children.append((item, [group_node(occurrences[0])] if occurrences
+                                       else [("", [])]))
+            else:
+                if not occurrences:
+                    raise ValueError(f"{field_symbol}: no value of a repeated field")
+                # the chain of repetitions, from the last one
+                node = (item, [group_node(occurrences[-1])])
+                for value in reversed(occurrences[:-1]):
+                    node = (item, [group_node(value), node])
+                children.append(node)
+    return root
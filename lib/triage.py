@@ -0,0 +1,162 @@
+import base64
+import hashlib
+import json
+import re
+import time
+
+# upper bounds (seconds) of the latency classes, slower responses are in the last one
+LATENCY_CLASSES = [0.1, 1.0, 5.0]
+
+# only the start of the bodies is hashed
+NORMALIZE_LIMIT = 1 << 16
+
+# parts of a body which change from one response to the next: uuids, long hex
+# strings (ids, addresses) and numbers (timestamps, lengths, line numbers)
+RE_VOLATILE = re.compile(rb'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'
+                         rb'|(?:0x)?[0-9a-fA-F]{16,}'
+                         rb'|\d+')
+
+def length_class(length):
+    """
+    Powers of two: 0, 1, 2-3, 4-7, ...
+    """
+    return length.bit_length()
+
+def latency_class(latency):
+    for i, bound in enumerate(LATENCY_CLASSES):
+        if latency < bound:
+            return i
+    return len(LATENCY_CLASSES)
+
+def body_hash(content):
+    normalized = RE_VOLATILE.sub(b'0', content[:NORMALIZE_LIMIT])
+    return hashlib.blake2b(normalized, digest_size=8).hexdigest()
+
+def fingerprint(status, content, latency):
+    """
+    Return the bucket of a response: status code (or error name), length
+    class, hash of the normalized body and latency class
+    """
+    return (status, length_class(len(content)), body_hash(content), latency_class(latency))
+
+def fingerprint_id(key):
+    """
+    Return a 63-bit hash of a fingerprint, the same in every run (unlike the
+    bucket numbers, given in the order the buckets are found)
+    """
+    digest = hashlib.blake2b(json.dumps(list(key)).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') >> 1
+
+class Triage():
+    """
+    Bucket the responses by fingerprint and count them, instead of printing
+    every one of them. The first `examples` responses of each bucket are
+    written to the JSON lines file `fname`, with the input which caused them.
+
+    At most `max_buckets` buckets are kept; the responses of any further
+    bucket are only counted as 'overflow', so the memory stays bounded.
+    """
+
+    def __init__(self, fname=None, examples=3, max_buckets=100000, body_limit=4096, log=True):
+        self.fname = fname
+        self.examples = examples
+        self.max_buckets = max_buckets
+        self.body_limit = body_limit
+        self.log = log
+
+        # fingerprint -> [bucket number, count, examples written]
+        self.buckets = dict()
+        self.numbered = list()
+        # fingerprint_id() of each bucket, by number
+        self.ids = list()
+        self.total = 0
+        self.overflow = 0
+        self.out = open(fname, 'a') if fname else None
+
+    def add(self, url, serialized, status, headers, content, latency):
+        """
+        Count a response, return its bucket number (None if over max_buckets)
+        """
+        self.total += 1
+        key = fingerprint(status, content, latency)
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_buckets:
+                self.overflow += 1
+                return None
+            bucket = self.buckets[key] = [len(self.buckets), 0, 0]
+            self.numbered.append(bucket)
+            self.ids.append(fingerprint_id(key))
+            if self.log:
+                print(f"New bucket #{bucket[0]}: status {status}, length class {key[1]}, "
+                      f"latency class {key[3]}, {url}")
+
+        bucket[1] += 1
+        if bucket[2] < self.examples and self.out:
+            bucket[2] += 1
+            self.write_example(bucket[0], key, url, serialized, headers, content, latency)
+        return bucket[0]
+
+    def is_new(self, number):
+        """
+        True if bucket `number` holds a single response, the one just added
+        """
+        return number is not None and self.numbered[number][1] == 1
+
+    def bucket_id(self, number):
+        """
+        Return the fingerprint_id() of bucket `number`, None for None
+        """
+        return None if number is None else self.ids[number]
+
+    def add_response(self, url, serialized, response):
+        """
+        Count a transport.Response, or a requests one
+        """
+        latency = getattr(response, 'latency', None)
+        if latency is None:
+            latency = response.elapsed.total_seconds()
+        return self.add(url, serialized, response.status_code, dict(response.headers),
+                        response.content, latency)
+
+    def add_error(self, url, serialized, error, latency=0.0):
+        """
+        Count a failed request, the name of the exception standing for the status
+        """
+        return self.add(url, serialized, type(error).__name__, {}, str(error).encode(), latency)
+
+    def write_example(self, number, key, url, serialized, headers, content, latency):
+        record = {
+            'bucket': number,
+            'fingerprint': list(key),
+            'id': self.ids[number],
+            'time': time.time(),
+            'url': url,
+            'input': base64.b64encode(serialized).decode(),
+            'status': key[0],
+            'latency': latency,
+            'headers': headers,
+            'length': len(content),
+            'body': content[:self.body_limit].decode('utf-8', 'replace'),
+        }
+        self.out.write(json.dumps(record) + '\n')
+        self.out.flush()
+
+    def summary(self):
+        """
+        Return the buckets as dicts, the most frequent first
+        """
+        result = [{'bucket': number, 'id': self.ids[number], 'status': key[0],
+                   'length_class': key[1], 'body_hash': key[2], 'latency_class': key[3],
+                   'count': count}
+                  for key, (number, count, _) in self.buckets.items()]
+        result.sort(key=lambda b: -b['count'])
+        return result
+
+    def close(self):
+        if self.out:
+            self.out.close()
+            self.out = None
+
+__all__ = ["Triage", "fingerprint", "fingerprint_id", "LATENCY_CLASSES"]
@@ -0,0 +1,134 @@
+import random
+import string
+
+from array import array
+from itertools import accumulate
+
+from lib.inject_const import *
+
+# alphabets of the random strings and bytes, all of them single byte characters
+ALPHABETS = {
+    'alnum': string.digits + string.ascii_letters,
+    'printable': string.digits + string.ascii_letters + "!#$%&'()*+,-./:;<=>?@[]^_`{|}~ \t\x0c",
+    'bytes': ''.join(map(chr, range(0x100))),
+}
+
+# low bit of each byte, for the bools
+BOOL_TABLE = bytes(b & 1 for b in range(0x100))
+
+class Ring():
+    """
+    Values created `size` at a time by fill(size), and handed out one by one
+    """
+
+    def __init__(self, fill, size):
+        self.fill = fill
+        self.size = size
+        self.values = iter(())
+
+    def __call__(self):
+        try:
+            return next(self.values)
+        except StopIteration:
+            self.values = iter(self.fill(self.size))
+            return next(self.values)
+
+    def clear(self):
+        self.values = iter(())
+
+class BatchValues():
+    """
+    Payload values generated in blocks instead of one random call per value
+    (or per character): random bytes come from a single getrandbits() call and
+    are mapped to the alphabet with bytes.translate(). The random module is
+    still the only source, so the values follow random.seed().
+
+    `int32` and `int64` are the boundary values to pick from. `lengths` of
+    the strings and bytes is either a (min, max) range, picked uniformly, or
+    a {length: weight} dict.
+    """
+
+    def __init__(self, int32, int64, alphabet=ALPHABETS['alnum'], lengths=(0, 20),
+                 size=1024, rng=random):
+        self.int32 = [int(x) for x in int32]
+        self.int64 = [int(x) for x in int64]
+        self.lengths = lengths
+        self.rng = rng
+
+        alphabet = ALPHABETS.get(alphabet, alphabet)
+        if not alphabet or max(map(ord, alphabet)) > 0xff:
+            raise ValueError("the alphabet must be made of 1 to 256 single byte characters")
+
+        # random bytes past the last multiple of the alphabet size are dropped,
+        # so every character is equally likely
+        codes = alphabet.encode('latin-1')
+        limit = 0x100 - 0x100 % len(codes)
+        self.table = bytes(codes[b % len(codes)] for b in range(0x100))
+        self.reject = bytes(range(limit, 0x100))
+
+        self.rings = {
+            INJECT_INT32: Ring(self.fill_int32, size),
+            INJECT_INT64: Ring(self.fill_int64, size),
+            INJECT_BOOL: Ring(self.fill_bool, size),
+            INJECT_STRING: Ring(self.fill_string, size),
+            INJECT_BYTES: Ring(self.fill_bytes, size),
+        }
+
+    def sources(self):
+        """
+        Return the value source of each payload type, as Fuzzer.value_sources()
+        """
+        return dict(self.rings)
+
+    def clear(self):
+        """
+        Drop the values generated so far, eg. after reseeding random
+        """
+        for ring in self.rings.values():
+            ring.clear()
+
+    def random_bytes(self, n):
+        # randbytes() is only there from Python 3.9, and does the same
+        return self.rng.getrandbits(8 * n).to_bytes(n, 'little') if n else b''
+
+    def indexes(self, n, bound):
+        """
+        Return `n` random integers in [0, bound)
+        """
+        return [x % bound for x in array('Q', self.random_bytes(8 * n))]
+
+    def random_chars(self, n):
+        chars = bytearray()
+        while len(chars) < n:
+            chars += self.random_bytes(n - len(chars) + 16).translate(self.table, self.reject)
+        return bytes(chars[:n])
+
+    def random_lengths(self, n):
+        if isinstance(self.lengths, dict):
+            return self.rng.choices(list(self.lengths), list(self.lengths.values()), k=n)
+        lo, hi = self.lengths
+        return [lo + x for x in self.indexes(n, hi - lo + 1)]
+
+    def fill_int32(self, n):
+        values = self.int32
+        return [values[i] for i in self.indexes(n, len(values))]
+
+    def fill_int64(self, n):
+        values = self.int64
+        return [values[i] for i in self.indexes(n, len(values))]
+
+    def fill_bool(self, n):
+        return list(self.random_bytes(n).translate(BOOL_TABLE))
+
+    def split(self, chars, lengths):
+        return [chars[end - length:end] for (length, end) in zip(lengths, accumulate(lengths))]
+
+    def fill_bytes(self, n):
+        lengths = self.random_lengths(n)
+        return self.split(self.random_chars(sum(lengths)), lengths)
+
+    def fill_string(self, n):
+        lengths = self.random_lengths(n)
+        return self.split(self.random_chars(sum(lengths)).decode('latin-1'), lengths)
+
+__all__ = ["BatchValues", "Ring", "ALPHABETS"]
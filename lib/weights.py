@@ -0,0 +1,127 @@
+import json
+import os
+import random
+
+class WeightTable():
+    """
+    Weights of n items in a Fenwick tree: updating a weight and sampling an
+    item in proportion to its weight both take O(log n)
+    """
+
+    def __init__(self, weights):
+        self.n = len(weights)
+        self.weights = list(weights)
+        self.tree = [0.0] * (self.n + 1)
+        for i, w in enumerate(self.weights):
+            self.add(i, w)
+
+        self.top = 1
+        while self.top * 2 <= self.n:
+            self.top *= 2
+
+    def add(self, i, delta):
+        i += 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def __getitem__(self, i):
+        return self.weights[i]
+
+    def __setitem__(self, i, w):
+        self.add(i, w - self.weights[i])
+        self.weights[i] = w
+
+    def __len__(self):
+        return self.n
+
+    def total(self):
+        total = 0.0
+        i = self.n
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def sample(self, rng=random):
+        """
+        Return an index, picked in proportion to the weights
+        """
+        target = rng.random() * self.total()
+        pos = 0
+        step = self.top
+        while step:
+            if pos + step <= self.n and self.tree[pos + step] <= target:
+                pos += step
+                target -= self.tree[pos]
+            step //= 2
+        # rounding may point past the last item with a positive weight
+        while pos >= self.n or self.weights[pos] <= 0:
+            pos -= 1
+        return pos
+
+class ExpansionWeights():
+    """
+    Weights of the expansions of every symbol, per request, starting at 1.
+    The expansions used by an input which got a novel response are rewarded,
+    the others decay back to 1. The weights are saved as JSON in `fname`,
+    by request and symbol; those not matching the grammar any more are dropped.
+    """
+
+    def __init__(self, fname=None, reward=1.0, decay=0.99, max_weight=100.0):
+        self.fname = fname
+        self.reward = reward
+        self.decay = decay
+        self.max_weight = max_weight
+        # request -> symbol id -> WeightTable
+        self.tables = dict()
+        self.symbols = dict()
+        self.saved = dict()
+
+        if fname and os.path.exists(fname):
+            with open(fname, "r") as f:
+                self.saved = json.load(f)
+
+    def table(self, vector, symbol_id):
+        tables = self.tables.setdefault(vector['request'], dict())
+        table = tables.get(symbol_id)
+        if table is None:
+            g = vector['grammar']
+            self.symbols[vector['request']] = g.symbols
+            n = len(g.expansions[symbol_id])
+            weights = self.saved.get(vector['request'], {}).get(g.symbols[symbol_id])
+            if weights is None or len(weights) != n:
+                weights = [1.0] * n
+            table = tables[symbol_id] = WeightTable(weights)
+        return table
+
+    def choose(self, vector, symbol_id, rng=random):
+        return self.table(vector, symbol_id).sample(rng)
+
+    def update(self, vector, expansions, novel):
+        """
+        Reward (or decay) the (symbol id, expansion index) pairs used by an input
+        """
+        for symbol_id, index in set(expansions):
+            table = self.table(vector, symbol_id)
+            w = table[index]
+            if novel:
+                w = min(self.max_weight, w + self.reward)
+            else:
+                w = 1.0 + (w - 1.0) * self.decay
+            table[index] = w
+
+    def save(self):
+        if not self.fname:
+            return
+        for request, tables in self.tables.items():
+            saved = self.saved.setdefault(request, dict())
+            for symbol_id, table in tables.items():
+                saved[self.symbols[request][symbol_id]] = table.weights
+
+        tmp = f"{self.fname}.{os.getpid()}"
+        with open(tmp, "w") as f:
+            json.dump(self.saved, f)
+        os.replace(tmp, self.fname)
+
+__all__ = ["WeightTable", "ExpansionWeights"]
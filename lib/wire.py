@@ -0,0 +1,433 @@
+import random
+
+from google.protobuf.descriptor import FieldDescriptor as fd
+
+from lib.builder import BuildError, convert
+from lib.grammar import symbol_name
+from lib.inject import FieldKeys
+
+WIRETYPE_VARINT = 0
+WIRETYPE_FIXED64 = 1
+WIRETYPE_LENGTH_DELIMITED = 2
+WIRETYPE_START_GROUP = 3
+WIRETYPE_END_GROUP = 4
+WIRETYPE_FIXED32 = 5
+
+WIRE_TYPES = {
+    fd.TYPE_INT32: WIRETYPE_VARINT,
+    fd.TYPE_INT64: WIRETYPE_VARINT,
+    fd.TYPE_BOOL: WIRETYPE_VARINT,
+    fd.TYPE_ENUM: WIRETYPE_VARINT,
+    fd.TYPE_STRING: WIRETYPE_LENGTH_DELIMITED,
+    fd.TYPE_BYTES: WIRETYPE_LENGTH_DELIMITED,
+    fd.TYPE_MESSAGE: WIRETYPE_LENGTH_DELIMITED,
+}
+
+MASK64 = (1 << 64) - 1
+MAX_FIELD_NUMBER = (1 << 29) - 1
+OVERSIZED_LENGTHS = [(1 << 31) - 1, (1 << 32) - 1, MASK64]
+
+# Malformed encodings the Mutator can choose from, per field
+MUTATIONS = [
+    "overlong_varint",  # varint padded with 0x80 bytes, possibly over 10 bytes
+    "truncated_varint", # continuation bit set on the last varint byte
+    "wrong_wire_type",  # tag with a different (possibly invalid) wire type
+    "bad_length",       # length prefix off by a few bytes
+    "oversized_length", # length prefix far beyond the end of the message
+    "duplicate_field",  # the field is written twice
+    "unknown_field",    # a field number missing from the descriptor is added
+    "truncate",         # the message is cut inside the field
+]
+
+def varint_size(value):
+    size = 1
+    while value > 0x7f:
+        value >>= 7
+        size += 1
+    return size
+
+def encode_varint(value):
+    value &= MASK64
+    result = bytearray()
+    while value > 0x7f:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+def decode_varint(data, pos=0):
+    """
+    Return the varint at `pos` and the position following it
+    """
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(data) or shift > 63:
+            raise ValueError("truncated or too long varint")
+        b = data[pos]
+        result |= (b & 0x7f) << shift
+        pos += 1
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+def field_spans(data):
+    """
+    Return the (start, end) positions of the fields of a serialized message
+    by field number, the fields of a number being contiguous as written by
+    the WireEncoder (without mutator)
+    """
+    spans = dict()
+    pos = 0
+    while pos < len(data):
+        start = pos
+        tag, pos = decode_varint(data, pos)
+        wire_type = tag & 7
+        if wire_type == WIRETYPE_VARINT:
+            _, pos = decode_varint(data, pos)
+        elif wire_type == WIRETYPE_FIXED64:
+            pos += 8
+        elif wire_type == WIRETYPE_LENGTH_DELIMITED:
+            n, pos = decode_varint(data, pos)
+            pos += n
+        elif wire_type == WIRETYPE_FIXED32:
+            pos += 4
+        else:
+            raise ValueError(f"unexpected wire type {wire_type}")
+        if pos > len(data):
+            raise ValueError("truncated field")
+
+        span = spans.get(tag >> 3)
+        spans[tag >> 3] = (start if span is None else span[0], pos)
+    return spans
+
+def splice_field(data, spans, number, encoded):
+    """
+    Replace the fields `number` of a serialized message by `encoded`, the
+    spans being those of field_spans()
+    """
+    span = spans.get(number)
+    if span is None:
+        # insert after the fields of lower numbers
+        end = max((end for (n, (_, end)) in spans.items() if n < number), default=0)
+        span = (end, end)
+    return data[:span[0]] + encoded + data[span[1]:]
+
+def is_packed(field):
+    if field.label != fd.LABEL_REPEATED or WIRE_TYPES.get(field.type) != WIRETYPE_VARINT:
+        return False
+    options = field.GetOptions()
+    if options.HasField('packed'):
+        return options.packed
+    return field.file.syntax == 'proto3'
+
+def has_presence(field):
+    """
+    False for proto3 singular scalars, which are not serialized with their default value
+    """
+    if field.label == fd.LABEL_REPEATED:
+        return False
+    return (field.file.syntax != 'proto3'
+            or field.type == fd.TYPE_MESSAGE
+            or field.containing_oneof is not None)
+
+class Mutator():
+    """
+    Choose the malformed encodings produced by the WireEncoder. Each field is
+    mutated with probability `rate`, using one of `mutations`.
+    """
+
+    def __init__(self, rate=0.05, mutations=MUTATIONS, rng=random):
+        self.rate = rate
+        self.mutations = list(mutations)
+        self.rng = rng
+
+    def __getstate__(self):
+        # the random module stays the one of the process (eg. a spawned worker)
+        state = dict(self.__dict__)
+        if state['rng'] is random:
+            state['rng'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.rng is None:
+            self.rng = random
+
+    def choose(self):
+        if self.rate and self.rng.random() < self.rate:
+            return self.rng.choice(self.mutations)
+        return None
+
+class WireEncoder():
+    """
+    Encode a derivation tree straight to protobuf wire format, in a buffer
+    which is allocated once and reused. Fields are written in field number
+    order, so without a mutator the result equals SerializeToString() of the
+    same message.
+    """
+
+    def __init__(self, size=4096, mutator=None):
+        self.buf = bytearray(size)
+        self.pos = 0
+        self.mutator = mutator
+
+    def encode(self, tree, descriptor, values, replace={}, delete=[], field_sources={},
+               only=None):
+        """
+        Return the serialized message. `values` maps the payload placeholders
+        to functions returning the values, `field_sources` maps field keys to
+        functions of the placeholder type. If `only` is set, only the top
+        level fields of these numbers are encoded (see splice_field).
+        """
+        self.pos = 0
+        self.cut = None
+        self.values = values
+        self.replace = replace
+        self.replace_keys = FieldKeys(replace)
+        self.delete = FieldKeys(delete)
+        self.field_sources = field_sources
+        self.field_keys = FieldKeys(field_sources)
+
+        self.encode_message(tree, descriptor, (), only)
+
+        end = self.pos if self.cut is None else self.cut
+        return bytes(memoryview(self.buf)[:end])
+
+    def ensure(self, n):
+        if self.pos + n > len(self.buf):
+            self.buf.extend(bytes(max(len(self.buf), n)))
+
+    def message_fields(self, tree, descriptor):
+        """
+        Return the (field, node) pairs of a message node, in field number order
+        """
+        fields = []
+        stack = [iter(tree[1])]
+        while stack:
+            for c in stack[-1]:
+                if not c[0].startswith("<"):
+                    continue
+                if c[0].startswith(symbol_name[:-1]):
+                    stack.append(iter(c[1]))
+                    break
+
+                field = descriptor.fields_by_name.get(c[0][1:-1])
+                if field is None:
+                    raise BuildError(f"{descriptor.name} has no field {c[0][1:-1]}")
+                fields.append((field, c))
+            else:
+                stack.pop()
+
+        fields.sort(key=lambda f: f[0].number)
+        return fields
+
+    def encode_message(self, tree, descriptor, path, only=None):
+        fields = self.message_fields(tree, descriptor)
+        if only is not None:
+            fields = [f for f in fields if f[0].number in only]
+
+        i = 0
+        while i < len(fields) and self.cut is None:
+            field, node = fields[i]
+            i += 1
+            field_path = path + (field.name,)
+            if self.delete.match(field_path) is not None:
+                continue
+
+            mutation = self.mutator.choose() if self.mutator else None
+
+            if len(node[1][0][1]) and field.type == fd.TYPE_MESSAGE:
+                start = self.write_tag(field, WIRETYPE_LENGTH_DELIMITED, mutation)
+                body = self.begin_length()
+                self.encode_message(node, field.message_type, field_path)
+                if self.cut is not None:
+                    # a field inside was truncated: a truncation of this one
+                    # would move the cut, so its mutation is dropped
+                    mutation = None
+                self.end_length(body, mutation)
+                self.finish_field(start, mutation)
+                continue
+
+            if len(node[1][0][1]):
+                raise BuildError(f"{descriptor.name}.{field.name} is not a message")
+
+            if field.type == fd.TYPE_MESSAGE:
+                # message without any fields
+                start = self.write_tag(field, WIRETYPE_LENGTH_DELIMITED, mutation)
+                self.end_length(self.begin_length(), mutation)
+                self.finish_field(start, mutation)
+                continue
+
+            if is_packed(field):
+                start = self.write_tag(field, WIRETYPE_LENGTH_DELIMITED, mutation)
+                body = self.begin_length()
+                self.put_varint(self.value(field, node, field_path))
+                while i < len(fields) and fields[i][0] is field:
+                    self.put_varint(self.value(field, fields[i][1], field_path))
+                    i += 1
+                self.end_length(body, mutation)
+                self.finish_field(start, mutation)
+                continue
+
+            value = self.value(field, node, field_path)
+            if not has_presence(field) and value == field.default_value:
+                continue
+
+            start = self.write_tag(field, WIRE_TYPES[field.type], mutation)
+            if field.type in (fd.TYPE_STRING, fd.TYPE_BYTES):
+                if isinstance(value, str):
+                    value = value.encode('utf-8')
+                self.write_length_delimited(value, mutation)
+            else:
+                self.put_varint(value, mutation)
+            self.finish_field(start, mutation)
+
+    def value(self, field, node, path):
+        """
+        Return the typed value of a leaf node
+        """
+        content = node[1][0][0]
+        key = self.replace_keys.match(path)
+        if key is not None:
+            value = self.replace[key]
+        elif content in self.values:
+            key = self.field_keys.match(path)
+            if key is None:
+                value = self.values[content]()
+            else:
+                value = self.field_sources[key](content)
+        else:
+            # enum
+            value = content
+
+        try:
+            value = convert(field, value)
+        except ValueError as e:
+            raise BuildError(f"{field.name}: {e}")
+
+        if field.type not in WIRE_TYPES:
+            raise BuildError(f"{field.name}: unsupported type {field.type}")
+        return value
+
+    def write_tag(self, field, wire_type, mutation=None):
+        """
+        Write the field tag, return the position where the field starts
+        """
+        if mutation == "unknown_field":
+            self.write_unknown(field.containing_type)
+
+        start = self.pos
+        if mutation == "wrong_wire_type":
+            wire_type = self.mutator.rng.choice([w for w in range(8) if w != wire_type])
+
+        self.put_varint((field.number << 3) | wire_type)
+        return start
+
+    def write_unknown(self, descriptor):
+        rng = self.mutator.rng
+        number = rng.randint(1, MAX_FIELD_NUMBER)
+        while number in descriptor.fields_by_number:
+            number = rng.randint(1, MAX_FIELD_NUMBER)
+
+        wire_type = rng.choice([WIRETYPE_VARINT, WIRETYPE_FIXED64,
+                                WIRETYPE_LENGTH_DELIMITED, WIRETYPE_FIXED32])
+        self.put_varint((number << 3) | wire_type)
+        if wire_type == WIRETYPE_VARINT:
+            self.put_varint(rng.getrandbits(64))
+        elif wire_type == WIRETYPE_FIXED64:
+            self.put_fixed(rng.getrandbits(64), 8)
+        elif wire_type == WIRETYPE_FIXED32:
+            self.put_fixed(rng.getrandbits(32), 4)
+        else:
+            n = rng.randint(0, 16)
+            self.put_varint(n)
+            self.put_fixed(rng.getrandbits(8 * n), n)
+
+    def put_fixed(self, value, n):
+        self.ensure(n)
+        buf = self.buf
+        for i in range(self.pos, self.pos + n):
+            buf[i] = value & 0xff
+            value >>= 8
+        self.pos += n
+
+    def put_varint(self, value, mutation=None):
+        value &= MASK64
+        extra = 0
+        if mutation == "overlong_varint":
+            extra = self.mutator.rng.randint(1, 10)
+        self.ensure(varint_size(value) + extra)
+
+        buf = self.buf
+        pos = self.pos
+        while value > 0x7f:
+            buf[pos] = (value & 0x7f) | 0x80
+            value >>= 7
+            pos += 1
+
+        if mutation == "overlong_varint":
+            buf[pos] = value | 0x80
+            buf[pos + 1:pos + extra] = b'\x80' * (extra - 1)
+            buf[pos + extra] = 0
+            pos += extra + 1
+        elif mutation == "truncated_varint":
+            buf[pos] = value | 0x80
+            pos += 1
+        else:
+            buf[pos] = value
+            pos += 1
+        self.pos = pos
+
+    def declared_length(self, length, mutation):
+        if mutation == "bad_length":
+            rng = self.mutator.rng
+            return max(0, length + rng.choice([-1, 1]) * rng.randint(1, 16))
+        elif mutation == "oversized_length":
+            return self.mutator.rng.choice(OVERSIZED_LENGTHS)
+        return length
+
+    def write_length_delimited(self, data, mutation=None):
+        self.put_varint(self.declared_length(len(data), mutation), mutation)
+        n = len(data)
+        self.ensure(n)
+        self.buf[self.pos:self.pos + n] = data
+        self.pos += n
+
+    def begin_length(self):
+        """
+        Reserve one byte for the length prefix, return the position of the body
+        """
+        self.ensure(1)
+        self.pos += 1
+        return self.pos
+
+    def end_length(self, body, mutation=None):
+        """
+        Write the length prefix of the body written since begin_length(),
+        moving the body if the prefix takes more than one byte
+        """
+        end = self.pos
+        declared = self.declared_length(end - body, mutation)
+
+        # measure the prefix by writing it past the end of the body
+        self.put_varint(declared, mutation)
+        prefix = self.buf[end:self.pos]
+        shift = len(prefix) - 1
+
+        if shift:
+            self.buf[body + shift:end + shift] = self.buf[body:end]
+            if self.cut is not None and self.cut >= body:
+                self.cut += shift
+
+        self.buf[body - 1:body + shift] = prefix
+        self.pos = end + shift
+
+    def finish_field(self, start, mutation):
+        if mutation == "duplicate_field":
+            n = self.pos - start
+            self.ensure(n)
+            self.buf[self.pos:self.pos + n] = self.buf[start:self.pos]
+            self.pos += n
+        elif mutation == "truncate" and self.pos > start:
+            self.cut = self.mutator.rng.randrange(start, self.pos)
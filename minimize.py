@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import argparse
+import base64
+import json
+import os
+import re
+
+import google.protobuf.text_format as tf
+from google.protobuf.message import DecodeError
+
+from config import services, proto_out
+from lib import helper
+from lib.minimize import Minimizer
+
+def read_input(source, bucket=None, request=None):
+    """
+    Return the (url, request, serialized) input of `source`: an example of a
+    triage file (the first one of `bucket` if given), or a file holding a
+    serialized message of `request`
+    """
+    with open(source, "rb") as f:
+        data = f.read()
+
+    try:
+        examples = [json.loads(line) for line in data.splitlines() if line.strip()]
+    except (UnicodeDecodeError, ValueError):
+        examples = None
+
+    if examples is None:
+        if request is None:
+            raise ValueError(f"{source} is no triage file, give the request of its message")
+        for url, r, _ in services:
+            if r == request:
+                return url, request, data
+        raise ValueError(f"no service for request {request}")
+
+    examples = [e for e in examples if bucket is None or e['bucket'] == bucket]
+    if not examples:
+        raise ValueError(f"no example of bucket {bucket} in {source}")
+    example = examples[0]
+
+    requests = [r for (url, r, _) in services
+                if url == example['url'] and (request is None or r == request)]
+    if len(requests) != 1:
+        raise ValueError(f"{len(requests)} requests for {example['url']}, give the request with -r")
+    return example['url'], requests[0], base64.b64decode(example['input'])
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Minimize an input, keeping the same response")
+    parser.add_argument("source",
+                        help="triage file (see ppfuzz.py -t), or file of a serialized message")
+    parser.add_argument("-b", type=int, metavar="BUCKET",
+                        help="minimize the first example of BUCKET (default: the first one)")
+    parser.add_argument("-r", metavar="REQUEST",
+                        help="request of the message, needed if the source is no triage "
+                             "file or if several requests share its url")
+    parser.add_argument("-c", type=int, default=8, metavar="CONCURRENCY",
+                        help="candidates in flight (default: %(default)s)")
+    parser.add_argument("-T", type=float, default=10, metavar="TIMEOUT",
+                        help="request timeout in seconds (default: %(default)s)")
+    parser.add_argument("-s", action="store_true",
+                        help="only keep the status code (or error) of the response, "
+                             "not the rest of its fingerprint")
+    parser.add_argument("-o", default="minimized", metavar="OUTPUT",
+                        help="write the input to OUTPUT.bin and in text format to "
+                             "OUTPUT.txt (default: %(default)s)")
+    args = parser.parse_args()
+
+    try:
+        url, request, serialized = read_input(args.source, args.b, args.r)
+    except ValueError as e:
+        parser.error(str(e))
+
+    proto = next(p for (u, r, p) in services if (u, r) == (url, request))
+    msg_class = getattr(helper.get_proto_libs([proto])[proto], request)
+
+    minimizer = Minimizer(url, msg_class, args.c, args.T, args.s)
+    try:
+        msg = minimizer.minimize(serialized)
+    except DecodeError as e:
+        parser.error(f"the input is no {request} message: {e}")
+
+    if msg is None:
+        print(f"The response changed from one replay to the next, nothing to minimize "
+              f"({minimizer.tests} tests)")
+        exit(1)
+
+    minimized = msg.SerializePartialToString()
+    with open(f"{args.o}.bin", "wb") as f:
+        f.write(minimized)
+    with open(f"{args.o}.txt", "w") as f:
+        f.write(tf.MessageToString(msg))
+
+    pb2_file = os.path.join(proto_out, re.sub(r'.proto$', '_pb2.py', os.path.basename(proto)))
+    print(f"{len(serialized)} -> {len(minimized)} bytes in {minimizer.tests} tests, "
+          f"written to {args.o}.bin and {args.o}.txt")
+    print(f"./probe.py {url} {request} {pb2_file} {args.o}.txt")
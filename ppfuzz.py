@@ -1,20 +1,176 @@
 #!/usr/bin/env python3
 
-import re
-
-from sys import argv
+import argparse
+import json
+import random
+import sys
 
+from lib import corpus
 from lib import helper
+from lib.stats import Stats
+from lib.triage import Triage
+from lib.values import ALPHABETS
+from lib.wire import Mutator
 from config import *
-from fuzzer import ProtoFuzzer
+from lib.weights import ExpansionWeights
+from fuzzer import ProtoFuzzer, AdaptiveFuzzer, CoverageFuzzer, MutationFuzzer, ParallelFuzzer, \
+    Runner, AsyncRunner
 
 if __name__ == "__main__":
-    
-    if "-C" in argv[1:]:
-        helper.pb_compile(helper.get_proto_files(), proto_out)
+
+    parser = argparse.ArgumentParser(description="Python Protocol Buffers Fuzzer")
+    parser.add_argument("-C", action="store_true",
+                        help="compile the .proto files into proto_out")
+    parser.add_argument("-G", metavar="CORPUS",
+                        help="only generate the inputs, into a length-delimited CORPUS file")
+    parser.add_argument("-n", type=int, default=1,
+                        help="number of inputs (default: %(default)s)")
+    parser.add_argument("-j", type=int, metavar="JOBS",
+                        help="number of generating processes with -G (default: 1), "
+                             "or of parallel protoc runs with -C (default: CPU count)")
+    parser.add_argument("-r", action="append", metavar="REQUEST",
+                        help="only fuzz (or compile) the services of REQUEST, can be repeated")
+    parser.add_argument("-c", type=int, metavar="CONCURRENCY",
+                        help="send asynchronously, with at most CONCURRENCY requests in flight")
+    parser.add_argument("-s", "--seed", type=int,
+                        help="random seed, to reproduce the inputs")
+    parser.add_argument("-b", metavar="ALPHABET", choices=ALPHABETS,
+                        help="generate the payload values in batches, the strings and bytes "
+                             "from ALPHABET (%(choices)s)")
+    parser.add_argument("-E", "--encoder", choices=["message", "text", "wire"],
+                        help="serialize the inputs building the message from the tree, "
+                             "through the text format, or encoding the tree straight to wire "
+                             "format (default: message, wire with -m or -W)")
+    parser.add_argument("-W", "--mutate-wire", type=float, metavar="RATE",
+                        help="with the wire encoder, give a malformed encoding (overlong or "
+                             "truncated varint, bad length, wrong wire type, ...) to each field "
+                             "with probability RATE")
+    parser.add_argument("-t", metavar="TRIAGE",
+                        help="count the responses by fingerprint instead of printing them, "
+                             "writing the first ones of each kind to the JSON lines file TRIAGE")
+    parser.add_argument("-S", metavar="STORE",
+                        help="record the sent inputs, with the fingerprint id of their triage "
+                             "bucket, in the corpus store directory STORE (with -s, also their "
+                             "index in the stream, the seed being noted in STORE/runs); with -m, "
+                             "the inputs of STORE also seed the mutation pools")
+    parser.add_argument("-a", metavar="WEIGHTS",
+                        help="favour the expansions leading to new kinds of responses, "
+                             "with the weights learned so far kept in WEIGHTS")
+    parser.add_argument("-g", metavar="REPORT",
+                        help="favour the expansions not covered yet, writing the grammar "
+                             "coverage of each request to the JSON file REPORT")
+    parser.add_argument("-m", action="store_true",
+                        help="derive most inputs by mutating the trees of the inputs "
+                             "which got new kinds of responses")
+    parser.add_argument("-I", metavar="STATS",
+                        help="time the phases and count the inputs per service, appending "
+                             "the totals to the JSON lines file STATS every 10s")
+    parser.add_argument("-P", metavar="PROMETHEUS",
+                        help="same, written to the Prometheus text format file PROMETHEUS")
+    args = parser.parse_args()
+    if sum(map(bool, (args.a, args.g, args.m))) > 1:
+        parser.error("-a, -g and -m cannot be combined")
+    unknown = helper.unknown_requests(args.r)
+    if unknown:
+        parser.error(f"no service for request(s) {', '.join(unknown)} in the config")
+    if args.G and (args.I or args.P):
+        parser.error("-I and -P do not apply to -G")
+    if args.mutate_wire is not None:
+        if not 0 < args.mutate_wire <= 1:
+            parser.error("-W takes a rate in (0, 1]")
+        if args.encoder not in (None, "wire"):
+            parser.error("-W only applies to the wire encoder")
+
+    batch = {'alphabet': args.b} if args.b else None
+
+    # the wire encoder of -m only encodes again the mutated field
+    encoder = args.encoder or ("wire" if args.m or args.mutate_wire else "message")
+    mutator = Mutator(args.mutate_wire) if args.mutate_wire else None
+
+    if args.C:
+        failures = helper.pb_compile(helper.get_proto_files(args.r), proto_out, args.j)
+        exit(1 if failures else 0)
+
+    if args.G:
+        fuzzer = ParallelFuzzer(args.j or 1, args.seed, min_nonterminals=0, max_nonterminals=40,
+                                requests=args.r, batch=batch, encoder=encoder, mutator=mutator)
+        count = corpus.write_corpus(args.G, fuzzer.fuzz_iter(args.n))
+        print(f"{count} inputs written to {args.G}")
         exit()
 
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    stats = None
+    if args.I or args.P:
+        stats = Stats(args.I, args.P, requests={i: r for (i, (_, r, _)) in enumerate(services)})
+
     # fuzzer = ProtoFuzzer(disp=True, log=True)
-    fuzzer = ProtoFuzzer(min_nonterminals=0, max_nonterminals=40)
-    for _ in range(1):
-        fuzzer.run()
+    kwargs = dict(min_nonterminals=0, max_nonterminals=40, requests=args.r, batch=batch,
+                  encoder=encoder, mutator=mutator, stats=stats)
+    if args.a:
+        fuzzer = AdaptiveFuzzer(ExpansionWeights(args.a), **kwargs)
+    elif args.g:
+        fuzzer = CoverageFuzzer(**kwargs)
+    elif args.m:
+        fuzzer = MutationFuzzer(**kwargs)
+    else:
+        fuzzer = ProtoFuzzer(**kwargs)
+
+    # the novelty of the responses comes from the triage
+    feedback = args.a or args.m
+    triage = Triage(args.t) if args.t or feedback else None
+    store = corpus.CorpusStore(args.S) if args.S else None
+    if store is not None:
+        if args.m:
+            print(f"{fuzzer.load_pool(store)} inputs of {args.S} in the mutation pools")
+        store.add_run(seed=args.seed, args=sys.argv[1:])
+
+    # (url, serialized, vector id, index in the stream of the seed[, trace])
+    inputs = ((v['url'], serialized, v['id'], i if args.seed is not None else None)
+              + ((fuzzer.trace,) if feedback else ())
+              for i, (v, serialized) in enumerate(fuzzer.fuzz_iter(args.n)))
+
+    on_result = None
+    if feedback:
+        on_result = lambda bucket, meta: fuzzer.feedback(meta[2], triage.is_new(bucket))
+
+    try:
+        if args.c:
+            runner = AsyncRunner(args.c, triage=triage, store=store, on_result=on_result,
+                                 stats=stats)
+            result = runner.run_iter(inputs)
+            print(f"{result['sent']} sent, {result['failed']} failed in {result['elapsed']:.2f}s, "
+                  f"{result['rps']:.1f} requests/s")
+        elif triage or store is not None:
+            runner = Runner(triage, store, on_result, stats)
+            for item in inputs:
+                runner.run(*item)
+        else:
+            runner = Runner(stats=stats)
+            for _ in range(args.n):
+                fuzzer.run(runner)
+    finally:
+        if args.a:
+            fuzzer.weights.save()
+        if args.g:
+            report = fuzzer.coverage_report()
+            with open(args.g, "w") as f:
+                json.dump(report, f, indent=1)
+            for request, r in report.items():
+                print(f"{request}: {r['expansions']}/{r['total_expansions']} expansions, "
+                      f"{r['k_paths']}/{r['total_k_paths']} {r['k']}-paths covered")
+        if stats:
+            stats.close()
+
+    if store is not None:
+        store.close()
+        print(f"{len(store)} inputs in {args.S}")
+
+    if triage:
+        triage.close()
+        print(f"{triage.total} responses in {len(triage.buckets)} buckets "
+              f"({triage.overflow} over the limit)" + (f", examples in {args.t}" if args.t else ""))
+        for b in triage.summary()[:20]:
+            print(f"#{b['bucket']:<5} {b['count']:>8}  status {b['status']}, length class "
+                  f"{b['length_class']}, latency class {b['latency_class']}, body {b['body_hash']}")
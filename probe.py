@@ -1,25 +1,101 @@
 #!/usr/bin/env python3
 
-from sys import argv
+import argparse
+import json
 import google.protobuf.text_format as tf
 import re
 from importlib import import_module
-from fuzzer import Runner
+from fuzzer import Runner, AsyncRunner
+from lib import helper
+from lib import replay
 
-if len(argv) < 5:
-    print(f'Syntax: {argv[0]} <url> <endpoint> <proto_file.py> <msg_file>')
-    exit()
+class Replayer(AsyncRunner):
+    """
+    Replay inputs concurrently, keeping the fingerprint of every response
+    """
 
-url, endpoint, pb2_file, msg_file = argv[1:]
+    def __init__(self, concurrency, out):
+        super().__init__(concurrency, log=False)
+        self.out = out
+        self.results = dict()
+        self.latencies = list()
 
-mod_name = re.sub("/", ".", pb2_file)
-mod_name = re.sub(".py$", '', mod_name)
-pb2 = import_module(mod_name)
+    def handle(self, url, serialized, response, vector_id, key):
+        self.add(key, url, response.status_code, response.content, response.latency)
 
-with open(msg_file, "rb") as f:
-    msg = getattr(pb2, endpoint)()
-    tf.Parse(f.read(), msg)    
+    def handle_error(self, url, serialized, error, latency, vector_id, key):
+        self.add(key, url, type(error).__name__, str(error).encode(), latency)
 
-runner = Runner()
-serialized = msg.SerializeToString()
-runner.run(url, serialized)
\ No newline at end of file
+    def add(self, key, url, status, content, latency):
+        r = replay.result(key, url, status, content, latency)
+        self.results[key] = r
+        self.latencies.append(latency)
+        self.out.write(json.dumps(r) + '\n')
+
+def replay_batch(args):
+    from config import services
+
+    inputs = ((services[vector_id][0], serialized, vector_id, key)
+              for key, vector_id, serialized in replay.corpus_inputs(args.b, args.r))
+
+    with open(args.o, "w") as out:
+        replayer = Replayer(args.c, out)
+        stats = replayer.run_iter(inputs)
+
+    print(f"{stats['sent']} replayed, {stats['failed']} failed in {stats['elapsed']:.2f}s, "
+          f"{stats['rps']:.1f} requests/s, results in {args.o}")
+    latency = replay.latency_stats(replayer.latencies)
+    if latency:
+        print("latency: " + ", ".join(f"{k} {v * 1000:.1f}ms" for k, v in latency.items()))
+
+    if args.p:
+        changes = list(replay.diff(replay.read_results(args.p), replayer.results))
+        with open(f"{args.o}.diff", "w") as f:
+            for change in changes:
+                f.write(json.dumps(change) + '\n')
+        counts = {c: sum(1 for change in changes if change['change'] == c)
+                  for c in ('changed', 'new', 'missing')}
+        print(f"against {args.p}: {counts['changed']} changed, {counts['new']} new, "
+              f"{counts['missing']} missing, see {args.o}.diff")
+
+def replay_one(url, endpoint, pb2_file, msg_file):
+    mod_name = re.sub("/", ".", pb2_file)
+    mod_name = re.sub(".py$", '', mod_name)
+    pb2 = import_module(mod_name)
+
+    with open(msg_file, "rb") as f:
+        msg = getattr(pb2, endpoint)()
+        tf.Parse(f.read(), msg)
+
+    runner = Runner()
+    serialized = msg.SerializeToString()
+    runner.run(url, serialized)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Replay protobuf messages",
+        usage="%(prog)s <url> <endpoint> <proto_file.py> <msg_file>\n"
+              "       %(prog)s -b SOURCE [-c CONCURRENCY] [-o RESULTS] [-p PREVIOUS] [-r REQUEST]")
+    parser.add_argument("message", nargs="*", help=argparse.SUPPRESS)
+    parser.add_argument("-b", metavar="SOURCE",
+                        help="replay a corpus file, a corpus store, or a directory of text "
+                             "messages with a sub-directory per request")
+    parser.add_argument("-c", type=int, default=32, metavar="CONCURRENCY",
+                        help="requests in flight (default: %(default)s)")
+    parser.add_argument("-o", default="replay.jsonl", metavar="RESULTS",
+                        help="JSON lines file of the response fingerprints (default: %(default)s)")
+    parser.add_argument("-p", metavar="PREVIOUS",
+                        help="results of a previous replay, the differences go to RESULTS.diff")
+    parser.add_argument("-r", action="append", metavar="REQUEST",
+                        help="only replay the text messages of REQUEST, can be repeated")
+    args = parser.parse_args()
+    unknown = helper.unknown_requests(args.r)
+    if unknown:
+        parser.error(f"no service for request(s) {', '.join(unknown)} in the config")
+
+    if args.b:
+        replay_batch(args)
+    elif len(args.message) == 4:
+        replay_one(*args.message)
+    else:
+        parser.print_usage()
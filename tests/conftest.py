@@ -0,0 +1,21 @@
+import os
+import sys
+
+import pytest
+
+# the synthetic services of bench/config.py, as for bench.py
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+
+@pytest.fixture(scope="session")
+def compiled():
+    """
+    Compile the .proto files of bench/proto into bench_out
+    """
+    from config import proto_out
+    from lib import helper
+
+    if helper.pb_compile(helper.get_proto_files(), proto_out):
+        pytest.fail("protoc failed")
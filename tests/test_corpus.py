@@ -0,0 +1,106 @@
+import multiprocessing
+import os
+
+from lib.corpus import CorpusStore, INDEX_ENTRY
+from lib.triage import Triage
+
+def payload(i, size=1000):
+    return (b"%06d" % i) * (size // 6)
+
+def append_and_die(path, n):
+    store = CorpusStore(path)
+    for i in range(n):
+        store.append(i % 3, payload(i), i)
+    # no close(), nothing flushed
+    os._exit(0)
+
+def check_prefix(store):
+    """
+    The records left are the first ones appended, intact
+    """
+    for i, record in enumerate(store):
+        assert record.vector_id == i % 3
+        assert record.ref == i
+        assert bytes(record.serialized) == payload(i)
+
+def test_append_and_read(tmp_path):
+    with CorpusStore(str(tmp_path)) as store:
+        for i in range(100):
+            assert store.append(i % 3, payload(i, 10), i, i % 2) == i
+        assert store[5].serialized == payload(5, 10)
+        assert store.by_vector(1) == list(range(1, 100, 3))
+
+    with CorpusStore(str(tmp_path)) as store:
+        assert len(store) == 100
+        assert store.by_bucket(1) == list(range(1, 100, 2))
+        assert store[-1].ref == 99
+
+def test_segments(tmp_path):
+    with CorpusStore(str(tmp_path), segment_size=10000) as store:
+        store.extend((i % 3, payload(i)) for i in range(50))
+        assert len(store.segments()) > 1
+
+    with CorpusStore(str(tmp_path), segment_size=10000) as store:
+        assert len(store) == 50
+        assert [bytes(s) for _, s in store.inputs()] == [payload(i) for i in range(50)]
+
+def test_killed_writer(tmp_path):
+    process = multiprocessing.Process(target=append_and_die, args=(str(tmp_path), 2000))
+    process.start()
+    process.join()
+
+    with CorpusStore(str(tmp_path)) as store:
+        # the records of the flushed part of the segment buffer
+        assert 0 < len(store) < 2000
+        check_prefix(store)
+        count = len(store)
+        store.append(count % 3, payload(count), count)
+
+    with CorpusStore(str(tmp_path)) as store:
+        assert len(store) == count + 1
+        check_prefix(store)
+
+def test_truncated_index(tmp_path):
+    with CorpusStore(str(tmp_path)) as store:
+        for i in range(100):
+            store.append(i % 3, payload(i), i)
+
+    index = os.path.join(str(tmp_path), "index")
+    with open(index, "r+b") as f:
+        f.truncate(40 * INDEX_ENTRY.size + 7)
+
+    # the records following the last entry are indexed again
+    with CorpusStore(str(tmp_path)) as store:
+        assert len(store) == 100
+        check_prefix(store)
+
+def test_truncated_segment(tmp_path):
+    with CorpusStore(str(tmp_path)) as store:
+        for i in range(100):
+            store.append(i % 3, payload(i), i)
+        end = store.entry(60)[1]
+
+    with open(store.segment_path(0), "r+b") as f:
+        f.truncate(end + 10)
+
+    # the entries of the lost records are dropped, not only the last one
+    with CorpusStore(str(tmp_path)) as store:
+        assert len(store) == 60
+        check_prefix(store)
+        assert os.path.getsize(store.segment_path(0)) == end
+
+def test_buckets_across_runs(tmp_path):
+    # the same kinds of responses, found in a different order by each run
+    for statuses in ([200, 500], [500, 200]):
+        triage = Triage(log=False)
+        with CorpusStore(str(tmp_path)) as store:
+            for i in range(10):
+                status = statuses[i % 2]
+                bucket = triage.add("http://localhost/", b"", status, {}, b"%d" % status, 0.0)
+                store.append(0, b"%d" % status, None, triage.bucket_id(bucket))
+
+    with CorpusStore(str(tmp_path)) as store:
+        buckets = store.buckets()
+        assert sorted(buckets.values()) == [10, 10]
+        for bucket in buckets:
+            assert len({bytes(store[n].serialized) for n in store.by_bucket(bucket)}) == 1
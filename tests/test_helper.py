@@ -0,0 +1,29 @@
+import pytest
+
+from fuzzer import ProtoFuzzer
+from lib import helper
+
+def test_unknown_requests():
+    assert helper.unknown_requests(None) == []
+    assert helper.unknown_requests(["DeepRequest", "NoSuch"]) == ["NoSuch"]
+    assert [s[1] for _, s in helper.selected_services(["DeepRequest"])] == ["DeepRequest"]
+    with pytest.raises(ValueError, match="NoSuch"):
+        helper.selected_services(["DeepRequest", "NoSuch"])
+
+def test_fuzzer_unknown_request(compiled):
+    with pytest.raises(ValueError, match="NoSuch"):
+        ProtoFuzzer(cache=False, requests=["NoSuch"])
+
+def test_recompile_on_new_generator(tmp_path, monkeypatch, capsys):
+    files = ["bench/proto/Deep.proto"]
+    dest = str(tmp_path / "out")
+    assert helper.pb_compile(files, dest) == {}
+    assert helper.pb_compile(files, dest) == {}
+    assert "0 to compile" in capsys.readouterr().out
+
+    # a protoc or protobuf upgrade makes the generated files outdated
+    monkeypatch.setattr(helper, "generator_version", lambda: "libprotoc 99.0, protobuf 99.0")
+    assert helper.pb_compile(files, dest) == {}
+    assert "1 to compile" in capsys.readouterr().out
+    assert helper.pb_compile(files, dest) == {}
+    assert "0 to compile" in capsys.readouterr().out
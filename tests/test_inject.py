@@ -0,0 +1,30 @@
+from lib.inject import Template
+from lib.inject_const import *
+
+TEXT = f"""token: {INJECT_STRING}
+blob: {INJECT_BYTES}
+count: {INJECT_INT32}
+auth {{
+token: {INJECT_STRING}
+}}
+"""
+
+def test_set_types():
+    template = Template(TEXT)
+    template.set('blob', b'\x00\xff"')
+    template.set('count', 42)
+    template.set('token', 'café "x"')
+
+    assert template.text == ('token: "café \\"x\\""\n'
+                             'blob: "\\000\\377\\""\n'
+                             'count: 42\n'
+                             'auth {\n'
+                             'token: "café \\"x\\""\n'
+                             '}\n')
+
+def test_set_int_in_string_field():
+    template = Template(TEXT)
+    template.set('auth.token', 1234)
+    template.delete('blob')
+    template.inject({INJECT_STRING: lambda: "s", INJECT_INT32: lambda: 7})
+    assert template.text == 'token: "s"\ncount: 7\nauth {\ntoken: "1234"\n}\n'
@@ -0,0 +1,61 @@
+import importlib
+
+import pytest
+
+from config import proto_out
+from lib.minimize import Minimizer, removable, remove, split
+
+def interesting(msg):
+    return (3 in msg.ids and 7 in msg.ids
+            and any(row.row_id == 5 and "x" in "".join(row.cells) for row in msg.rows))
+
+class PredicateMinimizer(Minimizer):
+    """
+    Minimizer asking `predicate` instead of a server
+    """
+
+    def __init__(self, msg_class, predicate, **kwargs):
+        super().__init__("http://127.0.0.1:1/", msg_class, log=False, **kwargs)
+        self.predicate = predicate
+
+    async def send(self, serialized):
+        self.tests += 1
+        msg = self.msg_class()
+        msg.ParseFromString(serialized)
+        return ("interesting",) if self.predicate(msg) else ("boring",)
+
+@pytest.fixture(scope="module")
+def pb2(compiled):
+    return importlib.import_module(f"{proto_out}.Repeated_pb2")
+
+def test_split():
+    assert split(list(range(7)), 3) == [[0, 1, 2], [3, 4], [5, 6]]
+    assert split([1], 2) == [[1], []]
+
+def test_ddmin(pb2):
+    msg = pb2.RepeatedRequest(token="secret", note="note", ids=range(10), stamps=[1, 2, 3],
+                              labels=["a", "b"], chunks=[b"\x00" * 100])
+    for i in range(8):
+        row = msg.rows.add(row_id=i, cells=["cell", "x" * 40, "cell"])
+        row.typed.add(number=i, set=True, parts=[b"part"])
+    assert interesting(msg)
+
+    minimizer = PredicateMinimizer(pb2.RepeatedRequest, interesting)
+    result = minimizer.minimize(msg.SerializeToString())
+
+    assert interesting(result)
+    assert list(result.ids) == [3, 7]
+    assert [row.row_id for row in result.rows] == [5]
+    assert list(result.rows[0].cells) == ["x"]
+    assert not result.labels and not result.chunks and not result.stamps
+    assert not result.HasField("note") and not result.rows[0].typed
+    assert result.token == ""
+
+    # 1-minimal: none of the parts left can go
+    for unit in removable(result):
+        assert not interesting(remove(result, [unit]))
+
+def test_flaky(pb2):
+    answers = iter([True, False])
+    minimizer = PredicateMinimizer(pb2.RepeatedRequest, lambda msg: next(answers))
+    assert minimizer.minimize(pb2.RepeatedRequest(token="t").SerializeToString()) is None
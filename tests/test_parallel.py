@@ -0,0 +1,27 @@
+import random
+
+from fuzzer import ParallelFuzzer
+
+KWARGS = dict(min_nonterminals=0, max_nonterminals=40, cache=False, requests=["ScalarsRequest"])
+
+def generate(processes, seed, n=40):
+    fuzzer = ParallelFuzzer(processes, seed, batch_size=8, **KWARGS)
+    return [(v['id'], serialized) for v, serialized in fuzzer.fuzz_iter(n)]
+
+def test_reproducible(compiled):
+    inputs = generate(1, 1)
+    assert len(inputs) == 40
+    assert generate(2, 1) == inputs
+    assert generate(1, 2) != inputs
+
+def test_caller_random_state(compiled):
+    random.seed(5)
+    expected = [random.random() for _ in range(3)]
+
+    random.seed(5)
+    fuzzer = ParallelFuzzer(1, 1, batch_size=8, **KWARGS)
+    drawn = []
+    for _ in fuzzer.fuzz_iter(20):
+        if len(drawn) < 3:
+            drawn.append(random.random())
+    assert drawn == expected
@@ -0,0 +1,140 @@
+import asyncio
+
+import pytest
+
+from urllib.parse import urlsplit
+
+from lib.transport import Client, TransportError
+
+class Server():
+    """
+    HTTP server on a local port answering every request with `response`,
+    closing each connection after `keep` requests (never if None)
+    """
+
+    def __init__(self, response, keep=None):
+        self.response = response
+        self.keep = keep
+        self.connections = 0
+        self.requests = []
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        served = 0
+        try:
+            while self.keep is None or served < self.keep:
+                head = await reader.readuntil(b"\r\n\r\n")
+                length = [line for line in head.split(b"\r\n")
+                          if line.lower().startswith(b"content-length:")]
+                body = await reader.readexactly(int(length[0].split(b":")[1]) if length else 0)
+                self.requests.append(body)
+                writer.write(self.response)
+                await writer.drain()
+                served += 1
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.url = f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/path"
+        return self
+
+    async def __aexit__(self, *exc):
+        self.server.close()
+        await self.server.wait_closed()
+
+OK = b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok"
+
+def test_keep_alive():
+    async def main():
+        async with Server(OK) as server:
+            client = Client(pool_size=4)
+            try:
+                for i in range(5):
+                    r = await client.post(server.url, b"%d" % i)
+                    assert (r.status_code, r.content) == (200, b"ok")
+            finally:
+                client.close()
+            return server
+
+    server = asyncio.run(main())
+    assert server.connections == 1
+    assert server.requests == [b"0", b"1", b"2", b"3", b"4"]
+
+def test_reconnect_after_idle_close():
+    async def main():
+        # the server closes the connections after one request, without saying so
+        async with Server(OK, keep=1) as server:
+            client = Client(pool_size=4)
+            try:
+                for i in range(3):
+                    r = await client.post(server.url, b"%d" % i)
+                    assert r.content == b"ok"
+                    # let the server close the idle connection
+                    await asyncio.sleep(0.05)
+            finally:
+                client.close()
+            return server
+
+    server = asyncio.run(main())
+    assert server.connections == 3
+    assert server.requests == [b"0", b"1", b"2"]
+
+def test_connection_close():
+    response = b"HTTP/1.1 500 Error\r\nConnection: close\r\nContent-Length: 3\r\n\r\nbad"
+    async def main():
+        async with Server(response) as server:
+            client = Client(pool_size=4)
+            try:
+                for i in range(2):
+                    r = await client.post(server.url, b"x")
+                    assert (r.status_code, r.text) == (500, "bad")
+                assert not client.pools[("http", urlsplit(server.url).netloc)].idle
+            finally:
+                client.close()
+            return server
+
+    assert asyncio.run(main()).connections == 2
+
+def test_chunked():
+    response = (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"3\r\nabc\r\n4;ext=1\r\ndefg\r\n0\r\nTrailer: x\r\n\r\n")
+    async def main():
+        async with Server(response) as server:
+            client = Client()
+            try:
+                first = await client.post(server.url, b"")
+                second = await client.post(server.url, b"")
+            finally:
+                client.close()
+            return server, first, second
+
+    server, first, second = asyncio.run(main())
+    assert first.content == second.content == b"abcdefg"
+    assert server.connections == 1
+
+def test_timeout():
+    async def main():
+        async with Server(b"") as server:
+            client = Client(timeout=0.1)
+            try:
+                with pytest.raises(asyncio.TimeoutError):
+                    await client.post(server.url, b"x")
+            finally:
+                client.close()
+
+    asyncio.run(main())
+
+def test_invalid_status_line():
+    async def main():
+        async with Server(b"garbage\r\n\r\n", keep=1) as server:
+            client = Client()
+            try:
+                with pytest.raises(TransportError):
+                    await client.post(server.url, b"x")
+            finally:
+                client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,144 @@
+import random
+
+import pytest
+
+from config import replace, delete
+from fuzzer import ProtoFuzzer
+from lib.builder import Builder
+from lib.inject_const import *
+from lib.wire import MUTATIONS, Mutator, WireEncoder, decode_varint, encode_varint, \
+    field_spans, varint_size
+
+# the same values whichever order the encoders fill the placeholders in
+VALUES = {
+    INJECT_INT32: lambda: -7,
+    INJECT_INT64: lambda: 1 << 40,
+    INJECT_BOOL: lambda: 1,
+    INJECT_STRING: lambda: "café",
+    INJECT_BYTES: lambda: b"\x00\xff",
+}
+
+class Script(Mutator):
+    """
+    Mutator choosing the mutations of the fields in encoding order from a list
+    """
+
+    def __init__(self, mutations, rng):
+        super().__init__(1, rng=rng)
+        self.script = iter(mutations)
+
+    def choose(self):
+        return next(self.script, None)
+
+@pytest.fixture(scope="module")
+def fuzzers(compiled):
+    fuzzers = dict()
+    for request in ["DeepRequest", "RepeatedRequest", "ScalarsRequest", "WideRequest"]:
+        fuzzers[request] = ProtoFuzzer(min_nonterminals=0, max_nonterminals=40, cache=False,
+                                       requests=[request])
+        fuzzers[request].v = fuzzers[request].vectors[0]
+    return fuzzers
+
+def encode(fuzzer, tree, mutator=None):
+    fuzzer.wire_encoder.mutator = mutator
+    try:
+        return fuzzer.wire_encoder.encode(tree, fuzzer.v['msg'].DESCRIPTOR, VALUES, replace, delete)
+    finally:
+        fuzzer.wire_encoder.mutator = None
+
+def build(fuzzer, tree):
+    builder = Builder(tree, fuzzer.v['msg'], delete, replace)
+    for inj_type, func in VALUES.items():
+        builder.fill(inj_type, func)
+    return builder.message
+
+# the encoding of the int32 and int64 values, negative ones sign extended to 64 bits
+VARINTS = {
+    0: b"\x00",
+    1: b"\x01",
+    127: b"\x7f",
+    128: b"\x80\x01",
+    300: b"\xac\x02",
+    16383: b"\xff\x7f",
+    16384: b"\x80\x80\x01",
+    (1 << 31) - 1: b"\xff\xff\xff\xff\x07",
+    (1 << 32) - 1: b"\xff\xff\xff\xff\x0f",
+    (1 << 63) - 1: b"\xff" * 8 + b"\x7f",
+    -1: b"\xff" * 9 + b"\x01",
+    -2: b"\xfe" + b"\xff" * 8 + b"\x01",
+    -(1 << 31): b"\x80\x80\x80\x80\xf8\xff\xff\xff\xff\x01",
+    -(1 << 63): b"\x80" * 9 + b"\x01",
+}
+
+@pytest.mark.parametrize("value", VARINTS)
+def test_varint(value):
+    encoded = encode_varint(value)
+    assert encoded == VARINTS[value]
+    assert len(encoded) == varint_size(value & ((1 << 64) - 1))
+    assert decode_varint(b"\x00" + encoded + b"\x00", 1) == (value & ((1 << 64) - 1),
+                                                              len(encoded) + 1)
+
+def test_varint_limits():
+    assert encode_varint((1 << 64) - 1) == encode_varint(-1)
+    with pytest.raises(ValueError):
+        decode_varint(b"\x80\x80")
+    with pytest.raises(ValueError):
+        decode_varint(b"\x80" * 10 + b"\x01")
+
+def test_encoder_varint():
+    encoder = WireEncoder(size=1)
+    for value in VARINTS:
+        encoder.put_varint(value)
+    assert bytes(encoder.buf[:encoder.pos]) == b"".join(VARINTS.values())
+
+@pytest.mark.parametrize("request_name", ["DeepRequest", "RepeatedRequest", "ScalarsRequest",
+                                          "WideRequest"])
+def test_serialize_equal(fuzzers, request_name):
+    fuzzer = fuzzers[request_name]
+    random.seed(request_name)
+    for _ in range(50):
+        tree = fuzzer.fuzz_tree()
+        msg = build(fuzzer, tree)
+        assert encode(fuzzer, tree) == msg.SerializeToString()
+
+        # and with the random values
+        encoded = fuzzer.encode_wire(tree)
+        msg = fuzzer.v['msg']()
+        msg.ParseFromString(encoded)
+        assert encoded == msg.SerializeToString()
+
+def test_mutations(fuzzers):
+    fuzzer = fuzzers["ScalarsRequest"]
+    random.seed(2)
+    for mutation in MUTATIONS:
+        mutated = 0
+        for i in range(20):
+            tree = fuzzer.fuzz_tree()
+            plain = encode(fuzzer, tree)
+            encoded = encode(fuzzer, tree, Mutator(0.2, [mutation], random.Random(i)))
+            mutated += encoded != plain
+        assert mutated, mutation
+
+def test_truncate_inside_message(fuzzers):
+    fuzzer = fuzzers["DeepRequest"]
+    random.seed(1)
+    tested = 0
+    while tested < 50:
+        tree = fuzzer.fuzz_tree()
+        plain = encode(fuzzer, tree)
+        spans = field_spans(plain)
+        if 3 not in spans or spans[3][1] - spans[3][0] < 3:
+            continue
+        tested += 1
+
+        # the first field of l01, after its tag and length prefix
+        start, end = spans[3]
+        _, inner = decode_varint(plain, start + 1)
+        first = min(field_spans(plain[inner:end]).values())
+        first_end = inner + first[1]
+
+        # token as is, then both l01 and its first field truncated
+        truncated = encode(fuzzer, tree, Script([None, "truncate", "truncate"], random.Random(tested)))
+        assert truncated[:start + 1] == plain[:start + 1]
+        assert inner <= len(truncated) < first_end
+        assert plain[inner:first_end].startswith(truncated[inner:])